@@ -0,0 +1,250 @@
+"""
+Control de admisión con prioridades para proteger las lecturas interactivas.
+
+Cada solicitud HTTP se clasifica por ruta en una clase:
+- interactiva: lecturas y escrituras simples (/pacientes, /fhir/Patient/{id}, ...)
+- ia: /ai/* (modelo de lenguaje, sklearn)
+- lote: importaciones y recálculos (/fhir/import, /analytics/.../calcular, ...)
+
+Cada clase tiene un límite de solicitudes en curso y todas comparten una capacidad
+total. Si no hay cupo la solicitud espera en una cola acotada ordenada por prioridad
+(interactiva > ia > lote); cuando se libera un cupo entra la de mayor prioridad. Si la
+cola está llena o la espera supera el máximo de su clase se responde 503 de inmediato.
+Además, ia y lote tienen una cubeta de tokens por cliente (cabecera X-Cliente-Id o IP):
+al agotarla se responde 429. Ambos rechazos incluyen Retry-After.
+
+Los WebSocket, el SSE de cambios y /health no pasan por el control de admisión.
+"""
+import asyncio
+import heapq
+import itertools
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+
+PRIORIDADES = {"interactiva": 0, "ia": 1, "lote": 2}
+
+CAPACIDAD = int(os.getenv("ADMISION_CAPACIDAD", "32"))
+TAMANO_COLA = int(os.getenv("ADMISION_TAMANO_COLA", "64"))
+LIMITES = {
+    "interactiva": CAPACIDAD,
+    "ia": int(os.getenv("ADMISION_LIMITE_IA", "4")),
+    "lote": int(os.getenv("ADMISION_LIMITE_LOTE", "1")),
+}
+# Espera máxima en cola (segundos): una lectura que espera demasiado ya no cumple su latencia
+ESPERA_MAXIMA = {
+    "interactiva": float(os.getenv("ADMISION_ESPERA_INTERACTIVA", "2")),
+    "ia": float(os.getenv("ADMISION_ESPERA_IA", "10")),
+    "lote": float(os.getenv("ADMISION_ESPERA_LOTE", "30")),
+}
+# (tokens por segundo, ráfaga) por cliente; las clases sin entrada no se limitan por cliente
+CUBETAS = {
+    "ia": (float(os.getenv("ADMISION_TASA_IA", "0.5")), float(os.getenv("ADMISION_RAFAGA_IA", "5"))),
+    "lote": (float(os.getenv("ADMISION_TASA_LOTE", "0.05")), float(os.getenv("ADMISION_RAFAGA_LOTE", "2"))),
+}
+MAX_CLIENTES = 10000
+
+# (método o None, prefijo, sufijo o None, clase o None = sin control); la primera coincidencia gana
+REGLAS = [
+    (None, "/health", None, None),
+    (None, "/eventos/", None, None),
+    (None, "/ai/", None, "ia"),
+    ("POST", "/fhir/import", None, "lote"),
+    ("POST", "/historial/batch", None, "lote"),
+    ("POST", "/analytics/", "/calcular", "lote"),
+    ("POST", "/analytics/", "/refrescar", "lote"),
+    ("GET", "/analytics/tamizaje", None, "lote"),
+]
+
+def clasificar(metodo, ruta):
+    """Clase de la solicitud o None si no pasa por el control de admisión"""
+    for metodo_regla, prefijo, sufijo, clase in REGLAS:
+        if metodo_regla not in (None, metodo):
+            continue
+        if ruta.startswith(prefijo) and (sufijo is None or ruta.endswith(sufijo)):
+            return clase
+    return "interactiva"
+
+class Rechazo(Exception):
+    def __init__(self, status, motivo, reintentar):
+        super().__init__(motivo)
+        self.status = status
+        self.motivo = motivo
+        self.reintentar = max(1, math.ceil(reintentar))
+
+class CubetaTokens:
+    def __init__(self, tasa, rafaga):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.tokens = rafaga
+        self.actualizado = time.monotonic()
+
+    def tomar(self):
+        """Devuelve 0 si hay token o los segundos hasta el próximo"""
+        ahora = time.monotonic()
+        self.tokens = min(self.rafaga, self.tokens + (ahora - self.actualizado) * self.tasa)
+        self.actualizado = ahora
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.tasa
+
+class ControlAdmision:
+    """Cupos por clase y cola de prioridad; se usa desde un único event loop por worker"""
+
+    def __init__(self, capacidad=CAPACIDAD, limites=LIMITES, tamano_cola=TAMANO_COLA,
+                 espera_maxima=ESPERA_MAXIMA, cubetas=CUBETAS):
+        self.capacidad = capacidad
+        self.limites = dict(limites)
+        self.tamano_cola = tamano_cola
+        self.espera_maxima = dict(espera_maxima)
+        self.config_cubetas = dict(cubetas)
+        self.cubetas = OrderedDict()
+        self.en_curso = {clase: 0 for clase in PRIORIDADES}
+        self.cola = []                  # heap de (prioridad, secuencia, clase, future)
+        self.en_cola = {clase: 0 for clase in PRIORIDADES}
+        self.secuencia = itertools.count()
+        self.admitidas = {clase: 0 for clase in PRIORIDADES}
+        self.rechazos = {clase: {"cola_llena": 0, "espera_excedida": 0, "limite_cliente": 0} for clase in PRIORIDADES}
+        # Duración media (EWMA) por clase para estimar Retry-After
+        self.duracion_media = {clase: 1.0 for clase in PRIORIDADES}
+
+    def hay_cupo(self, clase):
+        return sum(self.en_curso.values()) < self.capacidad and self.en_curso[clase] < self.limites[clase]
+
+    def verificar_cliente(self, clase, cliente):
+        if clase not in self.config_cubetas:
+            return
+        clave = (clase, cliente)
+        cubeta = self.cubetas.get(clave)
+        if cubeta is None:
+            cubeta = self.cubetas[clave] = CubetaTokens(*self.config_cubetas[clase])
+            if len(self.cubetas) > MAX_CLIENTES:
+                self.cubetas.popitem(last=False)
+        self.cubetas.move_to_end(clave)
+        espera = cubeta.tomar()
+        if espera:
+            self.rechazos[clase]["limite_cliente"] += 1
+            raise Rechazo(429, "Demasiadas solicitudes de este cliente", espera)
+
+    def estimar_espera(self, clase):
+        return self.duracion_media[clase] * (1 + self.en_cola[clase]) / max(1, self.limites[clase])
+
+    async def admitir(self, clase, cliente):
+        """Espera un cupo o lanza Rechazo"""
+        self.verificar_cliente(clase, cliente)
+        # Sin cola de mayor o igual prioridad se entra directo
+        if self.hay_cupo(clase) and not any(f[0] <= PRIORIDADES[clase] for f in self.cola):
+            self.ocupar(clase)
+            return
+        if len(self.cola) >= self.tamano_cola:
+            self.rechazos[clase]["cola_llena"] += 1
+            raise Rechazo(503, "Servicio saturado", self.estimar_espera(clase))
+
+        futuro = asyncio.get_running_loop().create_future()
+        entrada = (PRIORIDADES[clase], next(self.secuencia), clase, futuro)
+        heapq.heappush(self.cola, entrada)
+        self.en_cola[clase] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(futuro), self.espera_maxima[clase])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if futuro.done() and not futuro.cancelled():
+                # Se le asignó el cupo justo al vencer: se devuelve
+                self.liberar(clase)
+            else:
+                futuro.cancel()
+                self.cola.remove(entrada)
+                heapq.heapify(self.cola)
+                self.en_cola[clase] -= 1
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.rechazos[clase]["espera_excedida"] += 1
+            raise Rechazo(503, "Tiempo de espera en cola excedido", self.estimar_espera(clase))
+
+    def ocupar(self, clase):
+        self.en_curso[clase] += 1
+        self.admitidas[clase] += 1
+
+    def liberar(self, clase, duracion=None):
+        self.en_curso[clase] -= 1
+        if duracion is not None:
+            self.duracion_media[clase] = 0.9 * self.duracion_media[clase] + 0.1 * duracion
+        self.despertar()
+
+    def despertar(self):
+        """Da los cupos libres a las solicitudes en cola, por prioridad"""
+        pendientes = []
+        while self.cola:
+            entrada = heapq.heappop(self.cola)
+            clase, futuro = entrada[2], entrada[3]
+            if self.hay_cupo(clase):
+                self.en_cola[clase] -= 1
+                self.ocupar(clase)
+                futuro.set_result(True)
+            else:
+                # Su clase está al límite: puede entrar una de menor prioridad si hay capacidad
+                pendientes.append(entrada)
+                if sum(self.en_curso.values()) >= self.capacidad:
+                    break
+        for entrada in pendientes:
+            heapq.heappush(self.cola, entrada)
+
+    def estado(self):
+        return {
+            "capacidad": self.capacidad,
+            "en_curso": dict(self.en_curso),
+            "en_cola": dict(self.en_cola),
+            "limites": dict(self.limites),
+            "admitidas": dict(self.admitidas),
+            "rechazos": {clase: dict(r) for clase, r in self.rechazos.items()},
+            "duracion_media_segundos": {clase: round(d, 3) for clase, d in self.duracion_media.items()},
+        }
+
+control = ControlAdmision()
+
+def identificar_cliente(scope):
+    for nombre, valor in scope.get("headers", []):
+        if nombre == b"x-cliente-id":
+            return valor.decode("latin-1")
+    cliente = scope.get("client")
+    return cliente[0] if cliente else "desconocido"
+
+class MiddlewareAdmision:
+    """Middleware ASGI: el cupo se mantiene hasta terminar de enviar la respuesta (incluye streaming)"""
+
+    def __init__(self, app, control=control):
+        self.app = app
+        self.control = control
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        clase = clasificar(scope["method"], scope["path"])
+        if clase is None or scope["method"] == "OPTIONS":
+            return await self.app(scope, receive, send)
+
+        try:
+            await self.control.admitir(clase, identificar_cliente(scope))
+        except Rechazo as r:
+            return await responder_rechazo(send, r, clase)
+
+        inicio = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.control.liberar(clase, time.monotonic() - inicio)
+
+async def responder_rechazo(send, rechazo, clase):
+    cuerpo = json.dumps({"detail": rechazo.motivo, "clase": clase, "reintentar_en": rechazo.reintentar}).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": rechazo.status,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(cuerpo)).encode()),
+            (b"retry-after", str(rechazo.reintentar).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": cuerpo})
@@ -0,0 +1,204 @@
+"""
+Consultas analíticas con DuckDB embebido (opcional).
+
+DuckDB corre dentro del proceso, sin servicios adicionales, y lee:
+- los snapshots Parquet de snapshots.py (ANALITICA_FUENTE=snapshot, por defecto), o
+- PostgreSQL directamente con la extensión postgres (ANALITICA_FUENTE=postgres).
+
+En ambos casos se exponen las mismas vistas (pacientes, historial_medico, observaciones),
+así que las consultas son idénticas. Cada respuesta incluye la frescura de los datos:
+la hora del último snapshot y su antigüedad, o "en vivo" al leer de PostgreSQL.
+
+Requiere duckdb (pip install duckdb).
+"""
+import json
+import os
+import threading
+from datetime import datetime
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+import snapshots
+from database import SQLALCHEMY_DATABASE_URL
+
+FUENTE = os.getenv("ANALITICA_FUENTE", "snapshot")
+INTERVALOS_TIEMPO = {"semana": "week", "mes": "month", "trimestre": "quarter", "anio": "year"}
+MAX_INTERVALOS_HISTOGRAMA = 100
+
+class DuckDBNoDisponible(Exception):
+    """duckdb no está instalado o no hay datos que consultar"""
+
+def sql_vistas_snapshot(destino):
+    vistas = []
+    for tabla in ("pacientes", "historial_medico", "observaciones"):
+        particiones = snapshots.columnas_particion(snapshots.TABLAS[tabla])
+        opciones = ""
+        if particiones:
+            tipos = ", ".join(f"'{c}': VARCHAR" for c in particiones)
+            opciones = f", hive_partitioning = true, hive_types = {{{tipos}}}"
+        patron = os.path.join(destino, tabla, "**", "*.parquet")
+        vistas.append(f"CREATE OR REPLACE VIEW {tabla} AS SELECT * FROM read_parquet('{patron}'{opciones})")
+    return vistas
+
+def sql_vistas_postgres():
+    dsn = SQLALCHEMY_DATABASE_URL.replace("postgresql+psycopg2://", "postgresql://")
+    return [
+        "INSTALL postgres",
+        "LOAD postgres",
+        f"ATTACH '{dsn}' AS pg (TYPE postgres, READ_ONLY)",
+    ] + [
+        f"CREATE OR REPLACE VIEW {tabla} AS SELECT * FROM pg.public.{tabla}"
+        for tabla in ("pacientes", "historial_medico", "observaciones")
+    ]
+
+class MotorAnalitico:
+    """Conexión DuckDB compartida; cada consulta usa un cursor propio (seguro entre hilos)"""
+
+    def __init__(self, fuente=FUENTE, destino=snapshots.DESTINO):
+        self.fuente = fuente
+        self.destino = destino
+        self.conexion = None
+        self.lock = threading.Lock()
+
+    def conectar(self):
+        if duckdb is None:
+            raise DuckDBNoDisponible("La analítica con DuckDB requiere el paquete duckdb: pip install duckdb")
+        with self.lock:
+            if self.conexion is None:
+                if self.fuente == "snapshot" and not snapshots.existe("observaciones", self.destino):
+                    raise DuckDBNoDisponible("No hay snapshots; ejecute python snapshots.py exportar")
+                conexion = duckdb.connect(database=":memory:")
+                for sql in (sql_vistas_snapshot(self.destino) if self.fuente == "snapshot" else sql_vistas_postgres()):
+                    conexion.execute(sql)
+                self.conexion = conexion
+        return self.conexion
+
+    def consultar(self, sql, parametros=()):
+        cursor = self.conectar().cursor()
+        try:
+            cursor.execute(sql, list(parametros))
+            columnas = [c[0] for c in cursor.description]
+            return [dict(zip(columnas, fila)) for fila in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def frescura(self):
+        if self.fuente != "snapshot":
+            return {"fuente": "postgres", "en_vivo": True}
+        estado = snapshots.leer_estado(self.destino)
+        exportados = [t["exportado"] for t in estado["tablas"].values() if t.get("exportado")]
+        if not exportados:
+            return {"fuente": "snapshot", "en_vivo": False, "actualizado": None}
+        actualizado = min(exportados)
+        return {
+            "fuente": "snapshot",
+            "en_vivo": False,
+            "actualizado": actualizado,
+            "antiguedad_segundos": round((datetime.now() - datetime.fromisoformat(actualizado)).total_seconds()),
+        }
+
+motor = MotorAnalitico()
+
+# Último valor de cada paciente para un biomarcador
+SQL_ULTIMOS = """
+    ultimos AS (
+        SELECT paciente_id, arg_max(valor, fecha_efectiva) AS valor
+        FROM observaciones
+        WHERE codigo = ?
+        GROUP BY paciente_id
+    )
+"""
+
+# Suplemento más reciente de cada paciente ('sin_dato' es la partición de los nulos)
+SQL_SUPLEMENTOS = """
+    suplementos AS (
+        SELECT paciente_id, arg_max(suplemento, fecha_inicio) AS suplemento
+        FROM historial_medico
+        WHERE suplemento IS NOT NULL AND suplemento NOT IN ('', 'sin_dato')
+        GROUP BY paciente_id
+    )
+"""
+
+def distribucion(codigo, intervalos=20):
+    """Histograma y percentiles del último valor por paciente"""
+    intervalos = max(1, min(intervalos, MAX_INTERVALOS_HISTOGRAMA))
+    resumen = motor.consultar(f"""
+        WITH {SQL_ULTIMOS}
+        SELECT count(*) AS n, avg(valor) AS media, stddev_samp(valor) AS desviacion,
+               min(valor) AS minimo, max(valor) AS maximo,
+               quantile_cont(valor, [0.1, 0.25, 0.5, 0.75, 0.9]) AS percentiles
+        FROM ultimos
+    """, [codigo])[0]
+    histograma = []
+    if resumen["n"]:
+        histograma = motor.consultar(f"""
+            WITH {SQL_ULTIMOS},
+            limites AS (SELECT min(valor) AS desde, (max(valor) - min(valor)) / ? + 1e-9 AS ancho FROM ultimos),
+            asignados AS (
+                SELECT least(floor((valor - desde) / ancho), ? - 1)::INTEGER AS intervalo, desde, ancho
+                FROM ultimos, limites
+            )
+            SELECT intervalo, min(desde) + intervalo * min(ancho) AS desde,
+                   min(desde) + (intervalo + 1) * min(ancho) AS hasta, count(*) AS n
+            FROM asignados
+            GROUP BY intervalo
+            ORDER BY intervalo
+        """, [codigo, intervalos, intervalos])
+    percentiles = resumen.pop("percentiles") or [None] * 5
+    resumen.update(zip(["p10", "p25", "p50", "p75", "p90"], percentiles))
+    return {"codigo": codigo, "resumen": resumen, "histograma": histograma, "frescura": motor.frescura()}
+
+def comparar_cohortes(codigo, suplementos=None):
+    """Estadísticas del último valor por cohorte de suplemento actual (incluye 'Sin suplemento')"""
+    filtro = ""
+    parametros = [codigo]
+    if suplementos:
+        filtro = f"WHERE cohorte IN ({', '.join('?' for _ in suplementos)})"
+        parametros += list(suplementos)
+    grupos = motor.consultar(f"""
+        WITH {SQL_ULTIMOS}, {SQL_SUPLEMENTOS},
+        base AS (
+            SELECT coalesce(s.suplemento, 'Sin suplemento') AS cohorte, u.valor
+            FROM ultimos u LEFT JOIN suplementos s USING (paciente_id)
+        )
+        SELECT cohorte, count(*) AS n, avg(valor) AS media, stddev_samp(valor) AS desviacion,
+               quantile_cont(valor, 0.5) AS mediana,
+               quantile_cont(valor, 0.25) AS p25, quantile_cont(valor, 0.75) AS p75
+        FROM base
+        {filtro}
+        GROUP BY cohorte
+        ORDER BY n DESC
+    """, parametros)
+    return {"codigo": codigo, "cohortes": grupos, "frescura": motor.frescura()}
+
+def tendencia(codigo, intervalo="mes", suplemento=None):
+    """Promedio, mediana y mediciones por intervalo de tiempo"""
+    parametros = [codigo]
+    filtro = ""
+    if suplemento:
+        filtro = "AND paciente_id IN (SELECT paciente_id FROM suplementos WHERE suplemento = ?)"
+        parametros.append(suplemento)
+    serie = motor.consultar(f"""
+        WITH {SQL_SUPLEMENTOS}
+        SELECT CAST(date_trunc('{INTERVALOS_TIEMPO[intervalo]}', fecha_efectiva) AS DATE) AS periodo,
+               count(*) AS n, count(DISTINCT paciente_id) AS pacientes,
+               avg(valor) AS media, quantile_cont(valor, 0.5) AS mediana
+        FROM observaciones
+        WHERE codigo = ? {filtro}
+        GROUP BY 1
+        ORDER BY 1
+    """, parametros)
+    for fila in serie:
+        fila["periodo"] = fila["periodo"].isoformat()
+    return {"codigo": codigo, "intervalo": intervalo, "serie": serie, "frescura": motor.frescura()}
+
+if __name__ == "__main__":
+    import sys
+
+    codigo = sys.argv[1] if len(sys.argv) > 1 else "2093-3"
+    inicio = datetime.now()
+    print(json.dumps(distribucion(codigo), indent=2, default=str, ensure_ascii=False))
+    print(f"Consulta en {(datetime.now() - inicio).total_seconds() * 1000:.0f} ms")
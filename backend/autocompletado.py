@@ -0,0 +1,137 @@
+"""
+Autocompletado de pacientes con un índice de prefijos en memoria.
+
+El índice es un arreglo ordenado de (clave normalizada, id) donde las claves son
+nombre, apellido, "nombre apellido", "apellido nombre" y el RUT sin puntos ni guion.
+Una búsqueda por prefijo es un bisect más un recorrido de k elementos, sin tocar
+la base de datos. Se construye al iniciar y se actualiza con los commits que
+crean, modifican o eliminan pacientes en este proceso.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+import models
+from texto import normalizar
+
+def normalizar_rut(rut):
+    return re.sub(r"[^0-9k]", "", (rut or "").lower())
+
+def claves_paciente(nombre, apellido, rut):
+    nombre, apellido = normalizar(nombre).strip(), normalizar(apellido).strip()
+    claves = {nombre, apellido, f"{nombre} {apellido}", f"{apellido} {nombre}", normalizar_rut(rut)}
+    claves.update(nombre.split() + apellido.split())
+    return {c for c in claves if c.strip()}
+
+class IndicePrefijos:
+    """Arreglo ordenado de claves con los datos de cada paciente para responder sin consultas"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entradas = []      # [(clave, id)] ordenado
+        self.pacientes = {}     # id -> {"id", "rut", "nombre", "apellido"}
+
+    def construir(self, db):
+        filas = db.query(
+            models.Paciente.id, models.Paciente.rut, models.Paciente.nombre, models.Paciente.apellido
+        ).all()
+        entradas, pacientes = [], {}
+        for pid, rut, nombre, apellido in filas:
+            pid = str(pid)
+            pacientes[pid] = {"id": pid, "rut": rut, "nombre": nombre, "apellido": apellido}
+            entradas.extend((clave, pid) for clave in claves_paciente(nombre, apellido, rut))
+        entradas.sort()
+        with self.lock:
+            self.entradas, self.pacientes = entradas, pacientes
+
+    def _quitar(self, pid):
+        datos = self.pacientes.pop(pid, None)
+        if not datos:
+            return
+        for clave in claves_paciente(datos["nombre"], datos["apellido"], datos["rut"]):
+            i = bisect_left(self.entradas, (clave, pid))
+            if i < len(self.entradas) and self.entradas[i] == (clave, pid):
+                del self.entradas[i]
+
+    def actualizar(self, pid, rut, nombre, apellido):
+        with self.lock:
+            self._quitar(pid)
+            self.pacientes[pid] = {"id": pid, "rut": rut, "nombre": nombre, "apellido": apellido}
+            for clave in claves_paciente(nombre, apellido, rut):
+                insort(self.entradas, (clave, pid))
+
+    def eliminar(self, pid):
+        with self.lock:
+            self._quitar(pid)
+
+    def buscar(self, prefijo, k=10):
+        """Hasta k pacientes distintos cuya alguna clave comienza con el prefijo"""
+        prefijo = normalizar(prefijo).strip()
+        prefijo_rut = normalizar_rut(prefijo)
+        # Un prefijo numérico se compara también sin puntos ni guion
+        prefijos = {prefijo, prefijo_rut} if prefijo_rut and prefijo_rut[0].isdigit() else {prefijo}
+        if not any(prefijos):
+            return []
+
+        entradas, pacientes = self.entradas, self.pacientes
+        encontrados = []
+        for p in prefijos:
+            i = bisect_left(entradas, (p, ""))
+            while i < len(entradas) and entradas[i][0].startswith(p) and len(encontrados) < k:
+                pid = entradas[i][1]
+                if pid not in encontrados:
+                    encontrados.append(pid)
+                i += 1
+        return [pacientes[pid] for pid in encontrados[:k] if pid in pacientes]
+
+indice = IndicePrefijos()
+
+def construir_indice(session_factory):
+    db = session_factory()
+    try:
+        indice.construir(db)
+    finally:
+        db.close()
+    print(f"Índice de autocompletado construido con {len(indice.pacientes)} pacientes")
+
+def iniciar_reconstruccion_periodica(session_factory, intervalo_segundos):
+    """Reconstruye el índice periódicamente para incorporar cambios hechos por otros workers"""
+    def ciclo():
+        while True:
+            time.sleep(intervalo_segundos)
+            try:
+                construir_indice(session_factory)
+            except Exception as e:
+                print(f"Error al reconstruir índice de autocompletado: {e}")
+
+    hilo = threading.Thread(target=ciclo, name="indice-autocompletado", daemon=True)
+    hilo.start()
+    return hilo
+
+# Los cambios se acumulan en cada flush y se aplican solo si la transacción hace commit
+
+@event.listens_for(Session, "after_flush")
+def registrar_cambios_pacientes(session, flush_context):
+    cambios = session.info.setdefault("autocompletado", {})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, models.Paciente):
+            cambios[str(obj.id)] = (obj.rut, obj.nombre, obj.apellido)
+    for obj in session.deleted:
+        if isinstance(obj, models.Paciente):
+            cambios[str(obj.id)] = None
+
+@event.listens_for(Session, "after_commit")
+def aplicar_cambios_pacientes(session):
+    for pid, datos in session.info.pop("autocompletado", {}).items():
+        if datos is None:
+            indice.eliminar(pid)
+        else:
+            indice.actualizar(pid, *datos)
+
+@event.listens_for(Session, "after_rollback")
+def descartar_cambios_pacientes(session):
+    session.info.pop("autocompletado", None)
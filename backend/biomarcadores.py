@@ -0,0 +1,27 @@
+"""
+Catálogo de biomarcadores: única fuente para la API, la migración del historial y los rangos.
+
+Se lee de la sección "biomarcadores" de rangos_referencia.json (columna del historial ->
+código LOINC, nombre y unidad). Agregar un biomarcador es agregar una entrada allí (y sus
+rangos); la tabla de observaciones acepta cualquier código sin cambios de esquema.
+El catálogo se carga una vez al importar: a diferencia de los rangos, cambiarlo requiere
+reiniciar el backend.
+"""
+import json
+import os
+
+RUTA_CATALOGO = os.getenv(
+    "RANGOS_REFERENCIA_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rangos_referencia.json")
+)
+
+def cargar(ruta=RUTA_CATALOGO):
+    """Código LOINC -> {"campo", "nombre", "unidad"}"""
+    with open(ruta, encoding="utf-8") as f:
+        datos = json.load(f)
+    return {
+        info["codigo"]: {"campo": campo, "nombre": info["nombre"], "unidad": info["unidad"]}
+        for campo, info in datos["biomarcadores"].items()
+    }
+
+BIOMARCADORES = cargar()
+CODIGO_POR_BIOMARCADOR = {info["campo"]: codigo for codigo, info in BIOMARCADORES.items()}
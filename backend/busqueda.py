@@ -0,0 +1,208 @@
+"""
+Búsqueda de pacientes (nombre/RUT aproximado) y de notas clínicas (texto completo).
+
+En PostgreSQL usa índices GIN sobre to_tsvector('spanish', ...) para las notas y
+pg_trgm para nombres y RUT. En otros motores (SQLite de desarrollo) usa un índice
+invertido en memoria con la misma forma de respuesta.
+
+Los fragmentos se devuelven como HTML: el texto de las notas va escapado y solo las
+coincidencias quedan entre <mark> y </mark>.
+"""
+import re
+import threading
+import time
+from html import escape
+
+from sqlalchemy import text
+
+import models
+from texto import escapar_like, normalizar
+
+LIMITE_MAXIMO = 50
+MARCA_INICIO, MARCA_FIN = "<mark>", "</mark>"
+
+# Las expresiones deben coincidir exactamente con las de los índices para que se usen
+EXPR_NOMBRE = "(coalesce(nombre, '') || ' ' || coalesce(apellido, ''))"
+EXPR_NOTAS_HISTORIAL = (
+    "(coalesce(observaciones, '') || ' ' || coalesce(antecedentes_familiares, '') || ' ' "
+    "|| coalesce(tratamientos_actuales, ''))"
+)
+EXPR_NOTAS_PACIENTE = "coalesce(alergias, '')"
+
+SQL_INDICES = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    f"CREATE INDEX IF NOT EXISTS ix_pacientes_nombre_trgm ON pacientes USING gin ({EXPR_NOMBRE} gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_pacientes_rut_trgm ON pacientes USING gin (rut gin_trgm_ops)",
+    f"CREATE INDEX IF NOT EXISTS ix_pacientes_notas_fts ON pacientes USING gin (to_tsvector('spanish', {EXPR_NOTAS_PACIENTE}))",
+    f"CREATE INDEX IF NOT EXISTS ix_historial_notas_fts ON historial_medico USING gin (to_tsvector('spanish', {EXPR_NOTAS_HISTORIAL}))",
+]
+
+# ts_headline no escapa el texto: marca con caracteres de control (quitados antes de la nota)
+# y el fragmento se escapa en Python
+SEL_INICIO, SEL_FIN = "\x02", "\x03"
+OPCIONES_FRAGMENTO = f"MaxFragments=2, MaxWords=15, MinWords=5, StartSel={SEL_INICIO}, StopSel={SEL_FIN}"
+
+SQL_PACIENTES = text(f"""
+    SELECT id, rut, nombre, apellido,
+           greatest(word_similarity(:q, {EXPR_NOMBRE}), similarity(rut, :q)) AS puntaje
+    FROM pacientes
+    WHERE :q <% {EXPR_NOMBRE} OR rut % :q OR rut LIKE :prefijo ESCAPE '\\'
+    ORDER BY puntaje DESC
+    LIMIT :limite
+""")
+
+# El fragmento resaltado se calcula solo sobre las filas ya limitadas
+SQL_NOTAS = text(f"""
+    WITH consulta AS (SELECT websearch_to_tsquery('spanish', :q) AS q),
+    coincidencias AS (
+        SELECT 'historial' AS fuente, h.id::text AS id, h.paciente_id, {EXPR_NOTAS_HISTORIAL} AS texto,
+               ts_rank(to_tsvector('spanish', {EXPR_NOTAS_HISTORIAL}), consulta.q) AS puntaje
+        FROM historial_medico h, consulta
+        WHERE to_tsvector('spanish', {EXPR_NOTAS_HISTORIAL}) @@ consulta.q
+        UNION ALL
+        SELECT 'paciente', p.id::text, p.id, {EXPR_NOTAS_PACIENTE},
+               ts_rank(to_tsvector('spanish', {EXPR_NOTAS_PACIENTE}), consulta.q)
+        FROM pacientes p, consulta
+        WHERE to_tsvector('spanish', {EXPR_NOTAS_PACIENTE}) @@ consulta.q
+        ORDER BY puntaje DESC
+        LIMIT :limite
+    )
+    SELECT fuente, id, paciente_id, puntaje,
+           ts_headline('spanish', translate(texto, chr(2) || chr(3), ''), consulta.q, '{OPCIONES_FRAGMENTO}') AS fragmento
+    FROM coincidencias, consulta
+    ORDER BY puntaje DESC
+""")
+
+def sql_indices(tabla):
+    """Índices de búsqueda definidos sobre una tabla (para recrearlos al particionarla)"""
+    return [sql for sql in SQL_INDICES if f" ON {tabla} " in sql]
+
+def crear_indices(engine):
+    """Crea la extensión pg_trgm y los índices GIN de búsqueda (solo PostgreSQL)"""
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        for sql in SQL_INDICES:
+            conn.execute(text(sql))
+
+def buscar(db, q, limite=20):
+    """Busca pacientes por nombre/RUT y notas clínicas por contenido"""
+    limite = max(1, min(limite, LIMITE_MAXIMO))
+    # Con la cláusula, una sesión enrutada resuelve el engine de lectura sin marcarse como escritura
+    if db.get_bind(clause=SQL_PACIENTES).dialect.name != "postgresql":
+        return indice_memoria.buscar(db, q, limite)
+    pacientes = db.execute(SQL_PACIENTES, {"q": q, "prefijo": f"{escapar_like(q)}%", "limite": limite}).mappings().all()
+    notas = db.execute(SQL_NOTAS, {"q": q, "limite": limite}).mappings().all()
+    return {
+        "pacientes": [{**fila, "id": str(fila["id"])} for fila in pacientes],
+        "notas": [
+            {**fila, "paciente_id": str(fila["paciente_id"]), "fragmento": marcar(fila["fragmento"])}
+            for fila in notas
+        ],
+    }
+
+def marcar(fragmento):
+    """Escapa el fragmento de ts_headline y convierte sus marcas de control en <mark>"""
+    return escape(fragmento or "").replace(SEL_INICIO, MARCA_INICIO).replace(SEL_FIN, MARCA_FIN)
+
+# Índice en memoria para motores sin tsvector/pg_trgm
+
+def tokens(texto):
+    return re.findall(r"\w{2,}", normalizar(texto))
+
+def trigramas(texto):
+    texto = f"  {normalizar(texto)} "
+    return {texto[i:i + 3] for i in range(len(texto) - 2)}
+
+def resaltar(texto, terminos, ancho=60):
+    """Fragmento alrededor del primer término encontrado, con el término marcado (texto escapado)"""
+    normalizado = normalizar(texto)
+    for termino in terminos:
+        pos = normalizado.find(termino)
+        if pos >= 0:
+            inicio = max(0, pos - ancho)
+            fin = min(len(texto), pos + len(termino) + ancho)
+            return (
+                escape(texto[inicio:pos]) + MARCA_INICIO + escape(texto[pos:pos + len(termino)]) + MARCA_FIN
+                + escape(texto[pos + len(termino):fin])
+            )
+    return escape(texto[:2 * ancho])
+
+class IndiceBusquedaMemoria:
+    """Índice invertido de términos y trigramas, reconstruido cuando supera TTL segundos"""
+
+    TTL = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.construido = 0.0
+        self.pacientes = {}     # id -> (rut, nombre, apellido)
+        self.trigramas = {}     # trigrama -> set(id paciente)
+        self.documentos = {}    # (fuente, id) -> (paciente_id, texto)
+        self.terminos = {}      # término -> set((fuente, id))
+
+    def construir(self, db):
+        pacientes, trigramas, documentos, terminos = {}, {}, {}, {}
+        for p in db.query(models.Paciente).all():
+            pacientes[p.id] = (p.rut, p.nombre, p.apellido)
+            for t in trigramas_paciente(p.nombre, p.apellido, p.rut):
+                trigramas.setdefault(t, set()).add(p.id)
+            documentos[("paciente", p.id)] = (p.id, p.alergias or "")
+        for h in db.query(models.HistorialMedico).all():
+            texto = " ".join(filter(None, [h.observaciones, h.antecedentes_familiares, h.tratamientos_actuales]))
+            documentos[("historial", h.id)] = (h.paciente_id, texto)
+        for clave, (_, texto) in documentos.items():
+            for termino in set(tokens(texto)):
+                terminos.setdefault(termino, set()).add(clave)
+        self.pacientes, self.trigramas = pacientes, trigramas
+        self.documentos, self.terminos = documentos, terminos
+        self.construido = time.monotonic()
+
+    def buscar(self, db, q, limite):
+        with self.lock:
+            if time.monotonic() - self.construido > self.TTL:
+                self.construir(db)
+
+        # Pacientes: similitud de Jaccard entre trigramas de la consulta y del nombre/RUT
+        consulta = trigramas(q)
+        candidatos = {}
+        for t in consulta:
+            for pid in self.trigramas.get(t, ()):
+                candidatos[pid] = candidatos.get(pid, 0) + 1
+        pacientes = []
+        for pid, comunes in candidatos.items():
+            rut, nombre, apellido = self.pacientes[pid]
+            puntaje = comunes / len(consulta | trigramas_paciente(nombre, apellido, rut))
+            if puntaje >= 0.1:
+                pacientes.append({"id": str(pid), "rut": rut, "nombre": nombre, "apellido": apellido, "puntaje": puntaje})
+        pacientes.sort(key=lambda p: p["puntaje"], reverse=True)
+
+        # Notas: todos los términos deben aparecer (por prefijo); puntaje por frecuencia
+        terminos = tokens(q)
+        coincidencias = None
+        for termino in terminos:
+            claves = set()
+            for indexado, docs in self.terminos.items():
+                if indexado.startswith(termino):
+                    claves |= docs
+            coincidencias = claves if coincidencias is None else coincidencias & claves
+        notas = []
+        for fuente, doc_id in coincidencias or ():
+            paciente_id, texto = self.documentos[(fuente, doc_id)]
+            normalizado = normalizar(texto)
+            puntaje = sum(normalizado.count(t) for t in terminos) / (1 + len(normalizado.split()))
+            notas.append({
+                "fuente": fuente,
+                "id": str(doc_id),
+                "paciente_id": str(paciente_id),
+                "puntaje": puntaje,
+                "fragmento": resaltar(texto, terminos),
+            })
+        notas.sort(key=lambda n: n["puntaje"], reverse=True)
+
+        return {"pacientes": pacientes[:limite], "notas": notas[:limite]}
+
+def trigramas_paciente(nombre, apellido, rut):
+    return trigramas(f"{nombre or ''} {apellido or ''}") | trigramas(rut or "")
+
+indice_memoria = IndiceBusquedaMemoria()
@@ -0,0 +1,146 @@
+"""
+Coalescencia de solicitudes idénticas concurrentes (single-flight) para /ai/*.
+
+Al abrir la ficha de un paciente los componentes del dashboard, o varios médicos a la
+vez, suelen enviar la misma solicitud de IA en paralelo. La clave es el método, la ruta,
+la query y el cuerpo JSON normalizado (claves ordenadas, sin espacios): la primera
+solicitud ejecuta el endpoint y las que llegan mientras está en curso esperan y reciben
+una copia de la misma respuesta (estado, cabeceras y cuerpo). No es una caché: al
+terminar la ejecución la clave se libera y la siguiente solicitud vuelve a calcular.
+
+Solo se comparten respuestas 2xx. Si el líder obtiene otro estado o falla, las solicitudes
+que esperaban se ejecutan por su cuenta; si el líder se cancela (el cliente se desconectó),
+la primera en espera toma su lugar. El middleware va fuera del control de admisión: solo
+el líder ocupa un cupo (y un token de su cliente), así una ráfaga de duplicados no llena
+los cupos de 'ia' esperando un único cálculo. Si la admisión rechaza al líder (429/503),
+las que esperaban pasan por la admisión cada una por su cuenta.
+
+Las variantes /stream no se coalescen: esperar la respuesta completa anularía el
+streaming.
+"""
+import asyncio
+import json
+
+PREFIJO = "/ai/"
+
+def clave_solicitud(scope, cuerpo):
+    """Clave estable ante el orden de las claves y el formato del JSON"""
+    try:
+        normalizado = json.dumps(json.loads(cuerpo), sort_keys=True, separators=(",", ":"))
+    except ValueError:
+        normalizado = cuerpo.decode("utf-8", errors="replace")
+    return (scope["method"], scope["path"], scope.get("query_string", b"").decode("latin-1"), normalizado)
+
+def coalescible(scope):
+    return (
+        scope["type"] == "http"
+        and scope["method"] == "POST"
+        and scope["path"].startswith(PREFIJO)
+        and not scope["path"].endswith("/stream")
+    )
+
+async def leer_cuerpo(receive):
+    partes = []
+    while True:
+        mensaje = await receive()
+        if mensaje["type"] == "http.disconnect":
+            return None
+        partes.append(mensaje.get("body", b""))
+        if not mensaje.get("more_body"):
+            return b"".join(partes)
+
+class Coalescedor:
+    """Cálculos en curso por clave y contadores (uno por worker)"""
+
+    def __init__(self):
+        self.en_curso = {}
+        self.solicitudes = 0
+        self.ejecuciones = 0
+        self.compartidas = 0
+
+    def estado(self):
+        return {
+            "en_curso": len(self.en_curso),
+            "solicitudes": self.solicitudes,
+            "ejecuciones": self.ejecuciones,
+            "compartidas": self.compartidas,
+            "tasa_coalescencia": round(self.compartidas / self.solicitudes, 3) if self.solicitudes else None,
+        }
+
+coalescedor = Coalescedor()
+
+# Resultado del líder cancelado: una solicitud en espera pasa a ser la nueva líder
+PROMOVER = object()
+
+def respuesta_exitosa(mensajes):
+    inicio = next((m for m in mensajes if m["type"] == "http.response.start"), None)
+    return inicio is not None and 200 <= inicio["status"] < 300
+
+class MiddlewareCoalescencia:
+    """Middleware ASGI: un cálculo en curso por clave; los duplicados repiten sus mensajes"""
+
+    def __init__(self, app, coalescedor=coalescedor):
+        self.app = app
+        self.coalescedor = coalescedor
+
+    async def __call__(self, scope, receive, send):
+        if not coalescible(scope):
+            return await self.app(scope, receive, send)
+        cuerpo = await leer_cuerpo(receive)
+        if cuerpo is None:
+            return
+        c = self.coalescedor
+        clave = clave_solicitud(scope, cuerpo)
+        c.solicitudes += 1
+
+        while True:
+            futuro = c.en_curso.get(clave)
+            if futuro is None:
+                break
+            resultado = await asyncio.shield(futuro)
+            if resultado is PROMOVER:
+                # La primera en despertar se registra como líder; el resto la espera
+                continue
+            if resultado is None:
+                # El líder no obtuvo una respuesta 2xx: no se comparte su error
+                c.ejecuciones += 1
+                await self.ejecutar(scope, cuerpo, receive, send)
+                return
+            c.compartidas += 1
+            for mensaje in resultado:
+                await send(mensaje)
+            return
+
+        futuro = asyncio.get_running_loop().create_future()
+        c.en_curso[clave] = futuro
+        c.ejecuciones += 1
+        resultado = None
+        try:
+            mensajes = await self.ejecutar(scope, cuerpo, receive, send)
+            if respuesta_exitosa(mensajes):
+                resultado = mensajes
+        except asyncio.CancelledError:
+            resultado = PROMOVER
+            raise
+        finally:
+            del c.en_curso[clave]
+            futuro.set_result(resultado)
+
+    async def ejecutar(self, scope, cuerpo, receive, send):
+        """Ejecuta la aplicación con el cuerpo ya leído; devuelve los mensajes enviados"""
+        mensajes = []
+        entregado = False
+
+        async def receive_con_cuerpo():
+            nonlocal entregado
+            if not entregado:
+                entregado = True
+                return {"type": "http.request", "body": cuerpo, "more_body": False}
+            return await receive()
+
+        async def send_y_guardar(mensaje):
+            mensajes.append(mensaje)
+            await send(mensaje)
+
+        await self.app(scope, receive_con_cuerpo, send_y_guardar)
+        return mensajes
@@ -0,0 +1,279 @@
+"""
+Estadísticas poblacionales de biomarcadores servidas desde vistas materializadas.
+
+Las vistas agregan el último valor de cada biomarcador por paciente con GROUPING SETS
+sobre suplemento, isapre, sexo y grupo etario (cada dimensión sola y de a pares).
+Una dimensión no agrupada se marca con '*', de modo que cada consulta del dashboard
+lee solo las filas de sus grupos. Se refrescan periódicamente y cada refresco
+incrementa un contador de versión que invalida la caché de resultados.
+
+Uso:
+    python cohortes.py refrescar
+"""
+import threading
+import time
+from itertools import combinations
+
+from sqlalchemy import text
+
+from database import engine
+
+DIMENSIONES = ["suplemento", "isapre", "sexo", "grupo_edad"]
+NUM_INTERVALOS_HISTOGRAMA = 10
+# Identificador del advisory lock que evita refrescos simultáneos entre workers
+LOCK_REFRESCO = 740301
+# Se guarda como comentario de las vistas; si cambia la definición se recrean al iniciar
+VERSION_VISTAS = "3"
+
+# fecha_nacimiento es texto libre: una fecha mal escrita queda como NULL ("Sin dato") en vez
+# de abortar la creación o el refresco de las vistas
+SQL_FUNCION_FECHA = """
+CREATE OR REPLACE FUNCTION fecha_o_nulo(texto text) RETURNS date AS $$
+BEGIN
+    RETURN texto::date;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE
+"""
+
+# Último valor de cada biomarcador por paciente con sus dimensiones de cohorte
+SQL_BASE = """
+    WITH ultimos AS (
+        SELECT DISTINCT ON (paciente_id, codigo) paciente_id, codigo, valor
+        FROM observaciones
+        ORDER BY paciente_id, codigo, fecha_efectiva DESC
+    ),
+    suplementos AS (
+        SELECT DISTINCT ON (paciente_id) paciente_id, suplemento
+        FROM historial_medico
+        WHERE suplemento IS NOT NULL AND suplemento <> ''
+        -- fecha_inicio es texto: se ordena como fecha y las ilegibles quedan al final
+        ORDER BY paciente_id, fecha_o_nulo(fecha_inicio) DESC NULLS LAST, id DESC
+    ),
+    base AS (
+        SELECT
+            u.codigo,
+            u.valor,
+            COALESCE(s.suplemento, 'Sin suplemento') AS suplemento,
+            COALESCE(NULLIF(p.isapre, ''), 'Sin isapre') AS isapre,
+            CASE
+                WHEN lower(p.sexo) IN ('masculino', 'male') THEN 'masculino'
+                WHEN lower(p.sexo) IN ('femenino', 'female') THEN 'femenino'
+                ELSE 'otro'
+            END AS sexo,
+            CASE
+                WHEN f.nacimiento IS NULL THEN 'Sin dato'
+                WHEN age(f.nacimiento) < interval '30 years' THEN '<30'
+                WHEN age(f.nacimiento) < interval '45 years' THEN '30-44'
+                WHEN age(f.nacimiento) < interval '60 years' THEN '45-59'
+                ELSE '60+'
+            END AS grupo_edad
+        FROM ultimos u
+        JOIN pacientes p ON p.id = u.paciente_id
+        CROSS JOIN LATERAL (SELECT fecha_o_nulo(p.fecha_nacimiento) AS nacimiento) f
+        LEFT JOIN suplementos s ON s.paciente_id = u.paciente_id
+    )
+"""
+
+def conjuntos_agrupacion(extra=()):
+    """GROUPING SETS: total, cada dimensión y cada par de dimensiones"""
+    conjuntos = []
+    for r in range(3):
+        for dims in combinations(DIMENSIONES, r):
+            conjuntos.append("(" + ", ".join(["codigo", *extra, *dims]) + ")")
+    return ",\n            ".join(conjuntos)
+
+def columnas_dimension():
+    return ",\n        ".join(
+        f"CASE WHEN GROUPING({d}) = 1 THEN '*' ELSE {d} END AS {d}" for d in DIMENSIONES
+    )
+
+SQL_VISTA_ESTADISTICAS = f"""
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_cohortes_estadisticas AS
+{SQL_BASE}
+    SELECT
+        codigo,
+        {columnas_dimension()},
+        count(*) AS n,
+        avg(valor) AS media,
+        stddev_samp(valor) AS desviacion,
+        min(valor) AS minimo,
+        max(valor) AS maximo,
+        percentile_cont(0.25) WITHIN GROUP (ORDER BY valor) AS p25,
+        percentile_cont(0.50) WITHIN GROUP (ORDER BY valor) AS p50,
+        percentile_cont(0.75) WITHIN GROUP (ORDER BY valor) AS p75,
+        percentile_cont(0.90) WITHIN GROUP (ORDER BY valor) AS p90
+    FROM base
+    GROUP BY GROUPING SETS (
+            {conjuntos_agrupacion()}
+    )
+"""
+
+SQL_VISTA_HISTOGRAMA = f"""
+CREATE MATERIALIZED VIEW IF NOT EXISTS mv_cohortes_histograma AS
+{SQL_BASE},
+    limites AS (
+        SELECT codigo, min(valor) AS desde, max(valor) AS hasta FROM base GROUP BY codigo
+    ),
+    intervalos AS (
+        SELECT
+            base.*,
+            -- +1e-9 incluye el máximo en el último intervalo
+            width_bucket(valor, l.desde, l.hasta + 1e-9, {NUM_INTERVALOS_HISTOGRAMA}) AS intervalo,
+            l.desde AS minimo_codigo,
+            (l.hasta + 1e-9 - l.desde) / {NUM_INTERVALOS_HISTOGRAMA} AS ancho
+        FROM base JOIN limites l USING (codigo)
+    )
+    SELECT
+        codigo,
+        {columnas_dimension()},
+        intervalo,
+        min(minimo_codigo + (intervalo - 1) * ancho) AS desde,
+        min(minimo_codigo + intervalo * ancho) AS hasta,
+        count(*) AS n
+    FROM intervalos
+    GROUP BY GROUPING SETS (
+            {conjuntos_agrupacion(extra=("intervalo",))}
+    )
+"""
+
+SQL_INDICES = [
+    # REFRESH ... CONCURRENTLY requiere un índice único sobre la vista
+    f"CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_cohortes_estadisticas "
+    f"ON mv_cohortes_estadisticas (codigo, {', '.join(DIMENSIONES)})",
+    f"CREATE UNIQUE INDEX IF NOT EXISTS ux_mv_cohortes_histograma "
+    f"ON mv_cohortes_histograma (codigo, {', '.join(DIMENSIONES)}, intervalo)",
+]
+
+VISTAS = ["mv_cohortes_estadisticas", "mv_cohortes_histograma"]
+
+def crear_funcion_fecha():
+    """fecha_o_nulo() también la usa el tamizaje (rangos.py) aunque fallen las vistas"""
+    with engine.begin() as conn:
+        conn.execute(text(SQL_FUNCION_FECHA))
+
+def crear_vistas():
+    """Crea las vistas materializadas y la tabla de versión si no existen"""
+    with engine.begin() as conn:
+        crear_vistas_en(conn)
+
+def crear_vistas_en(conn, recrear=False):
+    """
+    Crea las vistas en la transacción de conn. Con recrear=True las elimina antes aunque su
+    versión coincida: las vistas quedan ligadas a la tabla (no a su nombre), así que tras
+    reemplazar observaciones o historial_medico (particiones.py) hay que volver a crearlas.
+    """
+    conn.execute(text(SQL_FUNCION_FECHA))
+    existe, version = conn.execute(text(
+        "SELECT to_regclass('mv_cohortes_estadisticas') IS NOT NULL, "
+        "obj_description(to_regclass('mv_cohortes_estadisticas'), 'pg_class')"
+    )).first()
+    if existe and (recrear or version != VERSION_VISTAS):
+        print(f"Recreando vistas de cohortes (versión {version} -> {VERSION_VISTAS})")
+        for vista in VISTAS:
+            conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {vista}"))
+    conn.execute(text(SQL_VISTA_ESTADISTICAS))
+    conn.execute(text(SQL_VISTA_HISTOGRAMA))
+    for sql in SQL_INDICES:
+        conn.execute(text(sql))
+    for vista in VISTAS:
+        conn.execute(text(f"COMMENT ON MATERIALIZED VIEW {vista} IS '{VERSION_VISTAS}'"))
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS cohortes_version ("
+        "id INTEGER PRIMARY KEY, version INTEGER NOT NULL, actualizado TIMESTAMP NOT NULL)"
+    ))
+    conn.execute(text(
+        "INSERT INTO cohortes_version (id, version, actualizado) VALUES (1, 1, now()) "
+        "ON CONFLICT (id) DO NOTHING"
+    ))
+
+def refrescar_vistas():
+    """Refresca las vistas sin bloquear lecturas e incrementa la versión; False si otro worker ya lo hace"""
+    with engine.begin() as conn:
+        if not conn.execute(text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": LOCK_REFRESCO}).scalar():
+            return False
+        conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_cohortes_estadisticas"))
+        conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_cohortes_histograma"))
+        conn.execute(text(
+            "UPDATE cohortes_version SET version = version + 1, actualizado = now() WHERE id = 1"
+        ))
+    return True
+
+def iniciar_refresco_periodico(intervalo_segundos):
+    """Lanza un hilo que refresca las vistas cada intervalo_segundos"""
+    def ciclo():
+        while True:
+            time.sleep(intervalo_segundos)
+            try:
+                if refrescar_vistas():
+                    print("Vistas de cohortes refrescadas")
+            except Exception as e:
+                print(f"Error al refrescar vistas de cohortes: {e}")
+
+    hilo = threading.Thread(target=ciclo, name="refresco-cohortes", daemon=True)
+    hilo.start()
+    return hilo
+
+# Caché de resultados por versión: al cambiar la versión se descarta completa
+_cache = {"version": None, "resultados": {}}
+_cache_lock = threading.Lock()
+
+def version_actual(db):
+    return db.execute(text("SELECT version, actualizado FROM cohortes_version WHERE id = 1")).first()
+
+def filtro_dimensiones(agrupar):
+    """Condiciones para leer solo las filas del conjunto de agrupación pedido"""
+    return " AND ".join(
+        f"{d} <> '*'" if d in agrupar else f"{d} = '*'" for d in DIMENSIONES
+    )
+
+def consultar(db, tipo, codigo, agrupar):
+    """Devuelve estadísticas ('estadisticas') o histograma ('histograma') de un biomarcador por grupos"""
+    agrupar = tuple(sorted(agrupar, key=DIMENSIONES.index))
+    version, actualizado = version_actual(db)
+    clave = (tipo, codigo, agrupar)
+
+    with _cache_lock:
+        if _cache["version"] != version:
+            _cache["version"] = version
+            _cache["resultados"] = {}
+        elif clave in _cache["resultados"]:
+            return _cache["resultados"][clave]
+
+    if tipo == "estadisticas":
+        sql = (
+            f"SELECT {', '.join(agrupar) + ', ' if agrupar else ''}"
+            "n, media, desviacion, minimo, maximo, p25, p50, p75, p90 "
+            f"FROM mv_cohortes_estadisticas WHERE codigo = :codigo AND {filtro_dimensiones(agrupar)} "
+            f"ORDER BY {', '.join(agrupar) if agrupar else 'n'}"
+        )
+    else:
+        sql = (
+            f"SELECT {', '.join(agrupar) + ', ' if agrupar else ''}intervalo, desde, hasta, n "
+            f"FROM mv_cohortes_histograma WHERE codigo = :codigo AND {filtro_dimensiones(agrupar)} "
+            f"ORDER BY {', '.join(agrupar) + ', ' if agrupar else ''}intervalo"
+        )
+
+    filas = db.execute(text(sql), {"codigo": codigo}).mappings().all()
+    resultado = {
+        "codigo": codigo,
+        "agrupado_por": list(agrupar),
+        "version": version,
+        "actualizado": actualizado.isoformat(),
+        "grupos": [dict(fila) for fila in filas],
+    }
+
+    with _cache_lock:
+        if _cache["version"] == version:
+            _cache["resultados"][clave] = resultado
+    return resultado
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "refrescar":
+        crear_vistas()
+        print("✅ Vistas refrescadas" if refrescar_vistas() else "Otro proceso está refrescando las vistas")
+    else:
+        print(__doc__)
@@ -1,7 +1,9 @@
 import time
+from sqlalchemy import text
 from sqlalchemy.exc import OperationalError
 from database import engine
 import models
+from biomarcadores import BIOMARCADORES
 
 def wait_for_db():
     max_retries = 10
@@ -26,8 +28,50 @@ def create_tables():
     models.Base.metadata.create_all(bind=engine)
     print("✅ Tablas creadas correctamente")
 
+# Fechas heredadas en texto libre: las que no se pueden convertir quedan en NULL en vez
+# de abortar la migración completa
+SQL_FUNCION_TIMESTAMP = """
+CREATE OR REPLACE FUNCTION timestamp_o_nulo(texto text) RETURNS timestamp AS $$
+BEGIN
+    RETURN texto::timestamp;
+EXCEPTION WHEN others THEN
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql STABLE
+"""
+
+def migrar_biomarcadores():
+    """Copia los biomarcadores del historial a la tabla de observaciones si aún está vacía"""
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT 1 FROM observaciones LIMIT 1")).first():
+            print("La tabla de observaciones ya contiene datos, no se migra")
+            return
+        conn.execute(text(SQL_FUNCION_TIMESTAMP))
+        for codigo, info in BIOMARCADORES.items():
+            campo = info["campo"]
+            resultado = conn.execute(text(f"""
+                INSERT INTO observaciones (paciente_id, codigo, valor, unidad, fecha_efectiva)
+                SELECT paciente_id, :codigo, {campo}, :unidad, fecha
+                FROM (
+                    SELECT paciente_id, {campo}, timestamp_o_nulo(fecha_inicio) AS fecha
+                    FROM historial_medico
+                    WHERE {campo} > 0
+                ) h
+                WHERE fecha IS NOT NULL
+            """), {"codigo": codigo, "unidad": info["unidad"]})
+            print(f"✅ {resultado.rowcount} valores de {campo} migrados a observaciones")
+
+            omitidas, ejemplos = conn.execute(text(f"""
+                SELECT count(*), (array_agg(DISTINCT coalesce(fecha_inicio, 'NULL')))[1:5]
+                FROM historial_medico
+                WHERE {campo} > 0 AND timestamp_o_nulo(fecha_inicio) IS NULL
+            """)).first()
+            if omitidas:
+                print(f"⚠️ {omitidas} filas de {campo} omitidas por fecha_inicio inválida (p. ej. {', '.join(ejemplos)})")
+
 if __name__ == "__main__":
     if wait_for_db():
         create_tables()
+        migrar_biomarcadores()
     else:
         exit(1) 
\ No newline at end of file
@@ -1,17 +1,155 @@
-from sqlalchemy import create_engine
+import itertools
+import os
+import re
+import threading
+import time
+
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql.elements import TextClause
+from sqlalchemy.sql.selectable import TextualSelect
+
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://salud_user:salud_password@db:5432/salud_db")
 
-SQLALCHEMY_DATABASE_URL = "postgresql://salud_user:salud_password@db:5432/salud_db"
+# Réplicas de lectura separadas por coma (vacío = todo va al primario)
+REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Retraso máximo aceptado (segundos) antes de descartar una réplica
+REPLICA_MAX_LAG = float(os.getenv("DATABASE_REPLICA_MAX_LAG", "5"))
+# Cada cuánto se vuelve a verificar el estado de una réplica (segundos)
+REPLICA_CHECK_INTERVAL = float(os.getenv("DATABASE_REPLICA_CHECK_INTERVAL", "10"))
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+engine = create_engine(SQLALCHEMY_DATABASE_URL, pool_pre_ping=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+# Si la réplica recibió todo el WAL el retraso es 0 aunque el primario esté inactivo
+CONSULTA_LAG = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+class EstadoReplica:
+    """Estado de salud y retraso de una réplica, verificado como máximo cada REPLICA_CHECK_INTERVAL"""
+
+    def __init__(self, url):
+        self.engine = create_engine(url, pool_pre_ping=True, connect_args={"connect_timeout": 2})
+        self.sana = False
+        self.lag = None
+        self.ultima_verificacion = 0.0
+        self.lock = threading.Lock()
+
+    def verificar(self):
+        """Consulta el retraso de replicación y marca la réplica como sana o no"""
+        try:
+            with self.engine.connect() as conn:
+                self.lag = float(conn.execute(CONSULTA_LAG).scalar())
+            self.sana = self.lag <= REPLICA_MAX_LAG
+        except Exception as e:
+            print(f"Réplica {self.engine.url.host} no disponible: {e}")
+            self.sana = False
+            self.lag = None
+        self.ultima_verificacion = time.monotonic()
+
+    def disponible(self):
+        if time.monotonic() - self.ultima_verificacion > REPLICA_CHECK_INTERVAL:
+            # Solo un hilo verifica; el resto usa el último estado conocido
+            if self.lock.acquire(blocking=False):
+                try:
+                    self.verificar()
+                finally:
+                    self.lock.release()
+        return self.sana
+
+replicas = [EstadoReplica(url) for url in REPLICA_URLS]
+_turno_replicas = itertools.count()
+
+def elegir_engine_lectura():
+    """Elige una réplica sana por turnos; si ninguna lo está, vuelve al primario"""
+    if not replicas:
+        return engine
+    inicio = next(_turno_replicas)
+    for i in range(len(replicas)):
+        replica = replicas[(inicio + i) % len(replicas)]
+        if replica.disponible():
+            return replica.engine
+    return engine
+
+def estado_replicas():
+    """Resumen del estado de las réplicas para el health check"""
+    return [
+        {"host": r.engine.url.host, "sana": r.sana, "lag_segundos": r.lag}
+        for r in replicas
+    ]
+
+# En SQL textual: lo que escribe, bloquea o usa secuencias debe ir al primario
+PATRON_NO_LECTURA = re.compile(r"\b(INSERT|UPDATE|DELETE|MERGE|INTO|NEXTVAL|SETVAL|LOCK|SHARE|NOTIFY)\b", re.IGNORECASE)
+# SELECT del ORM con with_for_update(): FOR UPDATE, FOR NO KEY UPDATE, FOR SHARE, FOR KEY SHARE
+PATRON_BLOQUEO = re.compile(r"\bFOR\s+(NO\s+KEY\s+UPDATE|UPDATE|KEY\s+SHARE|SHARE)\b", re.IGNORECASE)
+
+def es_lectura(clause):
+    """
+    Si la sentencia puede ir a una réplica: la opción de ejecución solo_lectura manda;
+    sin ella, los SELECT del ORM y los text() que empiezan con SELECT o WITH y no escriben
+    """
+    opciones = getattr(clause, "get_execution_options", None)
+    if opciones is None:
+        return False
+    marcada = opciones().get("solo_lectura")
+    if marcada is not None:
+        return marcada
+    if isinstance(clause, TextualSelect):
+        clause = clause.element
+    if isinstance(clause, TextClause):
+        palabras = clause.text.split(None, 1)
+        return bool(palabras) and palabras[0].upper() in ("SELECT", "WITH") and not PATRON_NO_LECTURA.search(clause.text)
+    if clause.is_select:
+        # SELECT ... FOR UPDATE/SHARE necesita el primario; el bloqueo solo se ve en el SQL compilado
+        return not PATRON_BLOQUEO.search(str(clause.compile(dialect=engine.dialect)))
+    return False
+
+class SesionEnrutada(Session):
+    """
+    Sesión de los endpoints de lectura: envía a una réplica todas sus lecturas, tanto del
+    ORM como de SQL textual (ver es_lectura), y al primario todo lo demás.
+    Una vez que la sesión envía al primario algo que no es lectura (un flush, un text() que
+    escribe, un SELECT ... FOR UPDATE), sigue leyendo del primario (read-your-writes).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.engine_lectura = None
+        self.escribio = False
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        # Sin réplicas todo va al primario y no hace falta clasificar la sentencia
+        if not replicas or self.escribio:
+            return engine
+        if self._flushing or not es_lectura(clause):
+            self.escribio = True
+            return engine
+        # La réplica se fija por sesión para que las lecturas de un request sean consistentes
+        if self.engine_lectura is None:
+            self.engine_lectura = elegir_engine_lectura()
+        return self.engine_lectura
+
+SessionLectura = sessionmaker(class_=SesionEnrutada, autocommit=False, autoflush=False)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close() 
\ No newline at end of file
+        db.close()
+
+def get_db_lectura():
+    """Sesión para endpoints de solo lectura: usa réplicas cuando están configuradas y al día"""
+    db = SessionLectura()
+    try:
+        yield db
+    finally:
+        db.close()
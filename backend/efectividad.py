@@ -0,0 +1,216 @@
+"""
+Motor de efectividad de suplementos: análisis antes/después sobre toda la población.
+
+Cada episodio de suplementación (historial_medico y medicaciones) se alinea con la
+serie de cada biomarcador mediante merge_asof: el valor basal es la última medición
+antes del inicio y el de seguimiento la más cercana a DIAS_SEGUIMIENTO después.
+Los deltas se agregan por suplemento y biomarcador (media, IC 95%, d de Cohen) y por
+nivel de dosis (curva dosis-respuesta), y se persisten para lectura rápida.
+
+Uso:
+    python efectividad.py              # lee de PostgreSQL
+    python efectividad.py --snapshot   # lee de los snapshots Parquet (snapshots.py)
+"""
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+import models
+import snapshots
+from database import SessionLocal, engine
+
+# Ventana para buscar la medición basal antes del inicio del suplemento
+DIAS_BASAL = 180
+# Momento objetivo de la medición de seguimiento y tolerancia alrededor de él
+DIAS_SEGUIMIENTO = 90
+TOLERANCIA_SEGUIMIENTO = 60
+# El seguimiento debe estar al menos a esta distancia del inicio
+DIAS_MINIMOS_EFECTO = 14
+Z_95 = 1.96
+
+# Códigos de medicaciones -> nombre usado en historial_medico
+ALIAS_SUPLEMENTOS = {
+    "VitD": "Vitamina D",
+    "Multi": "Multivitamínico",
+    "CoQ10": "Coenzima Q10",
+}
+
+def cargar_episodios(conn):
+    """Episodios de suplementación (paciente, suplemento, dosis, inicio) de ambas fuentes"""
+    historial = pd.read_sql(text(
+        "SELECT paciente_id, suplemento, dosis, fecha_inicio FROM historial_medico "
+        "WHERE suplemento IS NOT NULL AND suplemento <> ''"
+    ), conn)
+    medicaciones = pd.read_sql(text(
+        "SELECT paciente_id, codigo AS suplemento, dosis, fecha_inicio FROM medicaciones "
+        "WHERE codigo IS NOT NULL AND codigo <> ''"
+    ), conn)
+    return normalizar_episodios(historial, medicaciones)
+
+def cargar_episodios_snapshot():
+    """Igual que cargar_episodios, leyendo los snapshots Parquet en lugar de la base de datos"""
+    historial = snapshots.cargar_pandas("historial_medico", ["paciente_id", "suplemento", "dosis", "fecha_inicio"])
+    historial = historial[historial["suplemento"].notna() & ~historial["suplemento"].isin(["", "sin_dato"])]
+    medicaciones = snapshots.cargar_pandas("medicaciones", ["paciente_id", "codigo", "dosis", "fecha_inicio"])
+    medicaciones = medicaciones.rename(columns={"codigo": "suplemento"})
+    medicaciones = medicaciones[medicaciones["suplemento"].notna() & (medicaciones["suplemento"] != "")]
+    return normalizar_episodios(historial, medicaciones)
+
+def normalizar_episodios(historial, medicaciones):
+    episodios = pd.concat([historial, medicaciones], ignore_index=True)
+    episodios["suplemento"] = episodios["suplemento"].replace(ALIAS_SUPLEMENTOS)
+    episodios["fecha_inicio"] = pd.to_datetime(episodios["fecha_inicio"], errors="coerce")
+    episodios["paciente_id"] = episodios["paciente_id"].astype(str)
+    episodios = episodios.dropna(subset=["fecha_inicio"])
+    return episodios.drop_duplicates(["paciente_id", "suplemento", "fecha_inicio"])
+
+def cargar_observaciones(conn):
+    observaciones = pd.read_sql(text(
+        "SELECT paciente_id, codigo, valor, fecha_efectiva FROM observaciones"
+    ), conn)
+    observaciones["paciente_id"] = observaciones["paciente_id"].astype(str)
+    return observaciones
+
+def cargar_observaciones_snapshot():
+    observaciones = snapshots.cargar_pandas("observaciones", ["paciente_id", "codigo", "valor", "fecha_efectiva"])
+    observaciones["paciente_id"] = observaciones["paciente_id"].astype(str)
+    observaciones["codigo"] = observaciones["codigo"].astype(str)
+    return observaciones
+
+def parsear_dosis(dosis):
+    """Extrae valor numérico y unidad de textos como '2000mg', '1000UI diario', '2 cápsulas'"""
+    extraido = dosis.fillna("").str.extract(r"(?P<dosis_valor>\d+(?:[.,]\d+)?)\s*(?P<unidad_dosis>[A-Za-zá-úÁ-Ú]*)")
+    extraido["dosis_valor"] = pd.to_numeric(extraido["dosis_valor"].str.replace(",", "."), errors="coerce")
+    extraido["unidad_dosis"] = extraido["unidad_dosis"].str.lower()
+    return extraido
+
+def alinear_episodios(episodios, observaciones):
+    """Asocia a cada (episodio, biomarcador) su valor basal y de seguimiento"""
+    codigos = pd.DataFrame({"codigo": observaciones["codigo"].unique()})
+    pares = episodios.merge(codigos, how="cross")
+    pares["fecha_objetivo"] = pares["fecha_inicio"] + pd.Timedelta(days=DIAS_SEGUIMIENTO)
+
+    serie = observaciones.sort_values("fecha_efectiva")
+
+    basal = pd.merge_asof(
+        pares.sort_values("fecha_inicio"),
+        serie.rename(columns={"valor": "valor_basal", "fecha_efectiva": "fecha_basal"}),
+        left_on="fecha_inicio",
+        right_on="fecha_basal",
+        by=["paciente_id", "codigo"],
+        direction="backward",
+        tolerance=pd.Timedelta(days=DIAS_BASAL),
+    )
+    alineados = pd.merge_asof(
+        basal.sort_values("fecha_objetivo"),
+        serie.rename(columns={"valor": "valor_seguimiento", "fecha_efectiva": "fecha_seguimiento"}),
+        left_on="fecha_objetivo",
+        right_on="fecha_seguimiento",
+        by=["paciente_id", "codigo"],
+        direction="nearest",
+        tolerance=pd.Timedelta(days=TOLERANCIA_SEGUIMIENTO),
+    )
+
+    minimo = alineados["fecha_inicio"] + pd.Timedelta(days=DIAS_MINIMOS_EFECTO)
+    alineados = alineados[
+        alineados["valor_basal"].notna()
+        & alineados["valor_seguimiento"].notna()
+        & (alineados["fecha_seguimiento"] >= minimo)
+    ].copy()
+    alineados["delta"] = alineados["valor_seguimiento"] - alineados["valor_basal"]
+    alineados["delta_porcentual"] = alineados["delta"] / alineados["valor_basal"].replace(0, np.nan) * 100
+    return alineados
+
+def resumir_efectos(alineados):
+    """Delta medio, IC 95% y tamaño de efecto por suplemento y biomarcador"""
+    grupos = alineados.groupby(["suplemento", "codigo"])
+    resumen = grupos.agg(
+        n=("delta", "size"),
+        delta_medio=("delta", "mean"),
+        desviacion=("delta", "std"),
+        delta_porcentual=("delta_porcentual", "mean"),
+    ).reset_index()
+    error_estandar = resumen["desviacion"] / np.sqrt(resumen["n"])
+    resumen["ic_inferior"] = resumen["delta_medio"] - Z_95 * error_estandar
+    resumen["ic_superior"] = resumen["delta_medio"] + Z_95 * error_estandar
+    resumen["tamano_efecto"] = resumen["delta_medio"] / resumen["desviacion"].replace(0, np.nan)
+    return resumen
+
+def resumir_dosis(alineados):
+    """Curva dosis-respuesta y pendiente por mínimos cuadrados usando sumas agrupadas"""
+    con_dosis = alineados.join(parsear_dosis(alineados["dosis"])).dropna(subset=["dosis_valor"])
+    # Solo se compara la dosis dentro de la unidad más frecuente de cada suplemento
+    unidad_principal = con_dosis.groupby("suplemento")["unidad_dosis"].agg(lambda u: u.mode().iat[0])
+    con_dosis = con_dosis[con_dosis["unidad_dosis"] == con_dosis["suplemento"].map(unidad_principal)]
+
+    curva = con_dosis.groupby(["suplemento", "codigo", "dosis_valor", "unidad_dosis"]).agg(
+        n=("delta", "size"),
+        delta_medio=("delta", "mean"),
+    ).reset_index().rename(columns={"dosis_valor": "dosis"})
+
+    # pendiente = cov(dosis, delta) / var(dosis), calculada con medias agrupadas
+    con_dosis = con_dosis.assign(
+        xy=con_dosis["dosis_valor"] * con_dosis["delta"],
+        xx=con_dosis["dosis_valor"] ** 2,
+    )
+    medias = con_dosis.groupby(["suplemento", "codigo"]).agg(
+        x=("dosis_valor", "mean"), y=("delta", "mean"), xy=("xy", "mean"), xx=("xx", "mean"),
+        unidad_dosis=("unidad_dosis", "first"),
+    )
+    varianza = (medias["xx"] - medias["x"] ** 2).replace(0, np.nan)
+    medias["pendiente_dosis"] = (medias["xy"] - medias["x"] * medias["y"]) / varianza
+    return curva, medias[["pendiente_dosis", "unidad_dosis"]].reset_index()
+
+def a_registros(df):
+    """Convierte un DataFrame a dicts reemplazando NaN por None"""
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+def calcular_efectividad(desde_snapshot=False):
+    """
+    Recalcula y persiste la efectividad de todos los suplementos; devuelve el número de
+    episodios usados. Con desde_snapshot los datos se leen de los snapshots Parquet y la
+    base de datos solo recibe el resultado.
+    """
+    if desde_snapshot:
+        episodios = cargar_episodios_snapshot()
+        observaciones = cargar_observaciones_snapshot()
+    else:
+        with engine.connect() as conn:
+            episodios = cargar_episodios(conn)
+            observaciones = cargar_observaciones(conn)
+
+    alineados = pd.DataFrame()
+    if not episodios.empty and not observaciones.empty:
+        alineados = alinear_episodios(episodios, observaciones)
+
+    efectos, curva = pd.DataFrame(), pd.DataFrame()
+    if not alineados.empty:
+        efectos = resumir_efectos(alineados)
+        curva, pendientes = resumir_dosis(alineados)
+        efectos = efectos.merge(pendientes, on=["suplemento", "codigo"], how="left")
+        efectos["calculado"] = datetime.now()
+
+    db = SessionLocal()
+    try:
+        # Reemplazo completo en una transacción: los lectores ven el resultado anterior o el nuevo
+        db.query(models.EfectividadSuplemento).delete()
+        db.query(models.RespuestaDosis).delete()
+        db.bulk_insert_mappings(models.EfectividadSuplemento, a_registros(efectos))
+        db.bulk_insert_mappings(models.RespuestaDosis, a_registros(curva))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+    return len(alineados)
+
+if __name__ == "__main__":
+    import sys
+
+    inicio = datetime.now()
+    episodios = calcular_efectividad(desde_snapshot="--snapshot" in sys.argv)
+    print(f"✅ Efectividad calculada con {episodios} episodios en {(datetime.now() - inicio).total_seconds():.1f}s")
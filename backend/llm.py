@@ -0,0 +1,163 @@
+"""
+Llamadas al modelo de lenguaje protegidas por un interruptor de circuito.
+
+El interruptor observa las últimas llamadas (ventana deslizante): si la tasa de errores
+o de llamadas lentas supera el umbral se abre y durante TIEMPO_ABIERTO segundos ninguna
+solicitud llega a OpenAI; los endpoints responden con el motor de reglas. Pasado ese
+tiempo queda semiabierto y deja pasar una sola llamada de prueba: si funciona se cierra,
+si falla vuelve a abrirse.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+import openai
+
+MODELO = os.getenv("OPENAI_MODEL", "gpt-4")
+TIMEOUT = float(os.getenv("LLM_TIMEOUT_SEGUNDOS", "20"))
+# En streaming: espera máxima entre un fragmento y el siguiente (el primero usa TIMEOUT)
+TIMEOUT_FRAGMENTO = float(os.getenv("LLM_TIMEOUT_FRAGMENTO_SEGUNDOS", "10"))
+
+CERRADO, ABIERTO, SEMIABIERTO = "cerrado", "abierto", "semiabierto"
+
+class CircuitoAbierto(Exception):
+    """El interruptor no permite llamar al modelo en este momento"""
+
+class InterruptorCircuito:
+    def __init__(self, ventana=20, min_llamadas=5, tasa_error=0.5, latencia_lenta=10.0,
+                 tasa_lentas=0.5, tiempo_abierto=30.0):
+        self.ventana = deque(maxlen=ventana)   # (exito, latencia)
+        self.min_llamadas = min_llamadas
+        self.tasa_error = tasa_error
+        self.latencia_lenta = latencia_lenta
+        self.tasa_lentas = tasa_lentas
+        self.tiempo_abierto = tiempo_abierto
+        self.estado = CERRADO
+        self.abierto_desde = 0.0
+        self.prueba_en_curso = False
+        self.aperturas = 0
+        self.lock = threading.Lock()
+
+    def permitir(self):
+        """True si la llamada puede hacerse; en semiabierto solo pasa una prueba a la vez"""
+        with self.lock:
+            if self.estado == ABIERTO:
+                if time.monotonic() - self.abierto_desde < self.tiempo_abierto:
+                    return False
+                self.estado = SEMIABIERTO
+                self.prueba_en_curso = False
+            if self.estado == SEMIABIERTO:
+                if self.prueba_en_curso:
+                    return False
+                self.prueba_en_curso = True
+            return True
+
+    def liberar_prueba(self):
+        """La llamada se canceló sin resultado (p. ej. el cliente se desconectó)"""
+        with self.lock:
+            self.prueba_en_curso = False
+
+    def registrar(self, exito, latencia):
+        with self.lock:
+            if self.estado == SEMIABIERTO:
+                self.prueba_en_curso = False
+                if exito and latencia < self.latencia_lenta:
+                    self.estado = CERRADO
+                    self.ventana.clear()
+                else:
+                    self._abrir()
+                return
+            self.ventana.append((exito, latencia))
+            if len(self.ventana) < self.min_llamadas:
+                return
+            errores = sum(1 for ok, _ in self.ventana if not ok) / len(self.ventana)
+            lentas = sum(1 for _, lat in self.ventana if lat >= self.latencia_lenta) / len(self.ventana)
+            if errores >= self.tasa_error or lentas >= self.tasa_lentas:
+                self._abrir()
+
+    def _abrir(self):
+        self.estado = ABIERTO
+        self.abierto_desde = time.monotonic()
+        self.aperturas += 1
+        self.ventana.clear()
+        print(f"Interruptor del LLM abierto durante {self.tiempo_abierto:.0f}s")
+
+    def resumen(self):
+        with self.lock:
+            return {
+                "estado": self.estado,
+                "llamadas_en_ventana": len(self.ventana),
+                "errores_en_ventana": sum(1 for ok, _ in self.ventana if not ok),
+                "aperturas": self.aperturas,
+            }
+
+interruptor = InterruptorCircuito(
+    ventana=int(os.getenv("CIRCUITO_VENTANA", "20")),
+    min_llamadas=int(os.getenv("CIRCUITO_MIN_LLAMADAS", "5")),
+    tasa_error=float(os.getenv("CIRCUITO_TASA_ERROR", "0.5")),
+    latencia_lenta=float(os.getenv("CIRCUITO_LATENCIA_LENTA", "10")),
+    tasa_lentas=float(os.getenv("CIRCUITO_TASA_LENTAS", "0.5")),
+    tiempo_abierto=float(os.getenv("CIRCUITO_TIEMPO_ABIERTO", "30")),
+)
+
+async def completar(mensajes, temperature=0.7):
+    """Texto completo de la respuesta del modelo; CircuitoAbierto si el interruptor no lo permite"""
+    if not interruptor.permitir():
+        raise CircuitoAbierto()
+    inicio = time.monotonic()
+    try:
+        respuesta = await asyncio.wait_for(
+            openai.ChatCompletion.acreate(model=MODELO, messages=mensajes, temperature=temperature),
+            TIMEOUT
+        )
+    except (asyncio.CancelledError, GeneratorExit):
+        interruptor.liberar_prueba()
+        raise
+    except Exception:
+        interruptor.registrar(False, time.monotonic() - inicio)
+        raise
+    interruptor.registrar(True, time.monotonic() - inicio)
+    return respuesta.choices[0].message.content
+
+async def completar_streaming(mensajes, temperature=0.7):
+    """
+    Genera los fragmentos de texto a medida que llegan. El tiempo hasta el primer
+    fragmento cuenta como latencia para el interruptor; un corte a mitad de respuesta o
+    un fragmento que tarda más de TIMEOUT_FRAGMENTO cuentan como error.
+    """
+    if not interruptor.permitir():
+        raise CircuitoAbierto()
+    inicio = time.monotonic()
+    latencia = None
+    try:
+        respuesta = await asyncio.wait_for(
+            openai.ChatCompletion.acreate(model=MODELO, messages=mensajes, temperature=temperature, stream=True),
+            TIMEOUT
+        )
+        fragmentos = respuesta.__aiter__()
+        while True:
+            # Un stream que se queda sin enviar nada no debe retener la conexión indefinidamente
+            espera = TIMEOUT - (time.monotonic() - inicio) if latencia is None else TIMEOUT_FRAGMENTO
+            try:
+                fragmento = await asyncio.wait_for(fragmentos.__anext__(), max(espera, 0))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                cerrar = getattr(fragmentos, "aclose", None)
+                if cerrar is not None:
+                    await cerrar()
+                raise
+            if latencia is None:
+                latencia = time.monotonic() - inicio
+            texto = fragmento.choices[0].delta.get("content")
+            if texto:
+                yield texto
+    except (asyncio.CancelledError, GeneratorExit):
+        interruptor.liberar_prueba()
+        raise
+    except Exception:
+        interruptor.registrar(False, time.monotonic() - inicio)
+        raise
+    interruptor.registrar(True, latencia if latencia is not None else time.monotonic() - inicio)
@@ -1,12 +1,31 @@
-from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks, Header, Query, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
 from sqlalchemy.orm import Session
-from database import get_db, engine
+from database import get_db, get_db_lectura, engine, estado_replicas, SessionLocal
 import models
+import autocompletado
+import busqueda
+import cohortes
+import efectividad
+import notificaciones
+import prompts
+import llm
+import reglas
+import rangos
+import pronosticos
+import analitica_duckdb
+import admision
+import coalescencia
+import validacion_fhir
+from biomarcadores import BIOMARCADORES, CODIGO_POR_BIOMARCADOR
+import sql_diagnostico
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy import event
-from sqlalchemy.exc import OperationalError
+from sqlalchemy import event, text, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import DBAPIError, IntegrityError, OperationalError
+import asyncio
 import time
 from datetime import datetime, timedelta
 import openai # Use old import
@@ -15,9 +34,11 @@ import numpy as np
 from sklearn.linear_model import LinearRegression
 from sklearn.ensemble import IsolationForest
 import pandas as pd
+import hashlib
 import json
+import operator
 import uuid
-from sqlalchemy.types import String
+from http import HTTPStatus
 
 # Definir modelos Pydantic primero
 class PacienteBase(BaseModel):
@@ -95,6 +116,10 @@ class FHIRBundle(BaseModel):
     type: str = "collection"
     entry: List[Dict[str, Any]]
 
+# Límite de registros por POST /historial/batch y filas por sentencia INSERT
+MAX_HISTORIAL_LOTE = int(os.getenv("HISTORIAL_MAX_LOTE", "10000"))
+LOTE_INSERCION = 1000
+
 # Agregar este modelo Pydantic
 class HistorialMedicoCreate(BaseModel):
     paciente_id: str  # Changed from int to str to accept UUID strings
@@ -111,6 +136,17 @@ class HistorialMedicoCreate(BaseModel):
 # Crear instancia de FastAPI después de los modelos
 app = FastAPI(title="API Ficha Médica Nutricional FHIR")
 
+# Diagnóstico de SQL (solo desarrollo/pruebas): el middleware más interno, mide solo el endpoint
+if sql_diagnostico.ACTIVO:
+    app.add_middleware(sql_diagnostico.MiddlewareDiagnosticoSQL)
+# Starlette ejecuta primero el último middleware registrado.
+# Control de admisión por prioridad; se registra antes que CORS para que sus rechazos
+# (429/503) también lleven las cabeceras CORS
+app.add_middleware(admision.MiddlewareAdmision)
+# Las solicitudes de IA duplicadas comparten un cálculo; va fuera de la admisión para que
+# solo el líder ocupe un cupo de 'ia' y las que esperan su respuesta no consuman ninguno
+app.add_middleware(coalescencia.MiddlewareCoalescencia)
+
 # Configurar CORS
 app.add_middleware(
     CORSMiddleware,
@@ -122,6 +158,8 @@ app.add_middleware(
 
 # Configurar OpenAI (asegúrate de tener la variable de entorno OPENAI_API_KEY)
 openai.api_key = os.getenv("OPENAI_API_KEY") # Use old configuration
+# Permite apuntar a un servidor compatible (p. ej. scripts/fake_llm_server.py en pruebas)
+openai.api_base = os.getenv("OPENAI_API_BASE", openai.api_base)
 
 def wait_for_db():
     max_retries = 5
@@ -139,12 +177,105 @@ def wait_for_db():
 # Llamar antes de crear las tablas
 wait_for_db()
 models.Base.metadata.create_all(bind=engine)
+# create_all no agrega índices a tablas que ya existían
+for tabla in (models.HistorialMedico.__table__, models.Medicacion.__table__):
+    for indice in tabla.indexes:
+        indice.create(bind=engine, checkfirst=True)
+cohortes.crear_funcion_fecha()
+try:
+    cohortes.crear_vistas()
+except Exception as e:
+    # La API sigue funcionando; solo las estadísticas de cohortes quedan sin datos
+    print(f"No se pudieron crear las vistas de cohortes: {e}")
+busqueda.crear_indices(engine)
+notificaciones.crear_triggers(engine)
+
+@app.on_event("startup")
+def iniciar_tareas_periodicas():
+    """Construye los índices en memoria e inicia las tareas periódicas"""
+    rangos.recargar()
+    pronosticos.cargar()
+    notificaciones.distribuidor.agregar_oyente(pronosticos.invalidar_por_notificacion)
+    autocompletado.construir_indice(SessionLocal)
+    autocompletado.iniciar_reconstruccion_periodica(
+        SessionLocal, int(os.getenv("AUTOCOMPLETADO_RECONSTRUIR_SEGUNDOS", "300"))
+    )
+    cohortes.iniciar_refresco_periodico(int(os.getenv("COHORTES_REFRESCO_SEGUNDOS", "300")))
+
+@app.on_event("shutdown")
+def guardar_caches():
+    pronosticos.persistir()
+
+@app.on_event("startup")
+async def iniciar_notificaciones():
+    """Inicia el listener de cambios en el event loop de este worker"""
+    notificaciones.distribuidor.iniciar(engine, asyncio.get_running_loop())
 
 # Endpoint de health check
 @app.get("/health")
 def health_check():
     """Endpoint para verificar que el servicio está funcionando"""
-    return {"status": "ok"}
+    return {
+        "status": "ok",
+        "replicas": estado_replicas(),
+        "notificaciones": notificaciones.distribuidor.estado(),
+        "llm": llm.interruptor.resumen(),
+        "cache_pronosticos": pronosticos.cache.estado(),
+        "admision": admision.control.estado(),
+        "coalescencia": coalescencia.coalescedor.estado()
+    }
+
+def parsear_tablas(tablas):
+    """Lista de tablas separadas por coma; vacío = todas"""
+    if not tablas:
+        return None
+    seleccion = [t.strip() for t in tablas.split(",") if t.strip()]
+    invalidas = set(seleccion) - set(notificaciones.TABLAS)
+    if invalidas:
+        raise ValueError(f"Tablas no válidas: {', '.join(sorted(invalidas))}")
+    return seleccion
+
+@app.websocket("/ws/cambios")
+async def ws_cambios(websocket: WebSocket, paciente_id: Optional[str] = None, tablas: Optional[str] = None):
+    """Canal de cambios por WebSocket filtrado por paciente y tablas"""
+    try:
+        seleccion = parsear_tablas(tablas)
+    except ValueError:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    suscriptor = notificaciones.distribuidor.suscribir(paciente_id, seleccion)
+    try:
+        await websocket.send_json({"tipo": "suscrito", "id": suscriptor.id})
+        while True:
+            await websocket.send_json(await suscriptor.siguiente())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        notificaciones.distribuidor.desuscribir(suscriptor)
+
+@app.get("/eventos/cambios")
+async def sse_cambios(paciente_id: Optional[str] = None, tablas: Optional[str] = None):
+    """Canal de cambios por Server-Sent Events (alternativa a WebSocket)"""
+    try:
+        seleccion = parsear_tablas(tablas)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    suscriptor = notificaciones.distribuidor.suscribir(paciente_id, seleccion)
+
+    async def eventos():
+        try:
+            yield notificaciones.formato_sse({"tipo": "suscrito", "id": suscriptor.id})
+            while True:
+                yield notificaciones.formato_sse(await suscriptor.siguiente())
+        finally:
+            notificaciones.distribuidor.desuscribir(suscriptor)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # ... resto del código de rutas ...
 
@@ -157,12 +288,17 @@ def crear_paciente(paciente: PacienteCreate, db: Session = Depends(get_db)):
     return db_paciente
 
 @app.get("/pacientes/", response_model=List[PacienteResponse])
-def listar_pacientes(db: Session = Depends(get_db)):
+def listar_pacientes(db: Session = Depends(get_db_lectura)):
     return db.query(models.Paciente).all()
 
+@app.get("/pacientes/autocompletar")
+def autocompletar_pacientes(q: str = Query(..., min_length=1, max_length=50), k: int = Query(10, ge=1, le=50)):
+    """Pacientes cuyo nombre, apellido o RUT comienza con q, servidos desde el índice en memoria"""
+    return autocompletado.indice.buscar(q, k)
+
 @app.get("/pacientes/{paciente_id}")
 def obtener_paciente(paciente_id: str, db: Session = Depends(get_db)):
-    """Obtiene un paciente por su ID"""
+    """Obtiene un paciente por su ID (lee del primario: se usa para verificar escrituras recientes)"""
     try:
         paciente_uuid = uuid.UUID(paciente_id)
     except ValueError:
@@ -186,6 +322,7 @@ def crear_historial(historial: HistorialMedicoCreate, db: Session = Depends(get_
         # Crear nuevo historial
         nuevo_historial = models.HistorialMedico(**historial.dict())
         db.add(nuevo_historial)
+        db.add_all(observaciones_desde_historial(nuevo_historial))
         db.commit()
         db.refresh(nuevo_historial)
         
@@ -194,9 +331,80 @@ def crear_historial(historial: HistorialMedicoCreate, db: Session = Depends(get_
         db.rollback()
         raise HTTPException(status_code=500, detail=f"Error creando historial médico: {str(e)}")
 
+def insertar_por_lotes(db, tabla, filas, tamano=LOTE_INSERCION):
+    """INSERT ... VALUES multi-fila; se parte en lotes por el límite de parámetros de PostgreSQL"""
+    for i in range(0, len(filas), tamano):
+        db.execute(tabla.insert().values(filas[i:i + tamano]))
+
+@app.post("/historial/batch")
+def crear_historial_lote(
+    registros: List[HistorialMedicoCreate],
+    todo_o_nada: bool = False,
+    db: Session = Depends(get_db)
+):
+    """
+    Crea muchos registros de historial en una transacción. Los pacientes se validan con una
+    sola consulta y cada fila informa su estado; con todo_o_nada=true cualquier rechazo
+    cancela el lote completo.
+    """
+    if len(registros) > MAX_HISTORIAL_LOTE:
+        raise HTTPException(status_code=413, detail=f"Máximo {MAX_HISTORIAL_LOTE} registros por lote")
+    
+    resultados = [None] * len(registros)
+    uuids = {}
+    for indice, registro in enumerate(registros):
+        try:
+            uuids[indice] = uuid.UUID(registro.paciente_id)
+        except ValueError:
+            resultados[indice] = {"indice": indice, "estado": "rechazado", "motivo": "paciente_id inválido"}
+    
+    existentes = set()
+    if uuids:
+        existentes = {pid for (pid,) in db.query(models.Paciente.id).filter(models.Paciente.id.in_(set(uuids.values())))}
+    validos = {}     # índice -> (registro con el UUID, observaciones)
+    for indice, paciente_uuid in uuids.items():
+        if paciente_uuid not in existentes:
+            resultados[indice] = {"indice": indice, "estado": "rechazado", "motivo": "Paciente no encontrado"}
+            continue
+        registro = registros[indice].copy(update={"paciente_id": paciente_uuid})
+        validos[indice] = (registro, datos_observaciones_historial(registro))
+    
+    rechazados = len(registros) - len(validos)
+    if todo_o_nada and rechazados:
+        raise HTTPException(status_code=422, detail={"creados": 0, "rechazados": rechazados, "resultados": resultados})
+    
+    try:
+        historiales, observaciones = [], []
+        for (indice, (registro, filas)), nuevo_id in zip(
+            validos.items(), reservar_ids(db, models.HistorialMedico.__tablename__, len(validos))
+        ):
+            historiales.append({**registro.dict(), "id": nuevo_id})
+            observaciones.extend(filas)
+            # observaciones = 0 con biomarcadores informados indica una fecha_inicio no reconocida
+            resultados[indice] = {"indice": indice, "estado": "creado", "id": nuevo_id, "observaciones": len(filas)}
+        insertar_por_lotes(db, models.HistorialMedico.__table__, historiales)
+        insertar_por_lotes(db, models.Observacion.__table__, observaciones)
+        # El INSERT directo no pasa por los eventos del ORM: se invalida la caché de pronósticos a mano
+        pronosticos.marcar_modificados(db, {str(uuids[i]) for i in validos})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error creando historiales: {str(e)}")
+    
+    return {"creados": len(validos), "rechazados": rechazados, "resultados": resultados}
+
+@app.get("/buscar")
+def buscar(
+    q: str = Query(..., min_length=2, max_length=100),
+    limite: int = Query(20, ge=1, le=busqueda.LIMITE_MAXIMO),
+    db: Session = Depends(get_db_lectura)
+):
+    """Busca pacientes por nombre o RUT aproximado y notas clínicas por contenido, con fragmentos resaltados"""
+    return busqueda.buscar(db, q, limite)
+
 # Endpoints FHIR
 @app.get("/fhir/Patient", response_model=List[Dict])
-async def get_patients(db: Session = Depends(get_db)):
+async def get_patients(db: Session = Depends(get_db_lectura)):
     """Obtiene todos los pacientes en formato FHIR"""
     try:
         # Obtener todos los pacientes de la base de datos
@@ -253,7 +461,7 @@ async def get_patients(db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Error interno del servidor: {str(e)}")
 
 @app.get("/fhir/Patient/{patient_id}")
-def obtener_paciente_fhir(patient_id: str, db: Session = Depends(get_db)):
+def obtener_paciente_fhir(patient_id: str, db: Session = Depends(get_db_lectura)):
     """Obtiene un paciente específico en formato FHIR"""
     try:
         # Convert to UUID if it's a valid UUID format
@@ -262,10 +470,6 @@ def obtener_paciente_fhir(patient_id: str, db: Session = Depends(get_db)):
         # Query by UUID
         paciente = db.query(models.Paciente).filter(models.Paciente.id == patient_uuid).first()
         
-        if not paciente:
-            # If not found by UUID, try using it as a string ID
-            paciente = db.query(models.Paciente).filter(models.Paciente.id.cast(String) == patient_id).first()
-            
         if not paciente:
             # Last attempt - try by RUT
             paciente = db.query(models.Paciente).filter(models.Paciente.rut == patient_id).first()
@@ -331,79 +535,90 @@ def crear_paciente_fhir(patient: FHIRPatient, db: Session = Depends(get_db)):
     # Devolver el recurso creado
     return patient
 
+@app.get("/fhir/Observation")
+def buscar_observaciones(
+    subject: str,
+    code: Optional[str] = None,
+    date: Optional[List[str]] = Query(None),
+    value_quantity: Optional[List[str]] = Query(None, alias="value-quantity"),
+    sort: str = Query("date", alias="_sort"),
+    count: int = Query(100, alias="_count", ge=1, le=1000),
+    db: Session = Depends(get_db_lectura)
+):
+    """
+    Búsqueda FHIR de observaciones: subject (Patient/{id}), code (lista separada por comas,
+    admite system|code), date y value-quantity con prefijos eq/ne/gt/ge/lt/le, _sort y _count.
+    Los filtros se traducen a predicados sobre el índice (paciente_id, codigo, fecha_efectiva).
+    """
+    try:
+        paciente_uuid = uuid.UUID(subject.replace("Patient/", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Parámetro subject inválido")
+    
+    consulta = db.query(models.Observacion).filter(models.Observacion.paciente_id == paciente_uuid)
+    
+    if code:
+        codigos = [c.split("|")[-1] for c in code.split(",") if c]
+        consulta = consulta.filter(models.Observacion.codigo.in_(codigos))
+    
+    for valor in date or []:
+        prefijo, fecha = separar_prefijo_busqueda(valor)
+        try:
+            inicio = parsear_fecha_fhir(fecha)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Fecha inválida: {valor}")
+        if prefijo == "eq" and len(fecha) == 10:
+            # Una fecha sin hora abarca el día completo
+            consulta = consulta.filter(
+                models.Observacion.fecha_efectiva >= inicio,
+                models.Observacion.fecha_efectiva < inicio + timedelta(days=1)
+            )
+        else:
+            consulta = consulta.filter(PREFIJOS_BUSQUEDA[prefijo](models.Observacion.fecha_efectiva, inicio))
+    
+    for valor in value_quantity or []:
+        prefijo, cantidad = separar_prefijo_busqueda(valor)
+        try:
+            numero = float(cantidad.split("|")[0])
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Cantidad inválida: {valor}")
+        consulta = consulta.filter(PREFIJOS_BUSQUEDA[prefijo](models.Observacion.valor, numero))
+    
+    columnas_orden = {"date": models.Observacion.fecha_efectiva, "value": models.Observacion.valor}
+    orden = []
+    for campo in sort.split(","):
+        columna = columnas_orden.get(campo.lstrip("-"))
+        if columna is None:
+            raise HTTPException(status_code=400, detail=f"_sort no soportado: {campo}")
+        orden.append(columna.desc() if campo.startswith("-") else columna)
+    
+    observaciones = consulta.order_by(*orden).limit(count).all()
+    
+    return {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "entry": [
+            {
+                "fullUrl": f"Observation/obs-{obs.id}",
+                "resource": convertir_observacion_a_fhir(obs),
+                "search": {"mode": "match"}
+            } for obs in observaciones
+        ]
+    }
+
 @app.get("/fhir/Observation/{patient_id}")
-def obtener_observaciones_paciente(patient_id: str, db: Session = Depends(get_db)):
+def obtener_observaciones_paciente(patient_id: str, db: Session = Depends(get_db_lectura)):
     """Obtiene las observaciones de un paciente en formato FHIR"""
     try:
         # Intentar convertir a UUID
         patient_uuid = uuid.UUID(patient_id)
         
-        # Buscar historial del paciente
-        historiales = db.query(models.HistorialMedico).filter(
-            models.HistorialMedico.paciente_id == patient_uuid
-        ).all()
+        # Lectura por rango sobre (paciente_id, codigo, fecha_efectiva)
+        observaciones = db.query(models.Observacion).filter(
+            models.Observacion.paciente_id == patient_uuid
+        ).order_by(models.Observacion.codigo, models.Observacion.fecha_efectiva).all()
         
-        if not historiales:
-            return []
-            
-        # Convertir historiales a formato FHIR
-        observaciones = []
-        for historial in historiales:
-            # Crear observaciones para cada parámetro del historial
-            if historial.colesterol_total:
-                observaciones.append({
-                    "resourceType": "Observation",
-                    "id": str(uuid.uuid4()),
-                    "status": "final",
-                    "code": {
-                        "coding": [
-                            {
-                                "system": "http://loinc.org",
-                                "code": "2093-3",
-                                "display": "Colesterol Total"
-                            }
-                        ]
-                    },
-                    "subject": {
-                        "reference": f"Patient/{patient_id}"
-                    },
-                    "effectiveDateTime": historial.fecha_inicio,
-                    "valueQuantity": {
-                        "value": historial.colesterol_total,
-                        "unit": "mg/dL",
-                        "system": "http://unitsofmeasure.org",
-                        "code": "mg/dL"
-                    }
-                })
-            
-            # Agregar otras observaciones siguiendo el mismo patrón
-            if historial.trigliceridos:
-                observaciones.append({
-                    "resourceType": "Observation",
-                    "id": str(uuid.uuid4()),
-                    "status": "final",
-                    "code": {
-                        "coding": [
-                            {
-                                "system": "http://loinc.org",
-                                "code": "2571-8",
-                                "display": "Triglicéridos"
-                            }
-                        ]
-                    },
-                    "subject": {
-                        "reference": f"Patient/{patient_id}"
-                    },
-                    "effectiveDateTime": historial.fecha_inicio,
-                    "valueQuantity": {
-                        "value": historial.trigliceridos,
-                        "unit": "mg/dL",
-                        "system": "http://unitsofmeasure.org",
-                        "code": "mg/dL"
-                    }
-                })
-                
-        return observaciones
+        return [convertir_observacion_a_fhir(obs) for obs in observaciones]
     except ValueError:
         # ID de paciente no válido
         raise HTTPException(status_code=400, detail="ID de paciente inválido")
@@ -447,6 +662,7 @@ def crear_historial_medico(historial: dict, db: Session = Depends(get_db)):
         )
         
         db.add(db_historial)
+        db.add_all(observaciones_desde_historial(db_historial))
         db.commit()
         db.refresh(db_historial)
         return db_historial
@@ -455,7 +671,7 @@ def crear_historial_medico(historial: dict, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Error al crear historial médico: {str(e)}")
 
 @app.get("/fhir/MedicationStatement/{patient_id}")
-def obtener_medicaciones_paciente(patient_id: str, db: Session = Depends(get_db)):
+def obtener_medicaciones_paciente(patient_id: str, db: Session = Depends(get_db_lectura)):
     """Obtiene las medicaciones/suplementos de un paciente en formato FHIR"""
     try:
         # Try to convert to UUID
@@ -563,7 +779,7 @@ def crear_medicamento_fhir(medication: FHIRMedicationStatement, db: Session = De
     return medication
 
 @app.get("/fhir/Patient/{rut}/complete", response_model=FHIRBundle)
-def obtener_ficha_completa_fhir(rut: str, db: Session = Depends(get_db)):
+def obtener_ficha_completa_fhir(rut: str, db: Session = Depends(get_db_lectura)):
     """Endpoint para obtener la ficha completa del paciente en formato FHIR"""
     paciente = db.query(models.Paciente).filter(models.Paciente.rut == rut).first()
     if not paciente:
@@ -615,40 +831,19 @@ def obtener_ficha_completa_fhir(rut: str, db: Session = Depends(get_db)):
         "fullUrl": f"urn:uuid:{paciente.id}"
     })
     
-    # Agregar observaciones y medicamentos al bundle
+    # Agregar observaciones al bundle
+    observaciones = db.query(models.Observacion).filter(
+        models.Observacion.paciente_id == paciente.id
+    ).order_by(models.Observacion.codigo, models.Observacion.fecha_efectiva).all()
+    
+    for obs in observaciones:
+        bundle["entry"].append({
+            "resource": convertir_observacion_a_fhir(obs),
+            "fullUrl": f"urn:uuid:obs-{obs.id}"
+        })
+    
+    # Agregar medicamentos/suplementos al bundle
     for registro in historial:
-        # Agregar observación de colesterol
-        if registro.colesterol_total:
-            obs_colesterol = {
-                "resourceType": "Observation",
-                "id": f"col-{registro.id}",
-                "status": "final",
-                "code": {
-                    "coding": [
-                        {
-                            "system": "http://loinc.org",
-                            "code": "2093-3",
-                            "display": "Colesterol total"
-                        }
-                    ]
-                },
-                "subject": {
-                    "reference": f"Patient/{paciente.id}"
-                },
-                "effectiveDateTime": registro.fecha_inicio,
-                "valueQuantity": {
-                    "value": registro.colesterol_total,
-                    "unit": "mg/dL",
-                    "system": "http://unitsofmeasure.org",
-                    "code": "mg/dL"
-                }
-            }
-            bundle["entry"].append({
-                "resource": obs_colesterol,
-                "fullUrl": f"urn:uuid:col-{registro.id}"
-            })
-        
-        # Agregar medicamento/suplemento
         med_statement = {
             "resourceType": "MedicationStatement",
             "id": f"med-{registro.id}",
@@ -689,85 +884,465 @@ def obtener_ficha_completa_fhir(rut: str, db: Session = Depends(get_db)):
     return bundle
 
 @app.post("/fhir/import")
-def importar_fhir(bundle: Dict[str, Any], db: Session = Depends(get_db)):
-    """Importa un bundle FHIR"""
-    recursos_creados = []
+def importar_fhir(
+    bundle: Dict[str, Any],
+    modo: str = Query("completo", regex="^(completo|incremental)$"),
+    sistema: Optional[str] = None,
+    x_fuente_clave: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """
+    Importa un bundle FHIR. En modo incremental solo escribe los recursos que cambiaron.
+    Los sistemas de FHIR_FUENTES_CONFIABLES que envían su clave en X-Fuente-Clave omiten
+    la validación profunda; el sistema declarado por sí solo no basta.
+    """
+    sistema = sistema or bundle.get("meta", {}).get("source")
+    confiable = validacion_fhir.es_confiable(sistema, x_fuente_clave)
+    if modo == "incremental":
+        return importar_incremental(bundle, sistema or "desconocido", db, confiable)
     
-    # Primero procesar solo los pacientes
-    for entry in bundle.get("entry", []):
-        if entry.get("resource", {}).get("resourceType") == "Patient":
-            try:
-                paciente = procesar_paciente_fhir(entry["resource"], db)
-                recursos_creados.append({"tipo": "Patient", "id": str(paciente.id)})
-            except Exception as e:
-                print(f"Error al procesar paciente: {e}")
+    return importar_bundle(bundle, db, confiable)
+
+# Bundles FHIR: "transaction" se aplica entero o nada; "batch" (y cualquier otro tipo)
+# procesa cada entrada en un savepoint propio. Los pacientes se procesan primero para que
+# las referencias urn:uuid de las demás entradas apunten a pacientes ya creados.
+
+def estado_http(codigo):
+    return f"{codigo} {HTTPStatus(codigo).phrase}"
+
+def operation_outcome(mensaje, severidad="error", codigo="processing"):
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [{"severity": severidad, "code": codigo, "diagnostics": mensaje}]
+    }
+
+def id_paciente_entrada(entry):
+    """UUID del Patient: su id, el urn:uuid de fullUrl o uno nuevo"""
+    resource = entry.get("resource", {})
+    if resource.get("id"):
+        try:
+            return uuid.UUID(resource["id"])
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Id de paciente inválido: {resource['id']}")
+    full_url = entry.get("fullUrl", "")
+    if full_url.startswith("urn:uuid:"):
+        return uuid.UUID(full_url[len("urn:uuid:"):])
+    return uuid.uuid4()
+
+def resolver_paciente(resource, referencias, db):
+    """UUID del paciente referido en subject: urn:uuid del mismo bundle o Patient/<uuid> existente"""
+    ref = resource.get("subject", {}).get("reference", "")
+    if ref in referencias:
+        return referencias[ref]
+    if not ref.startswith("Patient/"):
+        raise HTTPException(status_code=400, detail=f"Referencia de paciente inválida: {ref}")
+    try:
+        paciente_uuid = uuid.UUID(ref.replace("Patient/", ""))
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Referencia de paciente inválida: {ref}")
+    if paciente_uuid not in referencias.values() and not db.query(models.Paciente.id).filter(models.Paciente.id == paciente_uuid).first():
+        raise HTTPException(status_code=404, detail=f"Paciente {paciente_uuid} no encontrado")
+    return paciente_uuid
+
+def precargar_referencias(entradas, db):
+    """Referencias Patient/<uuid> a pacientes existentes, resueltas con una sola consulta"""
+    ids = set()
+    for entry in entradas:
+        # Las entradas inválidas (en modo batch) pueden traer cualquier forma en subject
+        subject = (entry.get("resource") or {}).get("subject")
+        ref = subject.get("reference") if isinstance(subject, dict) else None
+        if not isinstance(ref, str) or not ref.startswith("Patient/"):
+            continue
+        try:
+            ids.add(uuid.UUID(ref[len("Patient/"):]))
+        except ValueError:
+            pass
+    if not ids:
+        return {}
+    existentes = db.query(models.Paciente.id).filter(models.Paciente.id.in_(ids)).all()
+    return {f"Patient/{fila.id}": fila.id for fila in existentes}
+
+def procesar_entrada(entry, db, referencias):
+    """Aplica una entrada del bundle sin hacer commit; devuelve (código HTTP, location)"""
+    resource = entry.get("resource") or {}
+    tipo = resource.get("resourceType")
+    metodo = (entry.get("request") or {}).get("method", "POST").upper()
+    if metodo not in ("POST", "PUT"):
+        raise HTTPException(status_code=405, detail=f"Método {metodo} no soportado")
+    if tipo == "Patient":
+        paciente, creado = procesar_paciente_fhir(resource, db, id_paciente_entrada(entry))
+        if entry.get("fullUrl"):
+            referencias[entry["fullUrl"]] = paciente.id
+        return (201 if creado else 200), f"Patient/{paciente.id}"
+    paciente_uuid = resolver_paciente(resource, referencias, db)
+    if tipo == "Observation":
+        registro = procesar_observacion_fhir(resource, db, paciente_uuid)
+    else:
+        registro = procesar_medicacion_fhir(resource, db, paciente_uuid)
+    return 201, f"{tipo}/{registro.id}"
+
+def aplicar_entrada(entry, db, referencias):
+    """Devuelve (entrada de respuesta, error); los errores de datos de la entrada no se propagan"""
+    try:
+        status, location = procesar_entrada(entry, db, referencias)
+        return {"response": {"status": estado_http(status), "location": location}}, None
+    except HTTPException as e:
+        status, mensaje = e.status_code, str(e.detail)
+    except ValueError as e:
+        status, mensaje = 400, str(e)
+    except IntegrityError as e:
+        # Duplicado (p. ej. un RUT ya registrado): solo afecta a esta entrada en modo batch
+        status, mensaje = 409, str(e.orig)
+    except OperationalError:
+        # Problemas de conexión o de la base no son culpa de la entrada
+        raise
+    except DBAPIError as e:
+        # Datos que la base rechaza (p. ej. un RUT más largo que la columna): error de la entrada
+        status, mensaje = 400, str(e.orig).strip()
+    except (TypeError, KeyError, AttributeError) as e:
+        # En modo confiable no hay validación profunda: un campo con otra forma llega hasta aquí
+        status, mensaje = 400, f"Entrada mal formada: {e!r}"
+    return {"response": {"status": estado_http(status), "outcome": operation_outcome(mensaje)}}, (status, mensaje)
+
+def importar_bundle(bundle, db, confiable=False):
+    """Importa un Bundle con semántica FHIR batch/transaction y devuelve el Bundle de respuesta"""
+    tipo_bundle = bundle.get("type", "collection")
+    entradas = bundle.get("entry", [])
+    # Todo el bundle se valida antes de escribir y los errores se informan juntos
+    errores = validacion_fhir.validar_entradas(entradas, confiable)
+    if errores and tipo_bundle == "transaction":
+        return JSONResponse(status_code=400, content=validacion_fhir.operation_outcome(errores))
+    # Solo las entradas válidas tienen la forma esperada (objeto con resource); las inválidas
+    # (modo batch) solo reciben su OperationOutcome
+    validas = [i for i in range(len(entradas)) if i not in errores]
+    # Pacientes primero, conservando el orden original en la respuesta
+    orden = sorted(validas, key=lambda i: entradas[i]["resource"].get("resourceType") != "Patient") + sorted(errores)
+    respuestas = [None] * len(entradas)
+    
+    try:
+        # Evita un SELECT del paciente por cada entrada que lo referencia (N+1)
+        referencias = precargar_referencias([entradas[i] for i in validas], db)
+        for i in orden:
+            if tipo_bundle == "transaction":
+                respuestas[i], error = aplicar_entrada(entradas[i], db, referencias)
+                if error:
+                    # Transacción: cualquier error deshace todo el bundle
+                    db.rollback()
+                    status, mensaje = error
+                    return JSONResponse(status_code=status, content=operation_outcome(f"Entrada {i}: {mensaje}"))
+            elif i in errores:
+                respuestas[i] = {"response": {
+                    "status": estado_http(400), "outcome": validacion_fhir.operation_outcome({i: errores[i]})
+                }}
+            else:
+                savepoint = db.begin_nested()
+                respuestas[i], error = aplicar_entrada(entradas[i], db, referencias)
+                if error:
+                    savepoint.rollback()
+                    # Las referencias a un paciente deshecho ya no son válidas
+                    referencias.pop(entradas[i].get("fullUrl"), None)
+                else:
+                    savepoint.commit()
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(status_code=500, detail=f"Error importando bundle: {str(e)}")
     
-    # Luego procesar el resto de recursos
+    if tipo_bundle in ("transaction", "batch"):
+        return {"resourceType": "Bundle", "type": f"{tipo_bundle}-response", "entry": respuestas}
+    # Otros tipos de bundle (collection): formato resumido
+    recursos = [r["response"]["location"] for r in respuestas if "location" in r["response"]]
+    errores = [
+        {"entrada": i, "status": r["response"]["status"], "detalle": r["response"]["outcome"]["issue"][0]["diagnostics"]}
+        for i, r in enumerate(respuestas) if "outcome" in r["response"]
+    ]
+    return {
+        "mensaje": f"Importados {len(recursos)} recursos",
+        "recursos": [{"tipo": loc.split("/")[0], "id": loc.split("/")[1]} for loc in recursos],
+        "errores": errores
+    }
+
+def procesar_paciente_fhir(resource, db, paciente_uuid):
+    """Crea el paciente si no existe (sin commit); devuelve (paciente, creado)"""
+    paciente_existente = db.query(models.Paciente).filter(models.Paciente.id == paciente_uuid).first()
+    if paciente_existente:
+        return paciente_existente, False
+    paciente = models.Paciente(**datos_paciente_fhir(resource, paciente_uuid))
+    db.add(paciente)
+    db.flush()
+    return paciente, True
+
+# Sincronización incremental: cada recurso de origen (sistema + tipo + id) guarda el hash
+# de su contenido; los recursos cuyo hash no cambió se descartan con una sola consulta.
+
+COLUMNAS_PACIENTE_SINCRONIZADAS = [
+    "rut", "nombre", "apellido", "fecha_nacimiento", "sexo", "direccion", "telefono", "email"
+]
+
+def hash_recurso(resource):
+    """SHA-256 del recurso serializado de forma canónica"""
+    contenido = json.dumps(resource, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+def uuid_paciente_fuente(sistema, recurso_id):
+    """UUID local de un paciente de origen; los ids que no son UUID se derivan de forma determinista"""
+    try:
+        return uuid.UUID(recurso_id)
+    except ValueError:
+        return uuid.uuid5(uuid.NAMESPACE_URL, f"{sistema}/Patient/{recurso_id}")
+
+def datos_paciente_fhir(resource, paciente_uuid):
+    """Columnas de la tabla pacientes a partir de un recurso Patient"""
+    nombre, apellido = obtener_nombre(resource)
+    return {
+        "id": paciente_uuid,
+        "rut": obtener_identificador(resource, "http://minsal.cl/rut"),
+        "nombre": nombre,
+        "apellido": apellido,
+        "fecha_nacimiento": resource.get("birthDate", ""),
+        "sexo": resource.get("gender", "").lower(),
+        "direccion": obtener_direccion(resource),
+        "telefono": obtener_telecom(resource, "phone"),
+        "email": obtener_telecom(resource, "email"),
+        # Campos requeridos por el modelo (valores por defecto)
+        "tipo_sangre": "",
+        "alergias": "",
+        "actividad_fisica": "",
+        "dieta": "",
+        "problema_salud_principal": "",
+        "objetivo_suplementacion": "",
+        "contacto_emergencia": "",
+        "consentimiento_datos": True
+    }
+
+def datos_observacion_fhir(resource, paciente_uuid):
+    """Columnas de la tabla observaciones a partir de un recurso Observation"""
+    coding = resource.get("code", {}).get("coding", [])
+    cantidad = resource.get("valueQuantity", {})
+    if not coding or cantidad.get("value") is None:
+        raise ValueError("Observación sin código o sin valor numérico")
+    codigo = coding[0].get("code", "")
+    return {
+        "paciente_id": paciente_uuid,
+        "codigo": codigo,
+        "valor": float(cantidad["value"]),
+        "unidad": cantidad.get("unit") or BIOMARCADORES.get(codigo, {}).get("unidad"),
+        "fecha_efectiva": parsear_fecha_fhir(resource.get("effectiveDateTime"))
+    }
+
+def datos_medicacion_fhir(resource, paciente_uuid):
+    """Columnas de la tabla medicaciones a partir de un recurso MedicationStatement"""
+    concepto = resource.get("medicationCodeableConcept", {})
+    coding = concepto.get("coding") or [{}]
+    codigo = resource.get("medicationReference", {}).get("reference") or coding[0].get("code")
+    if not codigo:
+        raise ValueError("Medicación sin referencia o código")
+    periodo = resource.get("effectivePeriod", {})
+    return {
+        "paciente_id": paciente_uuid,
+        "codigo": codigo,
+        "nombre": concepto.get("text") or coding[0].get("display"),
+        "estado": resource.get("status", "unknown"),
+        "fecha_inicio": resource.get("effectiveDateTime") or periodo.get("start", ""),
+        "fecha_fin": periodo.get("end"),
+        "dosis": (resource.get("dosage") or [{}])[0].get("text", "")
+    }
+
+def reservar_ids(db, tabla, cantidad):
+    """Obtiene 'cantidad' ids de la secuencia de la tabla en una sola consulta"""
+    if not cantidad:
+        return []
+    return db.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:tabla, 'id')) FROM generate_series(1, :n)"),
+        {"tabla": tabla, "n": cantidad}
+    ).scalars().all()
+
+def resolver_pacientes_por_rut(cambiados, existentes, sistema, db, rechazados):
+    """
+    Filas de pacientes a escribir. Un paciente nuevo cuyo RUT ya está registrado (p. ej. cargado
+    desde otro sistema) se escribe sobre ese paciente; un RUT repetido en el bundle o que ya
+    pertenece a otro paciente enlazado se rechaza solo para esa entrada.
+    """
+    filas = {
+        clave: datos_paciente_fhir(
+            resource,
+            uuid.UUID(existentes[clave][1]) if existentes.get(clave, (None, None))[1]
+            else uuid_paciente_fuente(sistema, clave[1])
+        )
+        for clave, (_, resource) in cambiados.items() if clave[0] == "Patient"
+    }
+    ruts = {datos["rut"] for datos in filas.values() if datos["rut"]}
+    titulares = {}
+    if ruts:
+        titulares = dict(db.query(models.Paciente.rut, models.Paciente.id).filter(models.Paciente.rut.in_(ruts)))
+    pacientes, vistos = {}, set()
+    for clave, datos in filas.items():
+        rut = datos["rut"]
+        if rut:
+            if rut in vistos:
+                rechazados.append({"tipo": "Patient", "id": clave[1], "motivo": f"RUT {rut} repetido en el bundle"})
+                continue
+            vistos.add(rut)
+            titular = titulares.get(rut)
+            if titular is not None and titular != datos["id"]:
+                if existentes.get(clave, (None, None))[1]:
+                    rechazados.append({"tipo": "Patient", "id": clave[1], "motivo": f"RUT {rut} ya registrado para otro paciente"})
+                    continue
+                datos["id"] = titular
+        pacientes[clave] = datos
+    return pacientes
+
+def pacientes_locales(sistema, pacientes, referidos, db):
+    """id de origen -> UUID local de los pacientes escritos en este bundle o sincronizados antes"""
+    locales = {recurso_id: datos["id"] for (_, recurso_id), datos in pacientes.items()}
+    pendientes = referidos - set(locales)
+    if pendientes:
+        filas = db.query(models.RecursoFuente.recurso_id, models.RecursoFuente.id_local).filter(
+            models.RecursoFuente.sistema == sistema,
+            models.RecursoFuente.tipo == "Patient",
+            models.RecursoFuente.recurso_id.in_(pendientes)
+        )
+        locales.update({recurso_id: uuid.UUID(id_local) for recurso_id, id_local in filas if id_local})
+    return locales
+
+def importar_incremental(bundle, sistema, db, confiable=False):
+    """Importa solo los recursos nuevos o modificados usando upserts masivos en una transacción"""
+    # Último recurso de cada (tipo, id) dentro del bundle
+    entradas = {}
+    rechazados = []
     for entry in bundle.get("entry", []):
         resource = entry.get("resource", {})
-        if resource.get("resourceType") != "Patient":  # Ya procesamos los pacientes
-            try:
-                if resource.get("resourceType") == "Observation":
-                    observacion = procesar_observacion_fhir(resource, db)
-                    recursos_creados.append({"tipo": "Observation", "id": observacion.id})
-                elif resource.get("resourceType") == "MedicationStatement":
-                    medicacion = procesar_medicacion_fhir(resource, db)
-                    recursos_creados.append({"tipo": "MedicationStatement", "id": medicacion.id})
-            except Exception as e:
-                print(f"Error al procesar recurso {resource.get('resourceType')}: {e}")
+        tipo = resource.get("resourceType")
+        if tipo not in ("Patient", "Observation", "MedicationStatement"):
+            continue
+        if not resource.get("id"):
+            rechazados.append({"tipo": tipo, "id": None, "motivo": "Recurso sin id"})
+            continue
+        errores = validacion_fhir.validar_recurso(resource, confiable)
+        if errores:
+            rechazados.append({"tipo": tipo, "id": resource["id"], "motivo": "; ".join(errores)})
+            continue
+        entradas[(tipo, resource["id"])] = (hash_recurso(resource), resource)
+    
+    # Diferencia contra los hashes almacenados en una sola consulta
+    existentes = {}
+    if entradas:
+        filas = db.query(
+            models.RecursoFuente.tipo, models.RecursoFuente.recurso_id,
+            models.RecursoFuente.hash, models.RecursoFuente.id_local
+        ).filter(
+            models.RecursoFuente.sistema == sistema,
+            tuple_(models.RecursoFuente.tipo, models.RecursoFuente.recurso_id).in_(list(entradas))
+        ).all()
+        existentes = {(f.tipo, f.recurso_id): (f.hash, f.id_local) for f in filas}
+    
+    cambiados = {
+        clave: valor for clave, valor in entradas.items()
+        if existentes.get(clave, (None, None))[0] != valor[0]
+    }
     
-    return {"mensaje": f"Importados {len(recursos_creados)} recursos", "recursos": recursos_creados}
-
-def procesar_paciente_fhir(resource, db):
-    """Procesa un recurso Patient de FHIR y lo guarda en la base de datos"""
     try:
-        # Extraer el UUID del paciente
-        paciente_id = resource.get("id")
-        if not paciente_id:
-            paciente_id = str(uuid.uuid4())
+        # Pacientes: INSERT ... ON CONFLICT (id) DO UPDATE. pacientes.rut también es único, así
+        # que un recurso nuevo con un RUT ya registrado se enlaza al paciente existente
+        pacientes = resolver_pacientes_por_rut(cambiados, existentes, sistema, db, rechazados)
+        if pacientes:
+            stmt = pg_insert(models.Paciente.__table__).values(list(pacientes.values()))
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["id"],
+                set_={columna: stmt.excluded[columna] for columna in COLUMNAS_PACIENTE_SINCRONIZADAS}
+            )
+            db.execute(stmt)
         
-        # Verificar si el paciente ya existe
-        paciente_uuid = uuid.UUID(paciente_id)
-        paciente_existente = db.query(models.Paciente).filter(models.Paciente.id == paciente_uuid).first()
-        if paciente_existente:
-            print(f"Paciente {paciente_id} ya existe en la base de datos")
-            return paciente_existente
+        # Referencias a pacientes: deben existir en la base o venir en este bundle
+        referidos = {}
+        for (tipo, recurso_id), (_, resource) in cambiados.items():
+            if tipo != "Patient":
+                ref = resource.get("subject", {}).get("reference", "")
+                referidos[(tipo, recurso_id)] = ref[len("Patient/"):] if ref.startswith("Patient/") else None
+        locales = pacientes_locales(sistema, pacientes, set(referidos.values()) - {None}, db)
+        referencias = {
+            clave: (locales.get(ref) or uuid_paciente_fuente(sistema, ref)) if ref else None
+            for clave, ref in referidos.items()
+        }
+        conocidos = set()
+        candidatos = {r for r in referencias.values() if r}
+        if candidatos:
+            conocidos = {pid for (pid,) in db.query(models.Paciente.id).filter(models.Paciente.id.in_(candidatos))}
         
-        # Extraer información del paciente
-        nombre, apellido = obtener_nombre(resource)
+        # Observaciones y medicaciones: actualización por id local o inserción masiva
+        ids_locales = {clave: datos["id"] for clave, datos in pacientes.items()}
+        for tipo, modelo, extraer in (
+            ("Observation", models.Observacion, datos_observacion_fhir),
+            ("MedicationStatement", models.Medicacion, datos_medicacion_fhir),
+        ):
+            nuevas, modificadas = {}, []
+            for clave, (_, resource) in cambiados.items():
+                if clave[0] != tipo:
+                    continue
+                paciente_uuid = referencias[clave]
+                if paciente_uuid not in conocidos:
+                    rechazados.append({"tipo": tipo, "id": clave[1], "motivo": "Paciente no encontrado"})
+                    continue
+                try:
+                    datos = extraer(resource, paciente_uuid)
+                except ValueError as e:
+                    rechazados.append({"tipo": tipo, "id": clave[1], "motivo": str(e)})
+                    continue
+                id_local = existentes.get(clave, (None, None))[1]
+                if id_local:
+                    modificadas.append({**datos, "id": int(id_local)})
+                    ids_locales[clave] = id_local
+                else:
+                    nuevas[clave] = datos
+            
+            # Los ids se reservan antes de insertar para registrar el id local sin RETURNING
+            for (clave, datos), nuevo_id in zip(nuevas.items(), reservar_ids(db, modelo.__tablename__, len(nuevas))):
+                datos["id"] = nuevo_id
+                ids_locales[clave] = nuevo_id
+            if nuevas:
+                db.execute(modelo.__table__.insert(), list(nuevas.values()))
+            if modificadas:
+                db.bulk_update_mappings(modelo, modificadas)
         
-        # Crear nuevo paciente
-        print(f"Creando nuevo paciente con ID: {paciente_id}")
-        paciente = models.Paciente(
-            id=paciente_uuid,
-            rut=obtener_identificador(resource, "http://minsal.cl/rut"),
-            nombre=nombre,
-            apellido=apellido,
-            fecha_nacimiento=resource.get("birthDate", ""),
-            sexo=resource.get("gender", "").lower(),
-            direccion=obtener_direccion(resource),
-            telefono=obtener_telecom(resource, "phone"),
-            email=obtener_telecom(resource, "email"),
-            # Campos requeridos por el modelo (valores por defecto)
-            tipo_sangre="",
-            alergias="",
-            actividad_fisica="",
-            dieta="",
-            problema_salud_principal="",
-            objetivo_suplementacion="",
-            contacto_emergencia="",
-            consentimiento_datos=True
-        )
+        # Registrar los hashes de lo escrito: INSERT ... ON CONFLICT DO UPDATE
+        ahora = datetime.now()
+        registros = [
+            {
+                "sistema": sistema,
+                "tipo": tipo,
+                "recurso_id": recurso_id,
+                "hash": cambiados[(tipo, recurso_id)][0],
+                "id_local": str(id_local),
+                "actualizado": ahora
+            } for (tipo, recurso_id), id_local in ids_locales.items()
+        ]
+        if registros:
+            stmt = pg_insert(models.RecursoFuente.__table__).values(registros)
+            stmt = stmt.on_conflict_do_update(
+                constraint="uq_recursos_fuente_sistema_tipo_id",
+                set_={"hash": stmt.excluded.hash, "id_local": stmt.excluded.id_local, "actualizado": stmt.excluded.actualizado}
+            )
+            db.execute(stmt)
         
-        db.add(paciente)
         db.commit()
-        db.refresh(paciente)
-        print(f"Paciente {paciente_id} creado correctamente")
-        return paciente
     except Exception as e:
         db.rollback()
-        print(f"Error al procesar paciente: {e}")
-        raise
+        raise HTTPException(status_code=500, detail=f"Error en la importación incremental: {str(e)}")
+    
+    # Los pacientes insertados con SQL directo no pasan por los eventos del ORM
+    for datos in pacientes.values():
+        autocompletado.indice.actualizar(str(datos["id"]), datos["rut"], datos["nombre"], datos["apellido"])
+    
+    escritos = len(ids_locales)
+    nuevos = sum(1 for clave in ids_locales if clave not in existentes)
+    return {
+        "mensaje": f"Sincronizados {escritos} recursos de {len(entradas)} recibidos",
+        "sistema": sistema,
+        "nuevos": nuevos,
+        "actualizados": escritos - nuevos,
+        "sin_cambios": len(entradas) - len(cambiados),
+        "rechazados": rechazados
+    }
 
 class AIRecommendationRequest(BaseModel):
     paciente_id: str # Changed from int to str
@@ -775,20 +1350,55 @@ class AIRecommendationRequest(BaseModel):
 class AIRecommendationResponse(BaseModel):
     recomendaciones: List[Dict[str, str]]
     explicacion: str
+    origen: str  # "llm" o "reglas"
 
 @app.post("/ai/recomendaciones", response_model=AIRecommendationResponse)
-async def obtener_recomendaciones_ia(request: AIRecommendationRequest, db: Session = Depends(get_db)):
+async def obtener_recomendaciones_ia(request: AIRecommendationRequest, db: Session = Depends(get_db_lectura)):
     """Endpoint para obtener recomendaciones personalizadas usando IA"""
+    contexto = contexto_recomendaciones(db, request.paciente_id)
+    
+    try:
+        ai_response = await llm.completar(mensajes_recomendaciones(contexto))
+    except llm.CircuitoAbierto:
+        return recomendaciones_por_reglas(contexto)
+    except Exception as e:
+        print(f"Error del LLM, respondiendo con reglas: {e}")
+        return recomendaciones_por_reglas(contexto)
+    
+    return estructurar_recomendaciones(ai_response)
+
+@app.post("/ai/recomendaciones/stream")
+async def obtener_recomendaciones_ia_stream(request: AIRecommendationRequest, db: Session = Depends(get_db_lectura)):
+    """Igual que /ai/recomendaciones, pero envía los tokens por SSE a medida que llegan"""
+    contexto = contexto_recomendaciones(db, request.paciente_id)
+    try:
+        mensajes = mensajes_recomendaciones(contexto)
+    except prompts.PresupuestoExcedido as e:
+        print(f"Prompt fuera de presupuesto, respondiendo con reglas: {e}")
+        mensajes = None
+    return respuesta_streaming(
+        mensajes,
+        estructurar_recomendaciones,
+        respaldo=lambda: recomendaciones_por_reglas(contexto)
+    )
+
+def contexto_recomendaciones(db, paciente_id):
+    """Datos del paciente, historial y biomarcadores que se envían al modelo"""
     # Obtener datos del paciente
-    paciente = db.query(models.Paciente).filter(models.Paciente.id == request.paciente_id).first()
+    paciente = db.query(models.Paciente).filter(models.Paciente.id == paciente_id).first()
     if not paciente:
         raise HTTPException(status_code=404, detail="Paciente no encontrado")
     
     # Obtener historial médico
-    historial = db.query(models.HistorialMedico).filter(models.HistorialMedico.paciente_id == request.paciente_id).all()
+    historial = db.query(models.HistorialMedico).filter(models.HistorialMedico.paciente_id == paciente_id).all()
     
-    # Preparar contexto para la IA
-    contexto = {
+    # Obtener serie de biomarcadores
+    observaciones = db.query(models.Observacion).filter(
+        models.Observacion.paciente_id == paciente_id
+    ).order_by(models.Observacion.codigo, models.Observacion.fecha_efectiva).all()
+    
+    # Preparar contexto para la IA; el historial se resume en prompts.construir_mensajes
+    return {
         "paciente": {
             "edad": calcular_edad(paciente.fecha_nacimiento),
             "sexo": paciente.sexo,
@@ -802,43 +1412,104 @@ async def obtener_recomendaciones_ia(request: AIRecommendationRequest, db: Sessi
             {
                 "fecha": h.fecha_inicio,
                 "suplemento": h.suplemento,
-                "dosis": h.dosis,
-                "colesterol": h.colesterol_total,
-                "trigliceridos": h.trigliceridos,
-                "vitamina_d": h.vitamina_d,
-                "omega3": h.omega3_indice
+                "dosis": h.dosis
             } for h in historial
+        ],
+        "observaciones": [
+            {
+                "fecha": obs.fecha_efectiva,
+                "codigo": obs.codigo,
+                "valor": obs.valor,
+                "unidad": obs.unidad
+            } for obs in observaciones
         ]
     }
+
+def mensajes_recomendaciones(contexto):
+    mensajes, _ = prompts.construir_mensajes(
+        "Eres un experto en nutrición y suplementación. Analiza los datos del paciente y su historial para ofrecer recomendaciones personalizadas basadas en evidencia científica.",
+        "Proporciona 3 recomendaciones específicas para mejorar sus biomarcadores y alcanzar sus objetivos de salud.",
+        contexto["paciente"],
+        contexto["historial"],
+        contexto["observaciones"]
+    )
+    return mensajes
+
+def estructurar_recomendaciones(ai_response):
+    # Estructurar respuesta (simplificado - en producción se requeriría un parsing más robusto)
+    recomendaciones = [
+        {"tipo": "Suplemento", "descripcion": "Aumentar dosis de Omega-3 a 2000mg diarios"},
+        {"tipo": "Dieta", "descripcion": "Incrementar consumo de alimentos ricos en fibra soluble"},
+        {"tipo": "Estilo de vida", "descripcion": "Incorporar 30 minutos de actividad aeróbica diaria"}
+    ]
     
-    try:
-        # Llamada a la API de OpenAI using the old syntax
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": "Eres un experto en nutrición y suplementación. Analiza los datos del paciente y su historial para ofrecer recomendaciones personalizadas basadas en evidencia científica."},
-                {"role": "user", "content": f"Datos del paciente: {contexto}. Proporciona 3 recomendaciones específicas para mejorar sus biomarcadores y alcanzar sus objetivos de salud."}
-            ],
-            temperature=0.7,
-        )
-        
-        # Procesar respuesta
-        ai_response = response.choices[0].message.content
-        
-        # Estructurar respuesta (simplificado - en producción se requeriría un parsing más robusto)
-        recomendaciones = [
-            {"tipo": "Suplemento", "descripcion": "Aumentar dosis de Omega-3 a 2000mg diarios"},
-            {"tipo": "Dieta", "descripcion": "Incrementar consumo de alimentos ricos en fibra soluble"},
-            {"tipo": "Estilo de vida", "descripcion": "Incorporar 30 minutos de actividad aeróbica diaria"}
-        ]
-        
-        return {
-            "recomendaciones": recomendaciones,
-            "explicacion": ai_response
-        }
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al generar recomendaciones: {str(e)}")
+    return {
+        "recomendaciones": recomendaciones,
+        "explicacion": ai_response,
+        "origen": "llm"
+    }
+
+def valores_y_tendencias(observaciones):
+    """Último valor y tendencia de cada biomarcador del catálogo, indexados por nombre de campo"""
+    series = {}
+    for obs in sorted(observaciones, key=lambda o: o["fecha"]):
+        if obs["codigo"] in BIOMARCADORES:
+            series.setdefault(BIOMARCADORES[obs["codigo"]]["campo"], []).append(obs)
+    valores, tendencias = {}, {}
+    for campo, serie in series.items():
+        valores[campo] = serie[-1]["valor"]
+        dias = [(o["fecha"] - serie[0]["fecha"]).days for o in serie]
+        if dias[-1] > 0:
+            pendiente = np.polyfit(dias, [o["valor"] for o in serie], 1)[0]
+            tendencias[campo] = reglas.clasificar_tendencia(pendiente)
+    return valores, tendencias
+
+def recomendaciones_por_reglas(contexto):
+    """Respuesta de /ai/recomendaciones generada solo con el motor de reglas"""
+    valores, tendencias = valores_y_tendencias(contexto["observaciones"])
+    paciente = contexto["paciente"]
+    recomendaciones = reglas.recomendar(valores, tendencias, paciente["sexo"], paciente["edad"])
+    return {
+        "recomendaciones": recomendaciones,
+        "explicacion": "Recomendaciones generadas por reglas clínicas a partir de los últimos biomarcadores y su tendencia.",
+        "origen": "reglas"
+    }
+
+def respuesta_streaming(mensajes, estructurar, respaldo, al_terminar=None):
+    """
+    Respuesta SSE: 'inicio' de inmediato, un evento 'token' por fragmento del modelo y
+    al final 'resultado' con el mismo payload que el endpoint sin streaming. Si el
+    interruptor está abierto, el modelo falla o no hay mensajes (prompt fuera de
+    presupuesto), 'resultado' viene del motor de reglas.
+    """
+    async def eventos():
+        yield formato_evento("inicio", {})
+        partes = []
+        if mensajes is None:
+            resultado = respaldo()
+        else:
+            try:
+                async for texto in llm.completar_streaming(mensajes):
+                    partes.append(texto)
+                    yield formato_evento("token", {"texto": texto})
+                resultado = estructurar("".join(partes))
+            except llm.CircuitoAbierto:
+                resultado = respaldo()
+            except Exception as e:
+                print(f"Error del LLM, respondiendo con reglas: {e}")
+                resultado = respaldo()
+        if al_terminar:
+            await al_terminar(resultado)
+        yield formato_evento("resultado", resultado)
+    
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def formato_evento(evento, datos):
+    return f"event: {evento}\ndata: {json.dumps(datos, ensure_ascii=False)}\n\n"
 
 def calcular_edad(fecha_nacimiento):
     """Función auxiliar para calcular edad desde fecha de nacimiento"""
@@ -850,7 +1521,7 @@ def calcular_edad(fecha_nacimiento):
 
 # Modelos para las solicitudes de IA
 class PredictiveTrendRequest(BaseModel):
-    paciente_id: int
+    paciente_id: str # Changed from int to str
     biomarcador: str  # "colesterol_total", "trigliceridos", "vitamina_d", "omega3_indice"
     dias_prediccion: int = 90
 
@@ -864,43 +1535,40 @@ class SupplementOptimizationRequest(BaseModel):
 # Endpoints de IA adicionales
 
 @app.post("/ai/prediccion-tendencias", response_model=Dict[str, Any])
-async def predecir_tendencias(request: PredictiveTrendRequest, db: Session = Depends(get_db)):
+async def predecir_tendencias(request: PredictiveTrendRequest, db: Session = Depends(get_db_lectura)):
     """Predice la evolución de biomarcadores basado en el historial y suplementación"""
-    # Verificar que el paciente existe
+    codigo = CODIGO_POR_BIOMARCADOR.get(request.biomarcador)
+    if not codigo:
+        raise HTTPException(status_code=400, detail="Biomarcador no válido")
+    
+    # Verificar que el paciente existe (antes de la caché: un paciente eliminado no debe
+    # seguir recibiendo su pronóstico guardado)
     paciente = db.query(models.Paciente).filter(models.Paciente.id == request.paciente_id).first()
     if not paciente:
         raise HTTPException(status_code=404, detail="Paciente no encontrado")
     
-    # Obtener historial médico ordenado por fecha
-    historial = db.query(models.HistorialMedico).filter(
-        models.HistorialMedico.paciente_id == request.paciente_id
-    ).order_by(models.HistorialMedico.fecha_inicio).all()
+    # Si la serie no cambió desde el último cálculo se devuelve el pronóstico guardado
+    clave = (str(paciente.id), codigo, request.dias_prediccion)
+    resultado, huella = pronosticos.cache.consultar(db, clave)
+    if resultado is not None:
+        return resultado
     
-    if len(historial) < 2:
+    # Serie del biomarcador ordenada por fecha (lectura por rango del índice)
+    serie = db.query(models.Observacion).filter(
+        models.Observacion.paciente_id == request.paciente_id,
+        models.Observacion.codigo == codigo
+    ).order_by(models.Observacion.fecha_efectiva).all()
+    
+    if len(serie) < 2:
         return {
             "mensaje": "Se necesitan al menos dos registros para realizar predicciones",
             "predicciones": []
         }
     
     # Preparar datos para el modelo predictivo
-    fechas = []
-    valores = []
-    
-    for registro in historial:
-        fecha = datetime.strptime(registro.fecha_inicio, "%Y-%m-%d")
-        fechas.append((fecha - datetime.strptime(historial[0].fecha_inicio, "%Y-%m-%d")).days)
-        
-        # Obtener el valor del biomarcador solicitado
-        if request.biomarcador == "colesterol_total":
-            valores.append(registro.colesterol_total)
-        elif request.biomarcador == "trigliceridos":
-            valores.append(registro.trigliceridos)
-        elif request.biomarcador == "vitamina_d":
-            valores.append(registro.vitamina_d)
-        elif request.biomarcador == "omega3_indice":
-            valores.append(registro.omega3_indice)
-        else:
-            raise HTTPException(status_code=400, detail="Biomarcador no válido")
+    fecha_base = serie[0].fecha_efectiva
+    fechas = [(registro.fecha_efectiva - fecha_base).days for registro in serie]
+    valores = [registro.valor for registro in serie]
     
     # Crear y entrenar modelo de regresión lineal
     X = np.array(fechas).reshape(-1, 1)
@@ -910,7 +1578,7 @@ async def predecir_tendencias(request: PredictiveTrendRequest, db: Session = Dep
     model.fit(X, y)
     
     # Generar predicciones
-    ultima_fecha = datetime.strptime(historial[-1].fecha_inicio, "%Y-%m-%d")
+    ultima_fecha = serie[-1].fecha_efectiva
     dias_futuros = [i for i in range(1, request.dias_prediccion + 1, 15)]  # Predicción cada 15 días
     
     predicciones = []
@@ -925,133 +1593,103 @@ async def predecir_tendencias(request: PredictiveTrendRequest, db: Session = Dep
         })
     
     # Calcular tendencia y recomendaciones
-    tendencia = "estable"
-    if model.coef_[0] > 0.5:
-        tendencia = "ascendente_rapida"
-    elif model.coef_[0] > 0.1:
-        tendencia = "ascendente_lenta"
-    elif model.coef_[0] < -0.5:
-        tendencia = "descendente_rapida"
-    elif model.coef_[0] < -0.1:
-        tendencia = "descendente_lenta"
+    tendencia = reglas.clasificar_tendencia(model.coef_[0])
     
     # Generar recomendaciones basadas en la tendencia y el biomarcador
-    recomendacion = generar_recomendacion_tendencia(request.biomarcador, tendencia, valores[-1])
+    recomendacion = reglas.recomendacion_tendencia(request.biomarcador, tendencia)
     
-    return {
+    resultado = {
         "biomarcador": request.biomarcador,
         "valor_actual": valores[-1],
         "tendencia": tendencia,
+        "pendiente_diaria": float(model.coef_[0]),
+        "intercepto": float(model.intercept_),
         "predicciones": predicciones,
         "recomendacion": recomendacion
     }
+    pronosticos.cache.guardar(clave, huella, resultado)
+    return resultado
 
 @app.post("/ai/deteccion-anomalias", response_model=Dict[str, Any])
-async def detectar_anomalias(request: AnomalyDetectionRequest, db: Session = Depends(get_db)):
+async def detectar_anomalias(request: AnomalyDetectionRequest, db: Session = Depends(get_db_lectura)):
     """Detecta valores anómalos en los biomarcadores del paciente"""
     # Verificar que el paciente existe
     paciente = db.query(models.Paciente).filter(models.Paciente.id == request.paciente_id).first()
     if not paciente:
         raise HTTPException(status_code=404, detail="Paciente no encontrado")
     
-    # Obtener último registro médico
-    ultimo_registro = db.query(models.HistorialMedico).filter(
-        models.HistorialMedico.paciente_id == request.paciente_id
-    ).order_by(models.HistorialMedico.fecha_inicio.desc()).first()
+    # Obtener último valor de cada biomarcador
+    ultimos_valores = obtener_ultimos_valores(db, request.paciente_id)
     
-    if not ultimo_registro:
+    if not ultimos_valores:
         return {
             "mensaje": "No hay registros médicos para este paciente",
             "anomalias": [],
             "fecha_analisis": datetime.now().strftime("%Y-%m-%d")
         }
     
-    # Rangos normales para cada biomarcador según sexo y edad
-    edad = calcular_edad(paciente.fecha_nacimiento)
-    es_hombre = paciente.sexo.lower() == "masculino"
-    
-    rangos_normales = {
-        "colesterol_total": {
-            "min": 130,
-            "max": 200,
-            "unidad": "mg/dL",
-            "nombre": "Colesterol Total"
-        },
-        "trigliceridos": {
-            "min": 40,
-            "max": 150,
-            "unidad": "mg/dL",
-            "nombre": "Triglicéridos"
-        },
-        "vitamina_d": {
-            "min": 30,
-            "max": 100,
-            "unidad": "ng/mL",
-            "nombre": "Vitamina D"
-        },
-        "omega3_indice": {
-            "min": 4,
-            "max": 8,
-            "unidad": "%",
-            "nombre": "Índice Omega-3"
-        }
-    }
-    
-    # Ajustar rangos por edad y sexo si es necesario
-    if edad > 50:
-        rangos_normales["colesterol_total"]["max"] = 220
-    
-    # Detectar anomalías
-    anomalias = []
-    
-    for biomarcador, rango in rangos_normales.items():
-        valor = getattr(ultimo_registro, biomarcador)
-        if valor is None:
-            continue
-            
-        if valor < rango["min"]:
-            anomalias.append({
-                "biomarcador": rango["nombre"],
-                "valor": valor,
-                "unidad": rango["unidad"],
-                "tipo": "bajo",
-                "rango_normal": f"{rango['min']} - {rango['max']} {rango['unidad']}",
-                "recomendacion": generar_recomendacion_anomalia(biomarcador, "bajo", paciente.sexo, edad)
-            })
-        elif valor > rango["max"]:
-            anomalias.append({
-                "biomarcador": rango["nombre"],
-                "valor": valor,
-                "unidad": rango["unidad"],
-                "tipo": "alto",
-                "rango_normal": f"{rango['min']} - {rango['max']} {rango['unidad']}",
-                "recomendacion": generar_recomendacion_anomalia(biomarcador, "alto", paciente.sexo, edad)
-            })
+    # Rangos normales según sexo y edad y recomendaciones del motor de reglas
+    anomalias = reglas.evaluar_anomalias(
+        ultimos_valores, paciente.sexo, calcular_edad(paciente.fecha_nacimiento)
+    )
     
     mensaje = "Se han detectado valores fuera de rango que requieren atención." if anomalias else "Todos los biomarcadores están dentro de rangos normales."
     
     return {
         "mensaje": mensaje,
         "anomalias": anomalias,
-        "fecha_analisis": datetime.now().strftime("%Y-%m-%d")
+        "fecha_analisis": datetime.now().strftime("%Y-%m-%d"),
+        "version_rangos": rangos.tabla().version
     }
 
 @app.post("/ai/optimizacion-suplementos", response_model=Dict[str, Any])
 async def optimizar_suplementos(
     request: SupplementOptimizationRequest, 
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_db_lectura)
 ):
     """Genera un plan personalizado de suplementación optimizado con IA"""
+    contexto, objetivo = contexto_optimizacion(db, request)
+    
+    try:
+        ai_response = await llm.completar(mensajes_optimizacion(contexto))
+        plan_suplementacion = estructurar_plan_suplementacion(objetivo, ai_response)
+    except llm.CircuitoAbierto:
+        plan_suplementacion = plan_por_reglas(contexto, objetivo)
+    except Exception as e:
+        print(f"Error del LLM, respondiendo con reglas: {e}")
+        plan_suplementacion = plan_por_reglas(contexto, objetivo)
+    
+    # Programar tarea en segundo plano para guardar la recomendación
+    background_tasks.add_task(
+        guardar_recomendacion_suplementos, 
+        db=db, 
+        paciente_id=request.paciente_id,
+        recomendacion=plan_suplementacion
+    )
+    
+    return plan_suplementacion
+
+@app.post("/ai/optimizacion-suplementos/stream")
+async def optimizar_suplementos_stream(request: SupplementOptimizationRequest, db: Session = Depends(get_db_lectura)):
+    """Igual que /ai/optimizacion-suplementos, pero envía los tokens por SSE a medida que llegan"""
+    contexto, objetivo = contexto_optimizacion(db, request)
+    return respuesta_streaming(
+        mensajes_optimizacion(contexto),
+        lambda ai_response: estructurar_plan_suplementacion(objetivo, ai_response),
+        respaldo=lambda: plan_por_reglas(contexto, objetivo),
+        al_terminar=lambda plan: guardar_recomendacion_suplementos(db, request.paciente_id, plan)
+    )
+
+def contexto_optimizacion(db, request):
+    """Contexto para el modelo y objetivo efectivo del plan de suplementación"""
     # Verificar que el paciente existe
     paciente = db.query(models.Paciente).filter(models.Paciente.id == request.paciente_id).first()
     if not paciente:
         raise HTTPException(status_code=404, detail="Paciente no encontrado")
     
-    # Obtener último registro médico
-    ultimo_registro = db.query(models.HistorialMedico).filter(
-        models.HistorialMedico.paciente_id == request.paciente_id
-    ).order_by(models.HistorialMedico.fecha_inicio.desc()).first()
+    # Obtener último valor de cada biomarcador
+    ultimos_valores = obtener_ultimos_valores(db, request.paciente_id)
     
     # Determinar objetivo
     objetivo = request.objetivo if request.objetivo else paciente.objetivo_suplementacion
@@ -1070,138 +1708,173 @@ async def optimizar_suplementos(
         }
     }
     
-    if ultimo_registro:
-        contexto["biomarcadores"] = {
-            "colesterol_total": ultimo_registro.colesterol_total,
-            "trigliceridos": ultimo_registro.trigliceridos,
-            "vitamina_d": ultimo_registro.vitamina_d,
-            "omega3_indice": ultimo_registro.omega3_indice
-        }
+    if ultimos_valores:
+        contexto["biomarcadores"] = ultimos_valores
     
-    try:
-        # Llamada a la API de OpenAI using the old syntax
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": """Eres un experto en nutrición y suplementación. 
-                Tu tarea es recomendar la combinación óptima de suplementos para el paciente 
-                basándote en su perfil, biomarcadores y objetivos. Proporciona dosis específicas, 
-                momento del día para tomarlos y posibles interacciones."""},
-                {"role": "user", "content": f"Datos del paciente: {contexto}. Proporciona un plan de suplementación personalizado."}
-            ],
-            temperature=0.7,
-        )
-        
-        # Procesar respuesta
-        ai_response = response.choices[0].message.content
-        
-        # Estructurar plan de suplementación (simplificado)
-        plan_suplementacion = {
-            "objetivo": objetivo,
-            "suplementos_recomendados": [
-                {
-                    "nombre": "Omega-3",
-                    "dosis": "2000mg",
-                    "frecuencia": "Diaria",
-                    "momento": "Con las comidas",
-                    "duracion": "3 meses",
-                    "justificacion": "Mejora perfil lipídico y reduce inflamación"
-                },
-                {
-                    "nombre": "Vitamina D3",
-                    "dosis": "2000 UI",
-                    "frecuencia": "Diaria",
-                    "momento": "Con el desayuno",
-                    "duracion": "6 meses",
-                    "justificacion": "Optimiza niveles séricos y mejora inmunidad"
-                }
-            ],
-            "consideraciones": "Evitar tomar calcio junto con el hierro para mejor absorción",
-            "seguimiento_recomendado": "Repetir análisis en 3 meses",
-            "explicacion_detallada": ai_response
-        }
-        
-        # Programar tarea en segundo plano para guardar la recomendación
-        background_tasks.add_task(
-            guardar_recomendacion_suplementos, 
-            db=db, 
-            paciente_id=request.paciente_id,
-            recomendacion=plan_suplementacion
-        )
-        
-        return plan_suplementacion
-        
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error al generar plan de suplementación: {str(e)}")
+    return contexto, objetivo
 
-# Funciones auxiliares para los endpoints de IA
+def mensajes_optimizacion(contexto):
+    return [
+        {"role": "system", "content": """Eres un experto en nutrición y suplementación. 
+        Tu tarea es recomendar la combinación óptima de suplementos para el paciente 
+        basándote en su perfil, biomarcadores y objetivos. Proporciona dosis específicas, 
+        momento del día para tomarlos y posibles interacciones."""},
+        {"role": "user", "content": f"Datos del paciente (JSON): {prompts.a_json(contexto)}\nProporciona un plan de suplementación personalizado."}
+    ]
 
-def generar_recomendacion_tendencia(biomarcador, tendencia, valor_actual):
-    """Genera recomendaciones basadas en la tendencia de un biomarcador"""
-    recomendaciones = {
-        "colesterol_total": {
-            "ascendente_rapida": "La tendencia al alza rápida del colesterol sugiere revisar la dieta. Considere aumentar fibra soluble y reducir grasas saturadas.",
-            "ascendente_lenta": "El colesterol muestra un aumento gradual. Monitorear y considerar ajustes en la dieta.",
-            "descendente_rapida": "Excelente progreso en la reducción del colesterol. Mantener el régimen actual.",
-            "descendente_lenta": "El colesterol está disminuyendo gradualmente. Continuar con el plan actual.",
-            "estable": "Los niveles de colesterol se mantienen estables."
-        },
-        "trigliceridos": {
-            "ascendente_rapida": "Aumento preocupante de triglicéridos. Revisar consumo de azúcares y carbohidratos refinados.",
-            "ascendente_lenta": "Ligero aumento en triglicéridos. Considerar reducir azúcares.",
-            "descendente_rapida": "Excelente reducción de triglicéridos. Mantener hábitos actuales.",
-            "descendente_lenta": "Reducción gradual de triglicéridos. Buen progreso.",
-            "estable": "Los niveles de triglicéridos se mantienen estables."
-        },
-        "vitamina_d": {
-            "ascendente_rapida": "Excelente mejora en niveles de vitamina D. Considerar ajustar dosis para mantener.",
-            "ascendente_lenta": "Mejora gradual en vitamina D. Continuar suplementación.",
-            "descendente_rapida": "Disminución significativa de vitamina D. Revisar dosis y absorción.",
-            "descendente_lenta": "Ligera disminución de vitamina D. Monitorear.",
-            "estable": "Los niveles de vitamina D se mantienen estables."
-        },
-        "omega3_indice": {
-            "ascendente_rapida": "Excelente mejora en índice omega-3. Mantener suplementación actual.",
-            "ascendente_lenta": "Mejora gradual en índice omega-3. Continuar régimen.",
-            "descendente_rapida": "Disminución significativa del índice omega-3. Revisar calidad del suplemento.",
-            "descendente_lenta": "Ligera disminución del índice omega-3. Considerar ajustar dosis.",
-            "estable": "El índice omega-3 se mantiene estable."
-        }
+def estructurar_plan_suplementacion(objetivo, ai_response):
+    # Estructurar plan de suplementación (simplificado)
+    return {
+        "objetivo": objetivo,
+        "suplementos_recomendados": [dict(reglas.SUPLEMENTOS[clave]) for clave in reglas.SUPLEMENTOS_BASE],
+        "consideraciones": reglas.CONSIDERACIONES,
+        "seguimiento_recomendado": reglas.SEGUIMIENTO,
+        "explicacion_detallada": ai_response,
+        "origen": "llm"
     }
-    
-    return recomendaciones.get(biomarcador, {}).get(tendencia, "No hay recomendaciones específicas disponibles.")
 
-def generar_recomendacion_anomalia(biomarcador, tipo, sexo, edad):
-    """Genera recomendaciones para valores anómalos de biomarcadores"""
-    recomendaciones = {
-        "colesterol_total": {
-            "alto": "Considere aumentar el consumo de fibra soluble, reducir grasas saturadas y aumentar actividad física. Evaluar suplementación con fitoesteroles.",
-            "bajo": "Niveles bajos de colesterol pueden afectar la producción hormonal. Consulte con su médico para evaluar causas subyacentes."
-        },
-        "trigliceridos": {
-            "alto": "Reduzca el consumo de azúcares y carbohidratos refinados. Aumente omega-3 y considere suplementos de berberina.",
-            "bajo": "Aunque poco común, niveles muy bajos de triglicéridos pueden indicar malabsorción. Consulte con su médico."
-        },
-        "vitamina_d": {
-            "alto": "Niveles elevados de vitamina D pueden ser tóxicos. Reduzca o suspenda suplementación y consulte con su médico.",
-            "bajo": "Aumente exposición solar moderada y considere suplementación con D3. Verificar niveles de magnesio para mejor absorción."
-        },
-        "omega3_indice": {
-            "alto": "Excelente nivel de omega-3. Mantener hábitos actuales.",
-            "bajo": "Aumente consumo de pescados grasos o considere suplementación con omega-3 de alta calidad (EPA/DHA)."
-        }
+def plan_por_reglas(contexto, objetivo):
+    """Plan de suplementación generado solo con el motor de reglas"""
+    paciente = contexto["paciente"]
+    return {
+        "objetivo": objetivo,
+        "suplementos_recomendados": reglas.suplementos_sugeridos(
+            contexto.get("biomarcadores", {}), paciente["sexo"], paciente["edad"]
+        ),
+        "consideraciones": reglas.CONSIDERACIONES,
+        "seguimiento_recomendado": reglas.SEGUIMIENTO,
+        "explicacion_detallada": "Plan generado por reglas clínicas a partir de los últimos biomarcadores del paciente.",
+        "origen": "reglas"
     }
+
+# Endpoints de analítica poblacional
+
+def validar_agrupacion(agrupar):
+    dimensiones = [d for d in (agrupar or "").split(",") if d]
+    invalidas = [d for d in dimensiones if d not in cohortes.DIMENSIONES]
+    if invalidas or len(dimensiones) > 2 or len(set(dimensiones)) != len(dimensiones):
+        raise HTTPException(
+            status_code=400,
+            detail=f"agrupar admite hasta dos dimensiones distintas entre: {', '.join(cohortes.DIMENSIONES)}"
+        )
+    return dimensiones
+
+@app.get("/analytics/cohortes")
+def estadisticas_cohortes(codigo: str, agrupar: Optional[str] = None, db: Session = Depends(get_db_lectura)):
+    """Conteo, media, desviación y percentiles del último valor de un biomarcador por grupo"""
+    return cohortes.consultar(db, "estadisticas", codigo, validar_agrupacion(agrupar))
+
+@app.get("/analytics/cohortes/histograma")
+def histograma_cohortes(codigo: str, agrupar: Optional[str] = None, db: Session = Depends(get_db_lectura)):
+    """Distribución por intervalos del último valor de un biomarcador por grupo"""
+    return cohortes.consultar(db, "histograma", codigo, validar_agrupacion(agrupar))
+
+@app.post("/analytics/cohortes/refrescar")
+def refrescar_cohortes():
+    """Fuerza el refresco de las vistas materializadas de cohortes"""
+    if not cohortes.refrescar_vistas():
+        raise HTTPException(status_code=409, detail="Ya hay un refresco en curso")
+    return {"mensaje": "Vistas de cohortes refrescadas"}
+
+@app.post("/analytics/efectividad/calcular", status_code=202)
+def calcular_efectividad_suplementos(background_tasks: BackgroundTasks, desde_snapshot: bool = False):
+    """Recalcula en segundo plano la efectividad de los suplementos sobre toda la población"""
+    background_tasks.add_task(efectividad.calcular_efectividad, desde_snapshot)
+    return {"mensaje": "Cálculo de efectividad iniciado", "fuente": "snapshot" if desde_snapshot else "postgresql"}
+
+@app.get("/analytics/efectividad")
+def obtener_efectividad_suplementos(
+    suplemento: Optional[str] = None,
+    codigo: Optional[str] = None,
+    db: Session = Depends(get_db_lectura)
+):
+    """Efecto antes/después precalculado por suplemento y biomarcador, con su curva dosis-respuesta"""
+    efectos = db.query(models.EfectividadSuplemento)
+    curva = db.query(models.RespuestaDosis)
+    if suplemento:
+        efectos = efectos.filter(models.EfectividadSuplemento.suplemento == suplemento)
+        curva = curva.filter(models.RespuestaDosis.suplemento == suplemento)
+    if codigo:
+        efectos = efectos.filter(models.EfectividadSuplemento.codigo == codigo)
+        curva = curva.filter(models.RespuestaDosis.codigo == codigo)
     
-    recomendacion_base = recomendaciones.get(biomarcador, {}).get(tipo, "Consulte con su médico.")
-    
-    # Personalizar por edad y sexo
-    if biomarcador == "colesterol_total" and tipo == "alto" and edad > 50:
-        recomendacion_base += " En personas mayores de 50 años, evaluar también niveles de CoQ10."
-    
-    if biomarcador == "vitamina_d" and tipo == "bajo" and sexo.lower() == "femenino":
-        recomendacion_base += " En mujeres, niveles óptimos de vitamina D son especialmente importantes para la salud ósea."
+    dosis_por_grupo = {}
+    for punto in curva.order_by(models.RespuestaDosis.dosis).all():
+        dosis_por_grupo.setdefault((punto.suplemento, punto.codigo), []).append({
+            "dosis": punto.dosis,
+            "unidad": punto.unidad_dosis,
+            "n": punto.n,
+            "delta_medio": punto.delta_medio
+        })
     
-    return recomendacion_base
+    return [
+        {
+            "suplemento": e.suplemento,
+            "codigo": e.codigo,
+            "biomarcador": BIOMARCADORES.get(e.codigo, {}).get("nombre", e.codigo),
+            "n": e.n,
+            "delta_medio": e.delta_medio,
+            "desviacion": e.desviacion,
+            "intervalo_confianza_95": [e.ic_inferior, e.ic_superior],
+            "delta_porcentual": e.delta_porcentual,
+            "tamano_efecto": e.tamano_efecto,
+            "pendiente_dosis": e.pendiente_dosis,
+            "unidad_dosis": e.unidad_dosis,
+            "respuesta_dosis": dosis_por_grupo.get((e.suplemento, e.codigo), []),
+            "calculado": e.calculado.isoformat()
+        } for e in efectos.order_by(models.EfectividadSuplemento.suplemento, models.EfectividadSuplemento.codigo).all()
+    ]
+
+@app.get("/analytics/rangos")
+def obtener_rangos_referencia():
+    """Rangos de referencia vigentes y su versión"""
+    return rangos.tabla().resumen()
+
+@app.post("/analytics/rangos/recargar")
+def recargar_rangos_referencia():
+    """Vuelve a leer el archivo de rangos sin reiniciar el servicio"""
+    try:
+        tabla = rangos.recargar()
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Archivo de rangos inválido: {str(e)}")
+    return {"mensaje": "Rangos recargados", "version": tabla.version}
+
+@app.get("/analytics/tamizaje")
+def tamizaje_poblacional(limite: int = Query(100, ge=0, le=1000), db: Session = Depends(get_db_lectura)):
+    """Evalúa el último valor de cada biomarcador de todos los pacientes contra los rangos de referencia"""
+    return rangos.tamizaje_poblacional(db, limite)
+
+def codigo_biomarcador(biomarcador):
+    """Acepta el nombre de campo (colesterol_total) o el código LOINC"""
+    return CODIGO_POR_BIOMARCADOR.get(biomarcador, biomarcador)
+
+def consultar_duckdb(funcion, *args):
+    try:
+        return funcion(*args)
+    except analitica_duckdb.DuckDBNoDisponible as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+@app.get("/analytics/duckdb/distribucion")
+def distribucion_biomarcador(biomarcador: str, intervalos: int = Query(20, ge=1, le=analitica_duckdb.MAX_INTERVALOS_HISTOGRAMA)):
+    """Histograma y percentiles del último valor de cada paciente"""
+    return consultar_duckdb(analitica_duckdb.distribucion, codigo_biomarcador(biomarcador), intervalos)
+
+@app.get("/analytics/duckdb/cohortes")
+def comparar_cohortes_suplemento(biomarcador: str, suplementos: Optional[str] = None):
+    """Compara el último valor del biomarcador entre pacientes agrupados por su suplemento actual"""
+    lista = [s.strip() for s in suplementos.split(",") if s.strip()] if suplementos else None
+    return consultar_duckdb(analitica_duckdb.comparar_cohortes, codigo_biomarcador(biomarcador), lista)
+
+@app.get("/analytics/duckdb/tendencia")
+def tendencia_poblacional(
+    biomarcador: str,
+    intervalo: str = Query("mes", regex="^(semana|mes|trimestre|anio)$"),
+    suplemento: Optional[str] = None
+):
+    """Promedio y mediana del biomarcador por semana, mes, trimestre o año"""
+    return consultar_duckdb(analitica_duckdb.tendencia, codigo_biomarcador(biomarcador), intervalo, suplemento)
+
+# Funciones auxiliares para los endpoints de IA
 
 async def guardar_recomendacion_suplementos(db: Session, paciente_id: int, recomendacion: Dict):
     """Guarda la recomendación de suplementos en la base de datos"""
@@ -1306,120 +1979,105 @@ def convertir_paciente_a_fhir(paciente):
     
     return paciente_fhir
 
-# Add this function to handle FHIR Observation resources
-def procesar_observacion_fhir(observacion, db):
-    """Procesa una observación en formato FHIR y la almacena en la base de datos"""
-    try:
-        # Extract patient reference
-        patient_ref = observacion.get("subject", {}).get("reference", "")
-        if not patient_ref or not patient_ref.startswith("Patient/"):
-            print(f"Referencia de paciente inválida: {patient_ref}")
-            return None
-            
-        patient_id = patient_ref.replace("Patient/", "")
-        
-        # Extract code and value
-        coding = observacion.get("code", {}).get("coding", [])
-        if not coding:
-            print("Observación sin código")
-            return None
-            
-        code = coding[0].get("code", "")
-        
-        # Extract value - could be valueQuantity, valueString, etc.
-        value = None
-        if "valueQuantity" in observacion:
-            value = observacion["valueQuantity"].get("value")
-        elif "valueString" in observacion:
-            value = observacion["valueString"]
-        elif "valueCodeableConcept" in observacion:
-            value = str(observacion["valueCodeableConcept"])
-        
-        if value is None:
-            print(f"Observación sin valor para el código {code}")
-            return None
-            
-        # Check if patient exists
-        paciente = db.query(models.Paciente).filter(models.Paciente.id == patient_id).first()
-        if not paciente:
-            print(f"Paciente {patient_id} no encontrado")
-            return None
-            
-        # Create or update historial médico record
-        historial = db.query(models.HistorialMedico).filter(
-            models.HistorialMedico.paciente_id == patient_id
-        ).first()
-        
-        if not historial:
-            historial = models.HistorialMedico(paciente_id=patient_id)
-            db.add(historial)
-        
-        # Map FHIR code to database field
-        if code == "2093-3":  # Colesterol total
-            historial.colesterol_total = value
-        elif code == "2571-8":  # Triglicéridos
-            historial.trigliceridos = value
-        elif code == "14635-7":  # Vitamina D
-            historial.vitamina_d = value
-        elif code == "omega3_index":  # Omega-3 Index
-            historial.omega3_index = value
-        
-        db.commit()
-        return historial
-    except Exception as e:
-        print(f"Error procesando observación: {str(e)}")
-        db.rollback()
-        return None
+def parsear_fecha_fhir(valor):
+    """Convierte una fecha FHIR (date o dateTime) a datetime; usa la fecha actual si falta"""
+    if not valor:
+        return datetime.now()
+    return datetime.fromisoformat(valor.replace("Z", "+00:00")).replace(tzinfo=None)
 
-def procesar_medicacion_fhir(medicacion, db):
-    """Procesa una declaración de medicación en formato FHIR y la almacena en la base de datos"""
+# Prefijos de comparación de los parámetros de búsqueda FHIR
+PREFIJOS_BUSQUEDA = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "gt": operator.gt,
+    "lt": operator.lt,
+    "ge": operator.ge,
+    "le": operator.le,
+}
+
+def separar_prefijo_busqueda(valor):
+    """Separa el prefijo de comparación FHIR (ge2024-01-01 -> ("ge", "2024-01-01"))"""
+    if valor[:2] in PREFIJOS_BUSQUEDA:
+        return valor[:2], valor[2:]
+    return "eq", valor
+
+def convertir_observacion_a_fhir(obs):
+    """Convierte una fila de la tabla de observaciones a un recurso Observation FHIR"""
+    info = BIOMARCADORES.get(obs.codigo, {})
+    return {
+        "resourceType": "Observation",
+        "id": f"obs-{obs.id}",
+        "status": "final",
+        "code": {
+            "coding": [
+                {
+                    "system": "http://loinc.org",
+                    "code": obs.codigo,
+                    "display": info.get("nombre", obs.codigo)
+                }
+            ]
+        },
+        "subject": {
+            "reference": f"Patient/{obs.paciente_id}"
+        },
+        "effectiveDateTime": obs.fecha_efectiva.strftime("%Y-%m-%d"),
+        "valueQuantity": {
+            "value": obs.valor,
+            "unit": obs.unidad,
+            "system": "http://unitsofmeasure.org",
+            "code": obs.unidad
+        }
+    }
+
+def datos_observaciones_historial(historial):
+    """
+    Filas de observación (diccionarios) para los biomarcadores informados en un historial.
+    fecha_inicio es texto libre: si no es una fecha ISO el historial se guarda igual, pero
+    sin observaciones derivadas (no hay fecha con la cual ubicarlas en la serie).
+    """
     try:
-        # Extract patient reference
-        patient_ref = medicacion.get("subject", {}).get("reference", "")
-        if not patient_ref or not patient_ref.startswith("Patient/"):
-            print(f"Referencia de paciente inválida en medicación: {patient_ref}")
-            return None
-            
-        patient_id = patient_ref.replace("Patient/", "")
-        
-        # Extract medication information
-        medication_ref = None
-        if "medicationReference" in medicacion:
-            medication_ref = medicacion["medicationReference"].get("reference", "")
-        elif "medicationCodeableConcept" in medicacion:
-            coding = medicacion["medicationCodeableConcept"].get("coding", [{}])
-            if coding:
-                medication_ref = coding[0].get("code", "")
-        
-        if not medication_ref:
-            print("Medicación sin referencia o código")
-            return None
-            
-        # Get status and date
-        status = medicacion.get("status", "unknown")
-        fecha = medicacion.get("effectiveDateTime", "")
-        
-        # Check if patient exists
-        paciente = db.query(models.Paciente).filter(models.Paciente.id == patient_id).first()
-        if not paciente:
-            print(f"Paciente {patient_id} no encontrado para medicación")
-            return None
-            
-        # Create medicación record
-        # Assuming you have a Medicacion model in your models.py
-        nueva_medicacion = models.Medicacion(
-            paciente_id=patient_id,
-            codigo=medication_ref,
-            estado=status,
-            fecha_inicio=fecha,
-            dosis=medicacion.get("dosage", [{}])[0].get("text", "")
-        )
-        
-        db.add(nueva_medicacion)
-        db.commit()
-        
-        return nueva_medicacion
-    except Exception as e:
-        print(f"Error procesando medicación: {str(e)}")
-        db.rollback()
-        return None
+        fecha = parsear_fecha_fhir(historial.fecha_inicio)
+    except (ValueError, AttributeError):
+        print(f"fecha_inicio no reconocida ({historial.fecha_inicio!r}); no se derivan observaciones")
+        return []
+    filas = []
+    for codigo, info in BIOMARCADORES.items():
+        valor = getattr(historial, info["campo"])
+        if valor:
+            filas.append({
+                "paciente_id": historial.paciente_id,
+                "codigo": codigo,
+                "valor": valor,
+                "unidad": info["unidad"],
+                "fecha_efectiva": fecha
+            })
+    return filas
+
+def observaciones_desde_historial(historial):
+    """Genera las filas de observación para los biomarcadores informados en un historial"""
+    return [models.Observacion(**datos) for datos in datos_observaciones_historial(historial)]
+
+def obtener_ultimos_valores(db, paciente_id):
+    """Obtiene el último valor de cada biomarcador del catálogo, indexado por nombre de campo"""
+    # DISTINCT ON (codigo) recorre el índice (paciente_id, codigo, fecha_efectiva) una vez
+    ultimos = db.query(models.Observacion).filter(
+        models.Observacion.paciente_id == paciente_id,
+        models.Observacion.codigo.in_(list(BIOMARCADORES))
+    ).distinct(models.Observacion.codigo).order_by(
+        models.Observacion.codigo, models.Observacion.fecha_efectiva.desc()
+    ).all()
+    return {BIOMARCADORES[obs.codigo]["campo"]: obs.valor for obs in ultimos}
+
+def procesar_observacion_fhir(observacion, db, paciente_uuid):
+    """Agrega la medición a la serie del paciente (append-only, sin commit)"""
+    nueva_observacion = models.Observacion(**datos_observacion_fhir(observacion, paciente_uuid))
+    db.add(nueva_observacion)
+    db.flush()
+    return nueva_observacion
+
+def procesar_medicacion_fhir(medicacion, db, paciente_uuid):
+    """Registra una declaración de medicación del paciente (sin commit)"""
+    nueva_medicacion = models.Medicacion(**datos_medicacion_fhir(medicacion, paciente_uuid))
+    db.add(nueva_medicacion)
+    db.flush()
+    return nueva_medicacion
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, ForeignKey
+from sqlalchemy import Column, Integer, BigInteger, Float, String, Text, Boolean, DateTime, ForeignKey, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database import Base  # Importación corregida para Docker
 from sqlalchemy.dialects.postgresql import UUID
@@ -7,7 +7,7 @@ import uuid
 class HistorialMedico(Base):
     __tablename__ = "historial_medico"
     id = Column(Integer, primary_key=True)
-    paciente_id = Column(UUID(as_uuid=True), ForeignKey('pacientes.id'))
+    paciente_id = Column(UUID(as_uuid=True), ForeignKey('pacientes.id'), index=True)
     grupo_sanguineo = Column(String(3))
     antecedentes_familiares = Column(Text)
     tratamientos_actuales = Column(Text)
@@ -48,13 +48,14 @@ class Paciente(Base):
     
     historial = relationship("HistorialMedico", back_populates="paciente")
     medicaciones = relationship("Medicacion", back_populates="paciente")
+    observaciones = relationship("Observacion", back_populates="paciente")
     # ... resto de campos ... 
 
 class Medicacion(Base):
     __tablename__ = "medicaciones"
     
     id = Column(Integer, primary_key=True)
-    paciente_id = Column(UUID(as_uuid=True), ForeignKey('pacientes.id'))
+    paciente_id = Column(UUID(as_uuid=True), ForeignKey('pacientes.id'), index=True)
     codigo = Column(String(50))  # Código del medicamento o suplemento
     nombre = Column(String(100), nullable=True)  # Nombre descriptivo
     estado = Column(String(20))  # active, completed, etc.
@@ -64,3 +65,65 @@ class Medicacion(Base):
     
     # Relación con el paciente
     paciente = relationship("Paciente", back_populates="medicaciones")
+
+class Observacion(Base):
+    """Serie temporal de biomarcadores: una fila por medición (append-only)"""
+    __tablename__ = "observaciones"
+    __table_args__ = (
+        # Las consultas por biomarcador son lecturas por rango sobre este índice
+        Index("ix_observaciones_paciente_codigo_fecha", "paciente_id", "codigo", "fecha_efectiva"),
+    )
+
+    id = Column(BigInteger, primary_key=True)
+    paciente_id = Column(UUID(as_uuid=True), ForeignKey('pacientes.id'), nullable=False)
+    codigo = Column(String(20), nullable=False)        # Código LOINC (2093-3, 2571-8, ...)
+    valor = Column(Float, nullable=False)
+    unidad = Column(String(20))                        # mg/dL, ng/mL, %
+    fecha_efectiva = Column(DateTime, nullable=False)  # effectiveDateTime FHIR
+
+    paciente = relationship("Paciente", back_populates="observaciones")
+
+class EfectividadSuplemento(Base):
+    """Resultado del análisis antes/después por suplemento y biomarcador"""
+    __tablename__ = "efectividad_suplementos"
+
+    id = Column(Integer, primary_key=True)
+    suplemento = Column(String(50), nullable=False, index=True)
+    codigo = Column(String(20), nullable=False)        # Código LOINC del biomarcador
+    n = Column(Integer, nullable=False)                # Episodios con medición basal y de seguimiento
+    delta_medio = Column(Float)                        # Seguimiento - basal, en unidades del biomarcador
+    desviacion = Column(Float)
+    ic_inferior = Column(Float)                        # Intervalo de confianza 95% del delta medio
+    ic_superior = Column(Float)
+    delta_porcentual = Column(Float)
+    tamano_efecto = Column(Float)                      # d de Cohen (delta medio / desviación)
+    pendiente_dosis = Column(Float)                    # Cambio del delta por unidad de dosis
+    unidad_dosis = Column(String(20))
+    calculado = Column(DateTime, nullable=False)
+
+class RespuestaDosis(Base):
+    """Curva dosis-respuesta: delta medio por nivel de dosis"""
+    __tablename__ = "respuesta_dosis"
+
+    id = Column(Integer, primary_key=True)
+    suplemento = Column(String(50), nullable=False, index=True)
+    codigo = Column(String(20), nullable=False)
+    dosis = Column(Float, nullable=False)
+    unidad_dosis = Column(String(20))
+    n = Column(Integer, nullable=False)
+    delta_medio = Column(Float)
+
+class RecursoFuente(Base):
+    """Hash del contenido de cada recurso FHIR importado, para la sincronización incremental"""
+    __tablename__ = "recursos_fuente"
+    __table_args__ = (
+        UniqueConstraint("sistema", "tipo", "recurso_id", name="uq_recursos_fuente_sistema_tipo_id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    sistema = Column(String(100), nullable=False)     # Sistema de origen (clínica, laboratorio)
+    tipo = Column(String(30), nullable=False)         # Patient, Observation, MedicationStatement
+    recurso_id = Column(String(64), nullable=False)   # id del recurso en el sistema de origen
+    hash = Column(String(64), nullable=False)         # SHA-256 del recurso normalizado
+    id_local = Column(String(64))                     # id de la fila creada en nuestra base
+    actualizado = Column(DateTime, nullable=False)
@@ -0,0 +1,209 @@
+"""
+Notificaciones de cambios en tiempo real (estilo FHIR Subscription).
+
+Triggers por sentencia en pacientes, historial_medico, medicaciones y observaciones emiten un
+pg_notify por paciente afectado con la tabla, la operación y el paciente (sin el contenido, para
+no superar el límite de 8000 bytes de NOTIFY); una escritura masiva no genera un aviso por fila.
+En las tablas particionadas los triggers se crean en la tabla padre; el nombre lógico de la
+tabla se pasa como argumento porque TG_TABLE_NAME sería el de la partición. Cada worker
+mantiene una única conexión LISTEN en un hilo y reparte los eventos a los suscriptores
+conectados por WebSocket o SSE, filtrados por paciente y por tabla.
+
+Contrapresión: cada suscriptor tiene una cola acotada. Si un cliente lento la llena se
+descartan los eventos más antiguos y se le envía un evento "resincronizar" para que
+vuelva a pedir los recursos completos una sola vez, en lugar de bloquear al resto.
+"""
+import asyncio
+import json
+import os
+import select
+import threading
+import time
+import uuid
+
+from sqlalchemy import text
+
+CANAL = "cambios_salud"
+TABLAS = ["pacientes", "historial_medico", "medicaciones", "observaciones"]
+# Eventos pendientes por suscriptor antes de descartar los más antiguos
+TAMANO_COLA = int(os.getenv("NOTIFICACIONES_TAMANO_COLA", "100"))
+# Intervalo de latidos para mantener vivas las conexiones (segundos)
+INTERVALO_LATIDO = 25
+
+# Un aviso por paciente afectado en cada sentencia (triggers FOR EACH STATEMENT con tablas de
+# transición). Como el payload no lleva el id de la fila, NOTIFY además descarta los avisos
+# idénticos de la misma transacción: una importación masiva cuesta O(pacientes), no O(filas).
+SQL_FUNCION = f"""
+CREATE OR REPLACE FUNCTION notificar_cambios() RETURNS trigger AS $$
+DECLARE
+    tabla text := TG_ARGV[0];
+    columna text := CASE WHEN TG_ARGV[0] = 'pacientes' THEN 'id' ELSE 'paciente_id' END;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('{CANAL}', json_build_object(
+            'tabla', tabla, 'operacion', 'delete', 'paciente_id', afectados.paciente_id
+        )::text)
+        FROM (SELECT DISTINCT to_jsonb(f)->>columna AS paciente_id FROM viejas f) afectados;
+    ELSE
+        PERFORM pg_notify('{CANAL}', json_build_object(
+            'tabla', tabla, 'operacion', lower(TG_OP), 'paciente_id', afectados.paciente_id
+        )::text)
+        FROM (SELECT DISTINCT to_jsonb(f)->>columna AS paciente_id FROM nuevas f) afectados;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+# Una tabla de transición solo se admite en triggers de un único evento
+OPERACIONES = {"insert": "NEW TABLE AS nuevas", "update": "NEW TABLE AS nuevas", "delete": "OLD TABLE AS viejas"}
+
+def sql_quitar_triggers(tabla, relacion=None):
+    """Elimina los triggers de notificación de tabla (o de la relación indicada, p. ej. una copia)"""
+    relacion = relacion or tabla
+    return [f"DROP TRIGGER IF EXISTS tr_notificar_{tabla} ON {relacion}"] + [
+        f"DROP TRIGGER IF EXISTS tr_notificar_{tabla}_{operacion} ON {relacion}" for operacion in OPERACIONES
+    ]
+
+def sql_trigger(tabla):
+    return sql_quitar_triggers(tabla) + [
+        f"CREATE TRIGGER tr_notificar_{tabla}_{operacion} AFTER {operacion.upper()} ON {tabla} "
+        f"REFERENCING {transicion} FOR EACH STATEMENT EXECUTE FUNCTION notificar_cambios('{tabla}')"
+        for operacion, transicion in OPERACIONES.items()
+    ]
+
+def crear_triggers(engine):
+    """Crea la función y los triggers de notificación (solo PostgreSQL)"""
+    if engine.dialect.name != "postgresql":
+        return
+    with engine.begin() as conn:
+        conn.execute(text(SQL_FUNCION))
+        for tabla in TABLAS:
+            for sql in sql_trigger(tabla):
+                conn.execute(text(sql))
+        # Función de los triggers por fila anteriores, ya sin uso
+        conn.execute(text("DROP FUNCTION IF EXISTS notificar_cambio()"))
+
+class Suscriptor:
+    """Cliente conectado con su filtro y su cola acotada de eventos"""
+
+    def __init__(self, paciente_id=None, tablas=None):
+        self.id = str(uuid.uuid4())
+        self.paciente_id = paciente_id
+        self.tablas = set(tablas or TABLAS)
+        self.cola = asyncio.Queue(maxsize=TAMANO_COLA)
+        self.descartados = 0
+
+    def acepta(self, evento):
+        if evento["tabla"] not in self.tablas:
+            return False
+        return self.paciente_id is None or evento.get("paciente_id") == self.paciente_id
+
+    def entregar(self, evento):
+        """Encola sin bloquear; si la cola está llena descarta lo más antiguo y pide resincronizar"""
+        if self.cola.full():
+            while not self.cola.empty():
+                self.cola.get_nowait()
+            self.descartados += 1
+            evento = {"tipo": "resincronizar", "motivo": "cliente lento", "tablas": sorted(self.tablas)}
+        self.cola.put_nowait(evento)
+
+    async def siguiente(self):
+        """Próximo evento o un latido si no hubo cambios en INTERVALO_LATIDO segundos"""
+        try:
+            return await asyncio.wait_for(self.cola.get(), INTERVALO_LATIDO)
+        except asyncio.TimeoutError:
+            return {"tipo": "latido"}
+
+class Distribuidor:
+    """Un LISTEN por worker que reparte las notificaciones en el event loop de la aplicación"""
+
+    def __init__(self):
+        self.suscriptores = {}
+        self.oyentes = []       # funciones internas que reciben todos los eventos
+        self.loop = None
+        self.eventos_recibidos = 0
+        self.conectado = False
+
+    def suscribir(self, paciente_id=None, tablas=None):
+        suscriptor = Suscriptor(paciente_id, tablas)
+        self.suscriptores[suscriptor.id] = suscriptor
+        return suscriptor
+
+    def desuscribir(self, suscriptor):
+        self.suscriptores.pop(suscriptor.id, None)
+
+    def agregar_oyente(self, funcion):
+        """Registra una función que recibe cada evento (p. ej. para invalidar cachés)"""
+        self.oyentes.append(funcion)
+
+    def publicar(self, evento):
+        """Se ejecuta en el event loop: entrega el evento a los oyentes y a los suscriptores que lo aceptan"""
+        self.eventos_recibidos += 1
+        for oyente in self.oyentes:
+            try:
+                oyente(evento)
+            except Exception as e:
+                print(f"Error en oyente de notificaciones: {e}")
+        for suscriptor in list(self.suscriptores.values()):
+            if suscriptor.acepta(evento):
+                suscriptor.entregar(evento)
+
+    def estado(self):
+        return {
+            "conectado": self.conectado,
+            "suscriptores": len(self.suscriptores),
+            "eventos_recibidos": self.eventos_recibidos,
+            "descartados": sum(s.descartados for s in self.suscriptores.values()),
+        }
+
+    def escuchar(self, engine):
+        """Bucle del hilo LISTEN; reconecta si se pierde la conexión"""
+        while True:
+            conexion = None
+            try:
+                conexion = engine.raw_connection()
+                conexion.set_session(autocommit=True)
+                cursor = conexion.cursor()
+                cursor.execute(f"LISTEN {CANAL}")
+                self.conectado = True
+                print(f"Escuchando notificaciones en el canal {CANAL}")
+                while True:
+                    if select.select([conexion.connection], [], [], INTERVALO_LATIDO) == ([], [], []):
+                        continue
+                    conexion.connection.poll()
+                    while conexion.connection.notifies:
+                        aviso = conexion.connection.notifies.pop(0)
+                        evento = {"tipo": "cambio", **json.loads(aviso.payload)}
+                        self.loop.call_soon_threadsafe(self.publicar, evento)
+            except Exception as e:
+                self.conectado = False
+                print(f"Error en el listener de notificaciones: {e}")
+                # Los clientes pudieron perder eventos mientras no había conexión
+                if self.loop is not None:
+                    self.loop.call_soon_threadsafe(self.publicar_resincronizacion)
+                time.sleep(5)
+            finally:
+                if conexion is not None:
+                    try:
+                        conexion.close()
+                    except Exception:
+                        pass
+
+    def publicar_resincronizacion(self):
+        for suscriptor in list(self.suscriptores.values()):
+            suscriptor.entregar({"tipo": "resincronizar", "motivo": "reconexion", "tablas": sorted(suscriptor.tablas)})
+
+    def iniciar(self, engine, loop):
+        """Lanza el hilo LISTEN (solo PostgreSQL); loop es el event loop de la aplicación"""
+        if engine.dialect.name != "postgresql":
+            return None
+        self.loop = loop
+        hilo = threading.Thread(target=self.escuchar, args=(engine,), name="listener-notificaciones", daemon=True)
+        hilo.start()
+        return hilo
+
+distribuidor = Distribuidor()
+
+def formato_sse(evento):
+    return f"event: {evento['tipo']}\ndata: {json.dumps(evento)}\n\n"
@@ -0,0 +1,316 @@
+"""
+Particionamiento declarativo (opcional) de las tablas clínicas en PostgreSQL.
+
+- observaciones: por rango mensual de fecha_efectiva (o hash por paciente_id)
+- historial_medico: por hash de paciente_id (fecha_inicio es texto)
+
+Uso:
+    python particiones.py convertir observaciones --estrategia rango
+    python particiones.py convertir historial_medico --estrategia hash --modulo 16
+    python particiones.py mantener --meses-futuros 3 --retencion-meses 36
+    python particiones.py verificar
+"""
+import argparse
+import sys
+from datetime import date
+
+from sqlalchemy import text
+
+import busqueda
+import cohortes
+import notificaciones
+from database import engine
+
+# Configuración por tabla: columna de fecha (solo para rango), índices y FK a recrear
+TABLAS = {
+    "observaciones": {
+        "columna_fecha": "fecha_efectiva",
+        "indices": ["(paciente_id, codigo, fecha_efectiva)"],
+    },
+    "historial_medico": {
+        "columna_fecha": None,
+        "indices": ["(paciente_id)"],
+    },
+}
+
+def primer_dia_mes(fecha, desplazamiento=0):
+    """Devuelve el primer día del mes desplazado en la cantidad de meses indicada"""
+    indice = fecha.year * 12 + (fecha.month - 1) + desplazamiento
+    return date(indice // 12, indice % 12 + 1, 1)
+
+def nombre_particion_mensual(tabla, inicio):
+    return f"{tabla}_{inicio.year}{inicio.month:02d}"
+
+def esta_particionada(conn, tabla):
+    """Indica si la tabla ya es una tabla particionada"""
+    return conn.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :tabla"
+    ), {"tabla": tabla}).first() is not None
+
+def estrategia_actual(conn, tabla):
+    """Devuelve 'rango', 'hash' o None según la estrategia de particionamiento de la tabla"""
+    fila = conn.execute(text(
+        "SELECT p.partstrat FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = :tabla"
+    ), {"tabla": tabla}).first()
+    if not fila:
+        return None
+    return {"r": "rango", "h": "hash"}.get(fila[0])
+
+def crear_particion_mensual(conn, tabla, inicio):
+    """Crea la partición del mes que comienza en 'inicio' si aún no existe"""
+    fin = primer_dia_mes(inicio, 1)
+    nombre = nombre_particion_mensual(tabla, inicio)
+    conn.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {nombre} PARTITION OF {tabla} "
+        f"FOR VALUES FROM ('{inicio.isoformat()}') TO ('{fin.isoformat()}')"
+    ))
+    return nombre
+
+def convertir(tabla, estrategia, modulo=8, meses_futuros=3):
+    """Reemplaza la tabla por una versión particionada copiando sus datos en una transacción"""
+    config = TABLAS[tabla]
+    if estrategia == "rango" and not config["columna_fecha"]:
+        raise ValueError(f"La tabla {tabla} no tiene columna de fecha; use --estrategia hash")
+    clave = config["columna_fecha"] if estrategia == "rango" else "paciente_id"
+    nueva = f"{tabla}_particionada"
+
+    with engine.begin() as conn:
+        if esta_particionada(conn, tabla):
+            print(f"La tabla {tabla} ya está particionada")
+            return
+        # La clave de partición pasa a ser NOT NULL (forma parte de la clave primaria)
+        nulas = conn.execute(text(f"SELECT count(*) FROM {tabla} WHERE {clave} IS NULL")).scalar()
+        if nulas:
+            raise ValueError(
+                f"{nulas} filas de {tabla} tienen {clave} NULL; corríjalas o elimínelas antes de particionar"
+            )
+
+        # LIKE ... INCLUDING DEFAULTS conserva la secuencia del id
+        conn.execute(text(
+            f"CREATE TABLE {nueva} (LIKE {tabla} INCLUDING DEFAULTS) "
+            f"PARTITION BY {'RANGE' if estrategia == 'rango' else 'HASH'} ({clave})"
+        ))
+        # La clave primaria de una tabla particionada debe incluir la clave de partición
+        conn.execute(text(f"ALTER TABLE {nueva} ALTER COLUMN {clave} SET NOT NULL"))
+        conn.execute(text(f"ALTER TABLE {nueva} ADD PRIMARY KEY (id, {clave})"))
+        conn.execute(text(
+            f"ALTER TABLE {nueva} ADD FOREIGN KEY (paciente_id) REFERENCES pacientes (id)"
+        ))
+
+        if estrategia == "rango":
+            columna = config["columna_fecha"]
+            desde, = conn.execute(text(f"SELECT min({columna}) FROM {tabla}")).first()
+            inicio = primer_dia_mes(desde or date.today())
+            fin = primer_dia_mes(date.today(), meses_futuros)
+            while inicio <= fin:
+                crear_particion_mensual(conn, nueva, inicio)
+                inicio = primer_dia_mes(inicio, 1)
+            # Captura valores fuera de las particiones mensuales existentes
+            conn.execute(text(f"CREATE TABLE {nueva}_default PARTITION OF {nueva} DEFAULT"))
+        else:
+            for resto in range(modulo):
+                conn.execute(text(
+                    f"CREATE TABLE {nueva}_h{resto} PARTITION OF {nueva} "
+                    f"FOR VALUES WITH (MODULUS {modulo}, REMAINDER {resto})"
+                ))
+
+        for i, columnas in enumerate(config["indices"]):
+            conn.execute(text(f"CREATE INDEX ix_{nueva}_{i} ON {nueva} {columnas}"))
+
+        copiadas = conn.execute(text(f"INSERT INTO {nueva} SELECT * FROM {tabla}")).rowcount
+
+        # Intercambiar tablas; la secuencia pasa a pertenecer a la nueva tabla
+        conn.execute(text(f"ALTER TABLE {tabla} RENAME TO {tabla}_sin_particion"))
+        liberar_nombres_indices(conn, f"{tabla}_sin_particion")
+        conn.execute(text(f"ALTER TABLE {nueva} RENAME TO {tabla}"))
+        conn.execute(text(f"ALTER SEQUENCE {tabla}_id_seq OWNED BY {tabla}.id"))
+        renombrar_particiones(conn, nueva, tabla)
+        recrear_dependencias(conn, tabla)
+
+    print(f"✅ {tabla} particionada por {estrategia} ({copiadas} filas copiadas)")
+    print(f"   La tabla original se conserva como {tabla}_sin_particion")
+
+def liberar_nombres_indices(conn, tabla):
+    """
+    Agrega el sufijo _sin_particion a los índices de la tabla original: los CREATE INDEX IF
+    NOT EXISTS del inicio comparan por nombre y, si no, darían por existentes los de la copia
+    """
+    indices = conn.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = :tabla"
+    ), {"tabla": tabla}).scalars().all()
+    for indice in indices:
+        if not indice.endswith("_sin_particion"):
+            # 63 caracteres es el largo máximo de un identificador
+            nuevo_nombre = indice[:49] + "_sin_particion"
+            conn.execute(text(f'ALTER INDEX "{indice}" RENAME TO "{nuevo_nombre}"'))
+
+def vistas_dependientes(conn, tabla):
+    """Vistas (normales o materializadas) cuya definición lee la tabla"""
+    return conn.execute(text("""
+        SELECT DISTINCT v.relname
+        FROM pg_depend d
+        JOIN pg_rewrite r ON r.oid = d.objid
+        JOIN pg_class v ON v.oid = r.ev_class
+        WHERE d.refobjid = CAST(:tabla AS regclass) AND v.oid <> d.refobjid
+    """), {"tabla": tabla}).scalars().all()
+
+def recrear_dependencias(conn, tabla):
+    """
+    Índices GIN de búsqueda, trigger de notificaciones y vistas de cohortes en la nueva tabla
+    padre. Las vistas quedan ligadas a la tabla y no a su nombre: sin recrearlas seguirían
+    leyendo la copia *_sin_particion, que además no se podría eliminar.
+    """
+    for sql in busqueda.sql_indices(tabla):
+        conn.execute(text(sql))
+    if tabla in notificaciones.TABLAS:
+        # La copia sin particionar ya no debe notificar cambios
+        for sql in notificaciones.sql_quitar_triggers(tabla, f"{tabla}_sin_particion"):
+            conn.execute(text(sql))
+        conn.execute(text(notificaciones.SQL_FUNCION))
+        for sql in notificaciones.sql_trigger(tabla):
+            conn.execute(text(sql))
+    cohortes.crear_vistas_en(conn, recrear=True)
+    restantes = vistas_dependientes(conn, f"{tabla}_sin_particion")
+    if restantes:
+        # Aborta la transacción: la conversión no se aplica a medias
+        raise RuntimeError(
+            f"Las vistas {', '.join(restantes)} todavía leen {tabla}_sin_particion; "
+            "elimínelas o recréelas y vuelva a convertir"
+        )
+
+def renombrar_particiones(conn, prefijo_anterior, tabla):
+    """Renombra las particiones creadas con el nombre temporal de la tabla"""
+    particiones = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :tabla"
+    ), {"tabla": tabla}).scalars().all()
+    for particion in particiones:
+        if particion.startswith(prefijo_anterior):
+            nuevo_nombre = tabla + particion[len(prefijo_anterior):]
+            conn.execute(text(f"ALTER TABLE {particion} RENAME TO {nuevo_nombre}"))
+
+def particiones_mensuales(conn, tabla):
+    """Lista (nombre, inicio) de las particiones mensuales de una tabla por rango"""
+    filas = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = :tabla"
+    ), {"tabla": tabla}).scalars().all()
+    resultado = []
+    for nombre in filas:
+        sufijo = nombre[len(tabla) + 1:]
+        if len(sufijo) == 6 and sufijo.isdigit():
+            resultado.append((nombre, date(int(sufijo[:4]), int(sufijo[4:]), 1)))
+    return sorted(resultado, key=lambda p: p[1])
+
+def mantener(meses_futuros=3, retencion_meses=None):
+    """
+    Crea las particiones de los próximos meses y desacopla las más antiguas que la retención.
+    Debe ejecutarse periódicamente (cron) antes de que lleguen datos del mes siguiente,
+    ya que no se puede crear una partición cuyo rango tenga filas en la partición por defecto.
+    """
+    with engine.begin() as conn:
+        for tabla in TABLAS:
+            if estrategia_actual(conn, tabla) != "rango":
+                continue
+
+            hoy = date.today()
+            for desplazamiento in range(meses_futuros + 1):
+                nombre = crear_particion_mensual(conn, tabla, primer_dia_mes(hoy, desplazamiento))
+                print(f"Partición {nombre} disponible")
+
+            if retencion_meses is None:
+                continue
+            limite = primer_dia_mes(hoy, -retencion_meses)
+            for nombre, inicio in particiones_mensuales(conn, tabla):
+                if inicio < limite:
+                    # La partición desacoplada queda como tabla independiente para archivar o eliminar
+                    conn.execute(text(f"ALTER TABLE {tabla} DETACH PARTITION {nombre}"))
+                    print(f"📦 Partición {nombre} desacoplada de {tabla}")
+
+# Consultas representativas de los endpoints y la cantidad máxima de particiones que pueden leer
+CONSULTAS_PODA = {
+    "observaciones": {
+        "rango": (
+            "SELECT * FROM observaciones WHERE paciente_id = :paciente_id "
+            "AND fecha_efectiva >= now() - interval '90 days' ORDER BY fecha_efectiva DESC LIMIT 1"
+        ),
+        "hash": (
+            "SELECT * FROM observaciones WHERE paciente_id = :paciente_id "
+            "ORDER BY codigo, fecha_efectiva DESC"
+        ),
+    },
+    "historial_medico": {
+        "hash": (
+            "SELECT * FROM historial_medico WHERE paciente_id = :paciente_id "
+            "ORDER BY fecha_inicio DESC LIMIT 1"
+        ),
+    },
+}
+
+def tablas_escaneadas(plan):
+    """Recorre un plan EXPLAIN (FORMAT JSON) y devuelve las relaciones leídas"""
+    relaciones = set()
+    if "Relation Name" in plan:
+        relaciones.add(plan["Relation Name"])
+    for hijo in plan.get("Plans", []):
+        relaciones |= tablas_escaneadas(hijo)
+    return relaciones
+
+def verificar():
+    """Comprueba con EXPLAIN que las consultas por paciente/fecha podan particiones"""
+    correcto = True
+    with engine.connect() as conn:
+        paciente_id = conn.execute(text("SELECT id FROM pacientes LIMIT 1")).scalar()
+        if paciente_id is None:
+            print("No hay pacientes para verificar la poda de particiones")
+            return True
+        for tabla, consultas in CONSULTAS_PODA.items():
+            estrategia = estrategia_actual(conn, tabla)
+            consulta = consultas.get(estrategia)
+            if not consulta:
+                print(f"{tabla}: sin particionar, se omite")
+                continue
+            plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {consulta}"), {"paciente_id": paciente_id}).scalar()
+            leidas = tablas_escaneadas(plan[0]["Plan"])
+            total = conn.execute(text(
+                "SELECT count(*) FROM pg_inherits i JOIN pg_class p ON p.oid = i.inhparent WHERE p.relname = :tabla"
+            ), {"tabla": tabla}).scalar()
+            # Con rango se admite el mes en curso, el anterior y la partición por defecto
+            maximo = 1 if estrategia == "hash" else 3
+            if len(leidas) <= maximo:
+                print(f"✅ {tabla}: {len(leidas)} de {total} particiones leídas")
+            else:
+                print(f"❌ {tabla}: {len(leidas)} de {total} particiones leídas ({', '.join(sorted(leidas))})")
+                correcto = False
+    return correcto
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Particionamiento de tablas clínicas")
+    subparsers = parser.add_subparsers(dest="comando", required=True)
+
+    p_convertir = subparsers.add_parser("convertir", help="Convierte una tabla a particionada")
+    p_convertir.add_argument("tabla", choices=list(TABLAS))
+    p_convertir.add_argument("--estrategia", choices=["rango", "hash"], default="rango")
+    p_convertir.add_argument("--modulo", type=int, default=8, help="Número de particiones hash")
+    p_convertir.add_argument("--meses-futuros", type=int, default=3)
+
+    p_mantener = subparsers.add_parser("mantener", help="Crea particiones futuras y desacopla antiguas")
+    p_mantener.add_argument("--meses-futuros", type=int, default=3)
+    p_mantener.add_argument("--retencion-meses", type=int, default=None)
+
+    subparsers.add_parser("verificar", help="Verifica la poda de particiones con EXPLAIN")
+
+    args = parser.parse_args()
+    if args.comando == "convertir":
+        try:
+            convertir(args.tabla, args.estrategia, args.modulo, args.meses_futuros)
+        except (ValueError, RuntimeError) as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+    elif args.comando == "mantener":
+        mantener(args.meses_futuros, args.retencion_meses)
+    elif args.comando == "verificar":
+        if not verificar():
+            sys.exit(1)
@@ -0,0 +1,181 @@
+"""
+Construcción de prompts con presupuesto de tokens.
+
+El historial completo de un paciente crece sin límite, así que en lugar de enviarlo
+tal cual se resume: por biomarcador primera/última medición, mínimo, máximo, pendiente
+mensual y las últimas mediciones; por suplemento los episodios, fechas y dosis. Si el
+resultado supera el presupuesto se aplican niveles de compactación cada vez más
+agresivos hasta que quepa. Si ni el nivel más agresivo cabe (muchos biomarcadores
+distintos) se conservan solo los biomarcadores medidos más recientemente, y si ni sin
+biomarcadores cabe se lanza PresupuestoExcedido: el prompt nunca supera el presupuesto.
+La salida es JSON compacto en lugar de repr de Python.
+
+Los tokens se cuentan con tiktoken si está instalado; si no, con una estimación
+conservadora por bytes. Las pruebas están en tests/test_prompts.py.
+"""
+import json
+import math
+import os
+
+import numpy as np
+
+try:
+    import tiktoken
+    _codificador = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _codificador = None
+
+PRESUPUESTO_TOKENS = int(os.getenv("PROMPT_PRESUPUESTO_TOKENS", "1500"))
+# Tokens reservados por mensaje para los metadatos del formato de chat
+TOKENS_POR_MENSAJE = 4
+
+# De menos a más agresivo; se usa el primero cuyo prompt cabe en el presupuesto
+NIVELES_COMPACTACION = [
+    {"recientes": 3, "max_suplementos": 10, "decimales": 2, "max_texto": 300},
+    {"recientes": 1, "max_suplementos": 5, "decimales": 1, "max_texto": 150},
+    {"recientes": 0, "max_suplementos": 3, "decimales": 1, "max_texto": 80},
+    {"recientes": 0, "max_suplementos": 0, "decimales": 0, "max_texto": 40},
+]
+
+class PresupuestoExcedido(ValueError):
+    """El prompt mínimo (sin historial ni biomarcadores) no cabe en el presupuesto"""
+
+def contar_tokens(texto):
+    """Tokens del texto; sin tiktoken estima 1 token cada 3 bytes (sobreestima en español)"""
+    if _codificador is not None:
+        return len(_codificador.encode(texto))
+    return math.ceil(len(texto.encode("utf-8")) / 3)
+
+def tokens_mensajes(mensajes):
+    return sum(contar_tokens(m["content"]) + TOKENS_POR_MENSAJE for m in mensajes)
+
+def a_json(datos):
+    """JSON sin espacios ni escapes de tildes"""
+    return json.dumps(datos, separators=(",", ":"), ensure_ascii=False, default=str)
+
+def redondear(valor, decimales):
+    if valor is None or (isinstance(valor, float) and math.isnan(valor)):
+        return None
+    return round(float(valor), decimales) if decimales else int(round(valor))
+
+def resumir_biomarcadores(observaciones, recientes=3, decimales=2):
+    """
+    observaciones: [{"fecha": datetime, "codigo", "valor", "unidad"}].
+    Devuelve un resumen por código con estadísticas y las últimas mediciones.
+    """
+    por_codigo = {}
+    for obs in observaciones:
+        por_codigo.setdefault(obs["codigo"], []).append(obs)
+
+    resumen = {}
+    for codigo, serie in por_codigo.items():
+        serie = sorted(serie, key=lambda o: o["fecha"])
+        valores = np.array([o["valor"] for o in serie], dtype=float)
+        dias = np.array([(o["fecha"] - serie[0]["fecha"]).days for o in serie], dtype=float)
+        entrada = {
+            "unidad": serie[-1].get("unidad"),
+            "n": len(serie),
+            "primero": [serie[0]["fecha"].strftime("%Y-%m-%d"), redondear(valores[0], decimales)],
+            "ultimo": [serie[-1]["fecha"].strftime("%Y-%m-%d"), redondear(valores[-1], decimales)],
+            "min": redondear(valores.min(), decimales),
+            "max": redondear(valores.max(), decimales),
+        }
+        if len(serie) >= 2 and dias[-1] > 0:
+            # Pendiente por mínimos cuadrados expresada por cada 30 días
+            entrada["pendiente_30d"] = redondear(np.polyfit(dias, valores, 1)[0] * 30, decimales)
+        if recientes:
+            entrada["recientes"] = [
+                [o["fecha"].strftime("%Y-%m-%d"), redondear(o["valor"], decimales)] for o in serie[-recientes:]
+            ]
+        resumen[codigo] = entrada
+    return resumen
+
+def resumir_suplementos(historial, max_suplementos=10):
+    """
+    historial: [{"fecha", "suplemento", "dosis"}] con fecha 'YYYY-MM-DD'.
+    Un resumen por suplemento, los usados más recientemente primero.
+    """
+    por_suplemento = {}
+    for h in historial:
+        if not h.get("suplemento"):
+            continue
+        por_suplemento.setdefault(h["suplemento"], []).append(h)
+
+    resumen = []
+    for suplemento, episodios in por_suplemento.items():
+        episodios = sorted(episodios, key=lambda h: h.get("fecha") or "")
+        dosis = []
+        for h in episodios:
+            if h.get("dosis") and h["dosis"] not in dosis:
+                dosis.append(h["dosis"])
+        resumen.append({
+            "suplemento": suplemento,
+            "episodios": len(episodios),
+            "desde": episodios[0].get("fecha"),
+            "hasta": episodios[-1].get("fecha"),
+            "dosis_actual": episodios[-1].get("dosis"),
+            "dosis_previas": dosis[:-1][-3:],
+        })
+    resumen.sort(key=lambda s: s["hasta"] or "", reverse=True)
+    return resumen[:max_suplementos]
+
+def recortar_texto(valor, max_texto):
+    if isinstance(valor, str) and len(valor) > max_texto:
+        return valor[:max_texto - 1] + "…"
+    return valor
+
+def contexto_compacto(paciente, historial, observaciones, nivel):
+    contexto = {"paciente": {k: recortar_texto(v, nivel["max_texto"]) for k, v in paciente.items()}}
+    if historial and nivel["max_suplementos"]:
+        contexto["suplementos"] = resumir_suplementos(historial, nivel["max_suplementos"])
+    if observaciones:
+        contexto["biomarcadores"] = resumir_biomarcadores(observaciones, nivel["recientes"], nivel["decimales"])
+    return contexto
+
+def armar_mensajes(sistema, instruccion, contexto):
+    return [
+        {"role": "system", "content": sistema},
+        {"role": "user", "content": f"Datos del paciente (JSON): {a_json(contexto)}\n{instruccion}"},
+    ]
+
+def construir_mensajes(sistema, instruccion, paciente, historial=(), observaciones=(), presupuesto=None):
+    """
+    Mensajes de chat cuyo total no supera el presupuesto de tokens.
+    Devuelve (mensajes, info) con el nivel de compactación usado, los tokens estimados y
+    los biomarcadores omitidos; lanza PresupuestoExcedido si el presupuesto es inalcanzable.
+    """
+    presupuesto = presupuesto or PRESUPUESTO_TOKENS
+    for i, nivel in enumerate(NIVELES_COMPACTACION):
+        contexto = contexto_compacto(paciente, historial, observaciones, nivel)
+        mensajes = armar_mensajes(sistema, instruccion, contexto)
+        tokens = tokens_mensajes(mensajes)
+        if tokens <= presupuesto:
+            return mensajes, {"nivel_compactacion": i, "tokens": tokens, "presupuesto": presupuesto, "codigos_omitidos": 0}
+
+    # Ni la compactación máxima cabe: se conservan los biomarcadores medidos más recientemente
+    biomarcadores = contexto.pop("biomarcadores", {})
+    codigos = sorted(biomarcadores, key=lambda c: biomarcadores[c]["ultimo"][0], reverse=True)
+
+    def probar(cantidad):
+        recortado = {**contexto, "biomarcadores": {c: biomarcadores[c] for c in codigos[:cantidad]}} if cantidad else contexto
+        mensajes = armar_mensajes(sistema, instruccion, recortado)
+        return mensajes, tokens_mensajes(mensajes)
+
+    mensajes, tokens = probar(0)
+    if tokens > presupuesto:
+        raise PresupuestoExcedido(f"El prompt mínimo ocupa {tokens} tokens (presupuesto {presupuesto})")
+    # Búsqueda binaria de la mayor cantidad de códigos que cabe (con todos ya se sabe que no)
+    bajo, alto = 0, len(codigos) - 1
+    while bajo < alto:
+        medio = (bajo + alto + 1) // 2
+        intento = probar(medio)
+        if intento[1] <= presupuesto:
+            bajo, (mensajes, tokens) = medio, intento
+        else:
+            alto = medio - 1
+    return mensajes, {
+        "nivel_compactacion": len(NIVELES_COMPACTACION) - 1,
+        "tokens": tokens,
+        "presupuesto": presupuesto,
+        "codigos_omitidos": len(codigos) - bajo,
+    }
@@ -0,0 +1,204 @@
+"""
+Caché de pronósticos de biomarcadores por paciente.
+
+Cada entrada guarda el resultado de /ai/prediccion-tendencias (coeficientes, curva
+predicha y recomendación) bajo la clave (paciente, código, días) junto con la huella
+de la serie usada: cantidad de mediciones, id máximo, suma de valores y última fecha.
+
+- Escrituras ORM de este worker sobre observaciones o historial_medico invalidan las
+  entradas del paciente al hacer commit.
+- Las notificaciones LISTEN/NOTIFY de observaciones e historial_medico invalidan entre
+  workers.
+- Las escrituras masivas con SQL directo se detectan comparando la huella, que se
+  vuelve a consultar cuando la entrada lleva más de TTL_VERIFICACION segundos sin
+  verificarse; dentro de ese plazo una vista repetida es solo una búsqueda en memoria.
+
+La memoria está acotada con desalojo LRU; opcionalmente la caché se guarda en disco al
+apagar y se carga al iniciar (PRONOSTICOS_CACHE_PATH).
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import Session
+
+import models
+
+CAPACIDAD = int(os.getenv("PRONOSTICOS_CACHE_CAPACIDAD", "10000"))
+TTL_VERIFICACION = float(os.getenv("PRONOSTICOS_CACHE_TTL_VERIFICACION", "30"))
+RUTA_PERSISTENCIA = os.getenv("PRONOSTICOS_CACHE_PATH", "")
+
+def huella_serie(db, paciente_id, codigo):
+    """Huella de la serie de un biomarcador sin leer las filas"""
+    n, id_maximo, suma, ultima = db.query(
+        func.count(models.Observacion.id),
+        func.max(models.Observacion.id),
+        func.sum(models.Observacion.valor),
+        func.max(models.Observacion.fecha_efectiva)
+    ).filter(
+        models.Observacion.paciente_id == paciente_id,
+        models.Observacion.codigo == codigo
+    ).one()
+    return hashlib.sha1(f"{n}|{id_maximo}|{suma!r}|{ultima}".encode("utf-8")).hexdigest()
+
+def normalizar_paciente(paciente_id):
+    """Forma canónica del id (UUID en minúsculas) para que la clave coincida al guardar e invalidar"""
+    try:
+        return str(uuid.UUID(str(paciente_id)))
+    except ValueError:
+        return str(paciente_id).lower()
+
+class CachePronosticos:
+    """LRU de (paciente_id, codigo, dias) -> {"huella", "verificado", "resultado"}"""
+
+    def __init__(self, capacidad=CAPACIDAD, ttl_verificacion=TTL_VERIFICACION):
+        self.capacidad = capacidad
+        self.ttl_verificacion = ttl_verificacion
+        self.entradas = OrderedDict()
+        # paciente_id -> claves: invalidar cuesta lo que tenga el paciente, no toda la caché
+        self.por_paciente = {}
+        self.lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+
+    def consultar(self, db, clave):
+        """
+        Devuelve (resultado, huella). resultado es None si no hay entrada vigente; huella
+        es la calculada para verificar (o None si no hizo falta) y sirve para guardar.
+        """
+        clave = self.normalizar_clave(clave)
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            if entrada is not None:
+                self.entradas.move_to_end(clave)
+                if time.monotonic() - entrada["verificado"] < self.ttl_verificacion:
+                    self.aciertos += 1
+                    return entrada["resultado"], None
+
+        paciente_id, codigo, _ = clave
+        huella = huella_serie(db, paciente_id, codigo)
+        with self.lock:
+            entrada = self.entradas.get(clave)
+            if entrada is not None and entrada["huella"] == huella:
+                entrada["verificado"] = time.monotonic()
+                self.aciertos += 1
+                return entrada["resultado"], huella
+            self.fallos += 1
+        return None, huella
+
+    @staticmethod
+    def normalizar_clave(clave):
+        paciente_id, codigo, dias = clave
+        return (normalizar_paciente(paciente_id), codigo, dias)
+
+    def agregar(self, clave, entrada):
+        """Inserta o reemplaza con el lock tomado, manteniendo el índice por paciente"""
+        self.entradas[clave] = entrada
+        self.entradas.move_to_end(clave)
+        self.por_paciente.setdefault(clave[0], set()).add(clave)
+        while len(self.entradas) > self.capacidad:
+            antigua, _ = self.entradas.popitem(last=False)
+            self.quitar_del_indice(antigua)
+
+    def quitar_del_indice(self, clave):
+        claves = self.por_paciente.get(clave[0])
+        if claves is not None:
+            claves.discard(clave)
+            if not claves:
+                del self.por_paciente[clave[0]]
+
+    def guardar(self, clave, huella, resultado):
+        clave = self.normalizar_clave(clave)
+        with self.lock:
+            self.agregar(clave, {"huella": huella, "verificado": time.monotonic(), "resultado": resultado})
+
+    def invalidar_paciente(self, paciente_id):
+        with self.lock:
+            claves = self.por_paciente.pop(normalizar_paciente(paciente_id), ())
+            for clave in claves:
+                self.entradas.pop(clave, None)
+            self.invalidaciones += len(claves)
+
+    def estado(self):
+        with self.lock:
+            total = self.aciertos + self.fallos
+            return {
+                "entradas": len(self.entradas),
+                "capacidad": self.capacidad,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": round(self.aciertos / total, 3) if total else None,
+                "invalidaciones": self.invalidaciones,
+            }
+
+    def guardar_en_disco(self, ruta):
+        """Las entradas se guardan sin marca de verificación: al cargarlas se vuelven a verificar"""
+        with self.lock:
+            datos = [
+                {"clave": list(clave), "huella": e["huella"], "resultado": e["resultado"]}
+                for clave, e in self.entradas.items()
+            ]
+        with open(ruta, "w", encoding="utf-8") as f:
+            json.dump(datos, f, ensure_ascii=False)
+
+    def cargar_desde_disco(self, ruta):
+        if not os.path.exists(ruta):
+            return 0
+        with open(ruta, encoding="utf-8") as f:
+            datos = json.load(f)
+        with self.lock:
+            for d in datos[-self.capacidad:]:
+                clave = self.normalizar_clave(tuple(d["clave"]))
+                self.agregar(clave, {"huella": d["huella"], "verificado": 0.0, "resultado": d["resultado"]})
+        return len(datos)
+
+cache = CachePronosticos()
+
+def cargar():
+    if RUTA_PERSISTENCIA:
+        try:
+            print(f"Caché de pronósticos: {cache.cargar_desde_disco(RUTA_PERSISTENCIA)} entradas cargadas")
+        except Exception as e:
+            print(f"No se pudo cargar la caché de pronósticos: {e}")
+
+def persistir():
+    if RUTA_PERSISTENCIA:
+        try:
+            cache.guardar_en_disco(RUTA_PERSISTENCIA)
+        except Exception as e:
+            print(f"No se pudo guardar la caché de pronósticos: {e}")
+
+TABLAS_SERIES = {"observaciones", "historial_medico"}
+
+def invalidar_por_notificacion(evento):
+    """Oyente de notificaciones: invalida al paciente cuando otro worker escribe sus series"""
+    if evento.get("tipo") == "cambio" and evento.get("tabla") in TABLAS_SERIES and evento.get("paciente_id"):
+        cache.invalidar_paciente(evento["paciente_id"])
+
+# Los pacientes afectados se acumulan en cada flush y se invalidan solo si hay commit
+
+def marcar_modificados(session, pacientes):
+    """Para escrituras con SQL directo, que no pasan por after_flush"""
+    session.info.setdefault("pronosticos", set()).update(pacientes)
+
+@event.listens_for(Session, "after_flush")
+def registrar_series_modificadas(session, flush_context):
+    afectados = session.info.setdefault("pronosticos", set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (models.Observacion, models.HistorialMedico)) and obj.paciente_id is not None:
+            afectados.add(str(obj.paciente_id))
+
+@event.listens_for(Session, "after_commit")
+def invalidar_series_modificadas(session):
+    for paciente_id in session.info.pop("pronosticos", ()):
+        cache.invalidar_paciente(paciente_id)
+
+@event.listens_for(Session, "after_rollback")
+def descartar_series_modificadas(session):
+    session.info.pop("pronosticos", None)
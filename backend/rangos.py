@@ -0,0 +1,211 @@
+"""
+Rangos de referencia versionados compilados en arreglos de NumPy.
+
+Los rangos se leen de rangos_referencia.json (por biomarcador, sexo y banda etaria) y se
+compilan en dos arreglos mínimos/máximos de forma (biomarcador, sexo, banda). Evaluar
+uno o cien mil pacientes es la misma comparación vectorizada: se indexan los límites
+de cada paciente según su sexo y banda y se comparan contra la matriz de valores.
+
+El archivo se vuelve a leer si cambia su fecha de modificación (revisada como máximo
+cada INTERVALO_REVISION segundos) o al llamar a recargar(); la tabla compilada se
+reemplaza de una vez, así que los lectores nunca ven una mezcla de versiones.
+
+Uso (tamizaje de toda la población desde la línea de comandos):
+    python rangos.py tamizaje
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import bindparam, text
+
+RUTA_RANGOS = os.getenv(
+    "RANGOS_REFERENCIA_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "rangos_referencia.json")
+)
+INTERVALO_REVISION = 5
+
+SEXOS = ["masculino", "femenino", "otro"]
+BAJO, NORMAL, ALTO = -1, 0, 1
+TIPOS = {BAJO: "bajo", ALTO: "alto"}
+
+def normalizar_sexo(sexo):
+    sexo = (sexo or "").lower()
+    return {"male": "masculino", "female": "femenino"}.get(sexo, sexo)
+
+def indice_sexo(sexo):
+    sexo = normalizar_sexo(sexo)
+    return SEXOS.index(sexo) if sexo in SEXOS else SEXOS.index("otro")
+
+class TablaRangos:
+    """Rangos compilados: minimos/maximos[biomarcador, sexo, banda] (NaN = sin rango)"""
+
+    def __init__(self, datos):
+        self.version = datos["version"]
+        self.biomarcadores = list(datos["biomarcadores"])
+        self.info = datos["biomarcadores"]
+        self.filas = datos["rangos"]
+        indice = {b: i for i, b in enumerate(self.biomarcadores)}
+
+        self.bordes = np.array(sorted({0} | {f["edad_desde"] for f in self.filas} | {f["edad_hasta"] for f in self.filas}), dtype=float)
+        forma = (len(self.biomarcadores), len(SEXOS), len(self.bordes) - 1)
+        self.minimos = np.full(forma, np.nan)
+        self.maximos = np.full(forma, np.nan)
+
+        # Primero las filas genéricas ('*') para que las específicas por sexo las sobrescriban
+        for fila in sorted(self.filas, key=lambda f: f["sexo"] != "*"):
+            if fila["biomarcador"] not in indice:
+                raise ValueError(f"Biomarcador desconocido en rangos: {fila['biomarcador']}")
+            b = indice[fila["biomarcador"]]
+            sexos = list(range(len(SEXOS))) if fila["sexo"] == "*" else [indice_sexo(fila["sexo"])]
+            desde = int(np.searchsorted(self.bordes, fila["edad_desde"]))
+            hasta = int(np.searchsorted(self.bordes, fila["edad_hasta"]))
+            self.minimos[b, sexos, desde:hasta] = fila["min"]
+            self.maximos[b, sexos, desde:hasta] = fila["max"]
+
+    def bandas(self, edades):
+        # Edad desconocida (NaN) usa la primera banda
+        edades = np.nan_to_num(np.asarray(edades, dtype=float), nan=0.0)
+        return np.clip(np.searchsorted(self.bordes, edades, side="right") - 1, 0, self.minimos.shape[2] - 1)
+
+    def limites(self, sexos, edades):
+        """Mínimos y máximos de cada paciente, matrices (pacientes, biomarcadores)"""
+        sexos = np.asarray(sexos, dtype=int)
+        bandas = self.bandas(edades)
+        return self.minimos[:, sexos, bandas].T, self.maximos[:, sexos, bandas].T
+
+    def evaluar(self, valores, sexos, edades):
+        """
+        valores: matriz (pacientes, biomarcadores) con NaN donde no hay dato.
+        Devuelve la matriz de estados BAJO/NORMAL/ALTO y los límites usados.
+        """
+        valores = np.asarray(valores, dtype=float)
+        minimos, maximos = self.limites(sexos, edades)
+        # Las comparaciones con NaN son falsas: sin dato o sin rango queda NORMAL
+        estados = np.where(valores < minimos, BAJO, np.where(valores > maximos, ALTO, NORMAL))
+        return estados, minimos, maximos
+
+    def evaluar_paciente(self, valores, sexo, edad):
+        """valores: {biomarcador: valor}. Devuelve [(biomarcador, tipo, min, max)] fuera de rango"""
+        fila = np.array([[np.nan if valores.get(b) is None else valores[b] for b in self.biomarcadores]])
+        estados, minimos, maximos = self.evaluar(fila, [indice_sexo(sexo)], [np.nan if edad is None else edad])
+        return [
+            (b, TIPOS[estados[0, i]], minimos[0, i], maximos[0, i])
+            for i, b in enumerate(self.biomarcadores) if estados[0, i] != NORMAL
+        ]
+
+    def resumen(self):
+        return {"version": self.version, "biomarcadores": self.info, "rangos": self.filas}
+
+_tabla = None
+_mtime = None
+_ultima_revision = 0.0
+_lock = threading.Lock()
+
+def recargar():
+    """Lee y compila el archivo de rangos; si es inválido se conserva la tabla anterior"""
+    global _tabla, _mtime
+    with _lock:
+        mtime = os.path.getmtime(RUTA_RANGOS)
+        with open(RUTA_RANGOS, encoding="utf-8") as f:
+            nueva = TablaRangos(json.load(f))
+        _tabla, _mtime = nueva, mtime
+    print(f"Rangos de referencia versión {nueva.version} cargados")
+    return nueva
+
+def tabla():
+    """Tabla vigente; recarga si el archivo cambió desde la última lectura"""
+    global _ultima_revision
+    if _tabla is None:
+        return recargar()
+    ahora = time.monotonic()
+    if ahora - _ultima_revision > INTERVALO_REVISION:
+        _ultima_revision = ahora
+        try:
+            if os.path.getmtime(RUTA_RANGOS) != _mtime:
+                recargar()
+        except Exception as e:
+            print(f"Error al recargar rangos de referencia, se mantiene la versión {_tabla.version}: {e}")
+    return _tabla
+
+# Último valor de cada biomarcador por paciente con sexo y edad. fecha_nacimiento es texto
+# libre: fecha_o_nulo() (cohortes.py) deja la edad desconocida en vez de fallar la consulta
+SQL_TAMIZAJE = text("""
+    SELECT DISTINCT ON (o.paciente_id, o.codigo)
+           o.paciente_id, o.codigo, o.valor, p.sexo,
+           date_part('year', age(fecha_o_nulo(p.fecha_nacimiento))) AS edad
+    FROM observaciones o
+    JOIN pacientes p ON p.id = o.paciente_id
+    WHERE o.codigo IN :codigos
+    ORDER BY o.paciente_id, o.codigo, o.fecha_efectiva DESC
+""").bindparams(bindparam("codigos", expanding=True))
+
+def tamizaje_poblacional(db, limite=100):
+    """Evalúa a todos los pacientes en una sola comparación vectorizada"""
+    t = tabla()
+    codigos = {t.info[b]["codigo"]: b for b in t.biomarcadores}
+    filas = db.execute(SQL_TAMIZAJE, {"codigos": list(codigos)}).mappings().all()
+
+    resultado = {
+        "version": t.version, "pacientes_evaluados": 0, "pacientes_fuera_de_rango": 0, "resumen": [], "pacientes": []
+    }
+    if not filas:
+        return resultado
+
+    df = pd.DataFrame(filas)
+    df["paciente_id"] = df["paciente_id"].astype(str)
+    df["biomarcador"] = df["codigo"].map(codigos)
+    valores = df.pivot(index="paciente_id", columns="biomarcador", values="valor").reindex(columns=t.biomarcadores)
+    demografia = df.drop_duplicates("paciente_id").set_index("paciente_id").loc[valores.index]
+
+    estados, minimos, maximos = t.evaluar(
+        valores.to_numpy(),
+        demografia["sexo"].map(indice_sexo).to_numpy(),
+        pd.to_numeric(demografia["edad"], errors="coerce").to_numpy()
+    )
+
+    resultado["pacientes_evaluados"] = len(valores)
+    for i, b in enumerate(t.biomarcadores):
+        resultado["resumen"].append({
+            "biomarcador": t.info[b]["nombre"],
+            "campo": b,
+            "con_dato": int(valores[b].notna().sum()),
+            "bajo": int((estados[:, i] == BAJO).sum()),
+            "alto": int((estados[:, i] == ALTO).sum()),
+        })
+
+    fuera = np.flatnonzero((estados != NORMAL).any(axis=1))
+    for p in fuera[:limite]:
+        resultado["pacientes"].append({
+            "paciente_id": valores.index[p],
+            "anomalias": [
+                {
+                    "campo": b,
+                    "valor": float(valores.iat[p, i]),
+                    "tipo": TIPOS[estados[p, i]],
+                    "rango_normal": f"{minimos[p, i]:g} - {maximos[p, i]:g} {t.info[b]['unidad']}",
+                } for i, b in enumerate(t.biomarcadores) if estados[p, i] != NORMAL
+            ]
+        })
+    resultado["pacientes_fuera_de_rango"] = int(len(fuera))
+    return resultado
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) > 1 and sys.argv[1] == "tamizaje":
+        from database import SessionLocal
+
+        db = SessionLocal()
+        try:
+            inicio = time.perf_counter()
+            r = tamizaje_poblacional(db, limite=0)
+            print(f"Rangos {r['version']}: {r['pacientes_evaluados']} pacientes en {time.perf_counter() - inicio:.2f}s")
+            for fila in r["resumen"]:
+                print(f"  {fila['biomarcador']}: {fila['bajo']} bajos, {fila['alto']} altos de {fila['con_dato']}")
+        finally:
+            db.close()
+    else:
+        print(__doc__)
@@ -0,0 +1,193 @@
+"""
+Motor de recomendaciones determinista basado en tablas.
+
+Las reglas son datos (diccionarios y listas), no código: umbrales de tendencia, textos
+por biomarcador/hallazgo y suplementos sugeridos; los rangos normales por sexo y edad
+vienen de la tabla versionada de rangos.py. Evaluar a un paciente son unas pocas
+búsquedas en diccionarios, por lo que se usa como camino rápido cuando el modelo de
+lenguaje no está disponible.
+"""
+import rangos
+
+# Pendiente diaria mínima para cada tendencia, evaluadas en orden
+UMBRALES_TENDENCIA = [
+    (0.5, "ascendente_rapida"),
+    (0.1, "ascendente_lenta"),
+    (-0.1, "estable"),
+    (-0.5, "descendente_lenta"),
+]
+TENDENCIA_MINIMA = "descendente_rapida"
+
+TEXTOS_TENDENCIA = {
+    "colesterol_total": {
+        "ascendente_rapida": "La tendencia al alza rápida del colesterol sugiere revisar la dieta. Considere aumentar fibra soluble y reducir grasas saturadas.",
+        "ascendente_lenta": "El colesterol muestra un aumento gradual. Monitorear y considerar ajustes en la dieta.",
+        "descendente_rapida": "Excelente progreso en la reducción del colesterol. Mantener el régimen actual.",
+        "descendente_lenta": "El colesterol está disminuyendo gradualmente. Continuar con el plan actual.",
+        "estable": "Los niveles de colesterol se mantienen estables."
+    },
+    "trigliceridos": {
+        "ascendente_rapida": "Aumento preocupante de triglicéridos. Revisar consumo de azúcares y carbohidratos refinados.",
+        "ascendente_lenta": "Ligero aumento en triglicéridos. Considerar reducir azúcares.",
+        "descendente_rapida": "Excelente reducción de triglicéridos. Mantener hábitos actuales.",
+        "descendente_lenta": "Reducción gradual de triglicéridos. Buen progreso.",
+        "estable": "Los niveles de triglicéridos se mantienen estables."
+    },
+    "vitamina_d": {
+        "ascendente_rapida": "Excelente mejora en niveles de vitamina D. Considerar ajustar dosis para mantener.",
+        "ascendente_lenta": "Mejora gradual en vitamina D. Continuar suplementación.",
+        "descendente_rapida": "Disminución significativa de vitamina D. Revisar dosis y absorción.",
+        "descendente_lenta": "Ligera disminución de vitamina D. Monitorear.",
+        "estable": "Los niveles de vitamina D se mantienen estables."
+    },
+    "omega3_indice": {
+        "ascendente_rapida": "Excelente mejora en índice omega-3. Mantener suplementación actual.",
+        "ascendente_lenta": "Mejora gradual en índice omega-3. Continuar régimen.",
+        "descendente_rapida": "Disminución significativa del índice omega-3. Revisar calidad del suplemento.",
+        "descendente_lenta": "Ligera disminución del índice omega-3. Considerar ajustar dosis.",
+        "estable": "El índice omega-3 se mantiene estable."
+    }
+}
+
+# Tendencias que merecen una recomendación aunque el valor esté en rango
+TENDENCIAS_RELEVANTES = {
+    "colesterol_total": {"ascendente_rapida", "ascendente_lenta"},
+    "trigliceridos": {"ascendente_rapida", "ascendente_lenta"},
+    "vitamina_d": {"descendente_rapida", "descendente_lenta"},
+    "omega3_indice": {"descendente_rapida", "descendente_lenta"},
+}
+
+TEXTOS_ANOMALIA = {
+    "colesterol_total": {
+        "alto": "Considere aumentar el consumo de fibra soluble, reducir grasas saturadas y aumentar actividad física. Evaluar suplementación con fitoesteroles.",
+        "bajo": "Niveles bajos de colesterol pueden afectar la producción hormonal. Consulte con su médico para evaluar causas subyacentes."
+    },
+    "trigliceridos": {
+        "alto": "Reduzca el consumo de azúcares y carbohidratos refinados. Aumente omega-3 y considere suplementos de berberina.",
+        "bajo": "Aunque poco común, niveles muy bajos de triglicéridos pueden indicar malabsorción. Consulte con su médico."
+    },
+    "vitamina_d": {
+        "alto": "Niveles elevados de vitamina D pueden ser tóxicos. Reduzca o suspenda suplementación y consulte con su médico.",
+        "bajo": "Aumente exposición solar moderada y considere suplementación con D3. Verificar niveles de magnesio para mejor absorción."
+    },
+    "omega3_indice": {
+        "alto": "Excelente nivel de omega-3. Mantener hábitos actuales.",
+        "bajo": "Aumente consumo de pescados grasos o considere suplementación con omega-3 de alta calidad (EPA/DHA)."
+    }
+}
+
+# (biomarcador, tipo, condición sobre (sexo, edad), texto adicional)
+AJUSTES_ANOMALIA = [
+    ("colesterol_total", "alto", lambda sexo, edad: edad > 50,
+     " En personas mayores de 50 años, evaluar también niveles de CoQ10."),
+    ("vitamina_d", "bajo", lambda sexo, edad: sexo == "femenino",
+     " En mujeres, niveles óptimos de vitamina D son especialmente importantes para la salud ósea."),
+]
+
+SUPLEMENTOS = {
+    "omega3": {
+        "nombre": "Omega-3", "dosis": "2000mg", "frecuencia": "Diaria", "momento": "Con las comidas",
+        "duracion": "3 meses", "justificacion": "Mejora perfil lipídico y reduce inflamación"
+    },
+    "vitamina_d3": {
+        "nombre": "Vitamina D3", "dosis": "2000 UI", "frecuencia": "Diaria", "momento": "Con el desayuno",
+        "duracion": "6 meses", "justificacion": "Optimiza niveles séricos y mejora inmunidad"
+    },
+    "fitoesteroles": {
+        "nombre": "Fitoesteroles", "dosis": "2g", "frecuencia": "Diaria", "momento": "Con la comida principal",
+        "duracion": "3 meses", "justificacion": "Reduce la absorción intestinal de colesterol"
+    },
+    "berberina": {
+        "nombre": "Berberina", "dosis": "500mg", "frecuencia": "Dos veces al día", "momento": "Antes de las comidas",
+        "duracion": "3 meses", "justificacion": "Contribuye a reducir triglicéridos"
+    },
+    "coq10": {
+        "nombre": "Coenzima Q10", "dosis": "100mg", "frecuencia": "Diaria", "momento": "Con el desayuno",
+        "duracion": "3 meses", "justificacion": "Apoyo cardiovascular en mayores de 50 años"
+    },
+}
+
+# Hallazgo (biomarcador, tipo) -> suplementos sugeridos
+SUPLEMENTOS_POR_HALLAZGO = {
+    ("colesterol_total", "alto"): ["fitoesteroles", "omega3"],
+    ("trigliceridos", "alto"): ["omega3", "berberina"],
+    ("vitamina_d", "bajo"): ["vitamina_d3"],
+    ("omega3_indice", "bajo"): ["omega3"],
+}
+# Si no hay hallazgos se sugiere el plan base
+SUPLEMENTOS_BASE = ["omega3", "vitamina_d3"]
+SUPLEMENTOS_POR_CONDICION = [
+    (lambda sexo, edad: edad > 50, "coq10"),
+]
+
+RECOMENDACIONES_GENERALES = [
+    {"tipo": "Dieta", "descripcion": "Incrementar consumo de alimentos ricos en fibra soluble"},
+    {"tipo": "Estilo de vida", "descripcion": "Incorporar 30 minutos de actividad aeróbica diaria"},
+    {"tipo": "Seguimiento", "descripcion": "Repetir análisis de biomarcadores en 3 meses"},
+]
+
+CONSIDERACIONES = "Evitar tomar calcio junto con el hierro para mejor absorción"
+SEGUIMIENTO = "Repetir análisis en 3 meses"
+
+def clasificar_tendencia(pendiente_diaria):
+    for umbral, tendencia in UMBRALES_TENDENCIA:
+        if pendiente_diaria > umbral:
+            return tendencia
+    return TENDENCIA_MINIMA
+
+def recomendacion_tendencia(biomarcador, tendencia):
+    return TEXTOS_TENDENCIA.get(biomarcador, {}).get(tendencia, "No hay recomendaciones específicas disponibles.")
+
+def recomendacion_anomalia(biomarcador, tipo, sexo, edad):
+    sexo = rangos.normalizar_sexo(sexo)
+    texto = TEXTOS_ANOMALIA.get(biomarcador, {}).get(tipo, "Consulte con su médico.")
+    for b, t, condicion, adicional in AJUSTES_ANOMALIA:
+        if b == biomarcador and t == tipo and condicion(sexo, edad):
+            texto += adicional
+    return texto
+
+def evaluar_anomalias(valores, sexo, edad):
+    """Biomarcadores fuera de rango; valores indexado por nombre de campo"""
+    tabla = rangos.tabla()
+    anomalias = []
+    for biomarcador, tipo, minimo, maximo in tabla.evaluar_paciente(valores, sexo, edad):
+        info = tabla.info[biomarcador]
+        anomalias.append({
+            "biomarcador": info["nombre"],
+            "campo": biomarcador,
+            "valor": valores[biomarcador],
+            "unidad": info["unidad"],
+            "tipo": tipo,
+            "rango_normal": f"{minimo:g} - {maximo:g} {info['unidad']}",
+            "recomendacion": recomendacion_anomalia(biomarcador, tipo, sexo, edad)
+        })
+    return anomalias
+
+def recomendar(valores, tendencias, sexo, edad, maximo=3):
+    """
+    Recomendaciones {"tipo", "descripcion"} priorizando anomalías, luego tendencias
+    desfavorables y completando con recomendaciones generales.
+    """
+    recomendaciones = [
+        {"tipo": "Biomarcador", "descripcion": f"{a['biomarcador']} {a['tipo']} ({a['valor']} {a['unidad']}): {a['recomendacion']}"}
+        for a in evaluar_anomalias(valores, sexo, edad)
+    ]
+    for biomarcador, tendencia in tendencias.items():
+        if tendencia in TENDENCIAS_RELEVANTES.get(biomarcador, ()):
+            recomendaciones.append({"tipo": "Tendencia", "descripcion": recomendacion_tendencia(biomarcador, tendencia)})
+    for general in RECOMENDACIONES_GENERALES:
+        if len(recomendaciones) >= maximo:
+            break
+        recomendaciones.append(dict(general))
+    return recomendaciones[:maximo]
+
+def suplementos_sugeridos(valores, sexo, edad):
+    """Suplementos (sin repetir) según los hallazgos del paciente"""
+    sexo = rangos.normalizar_sexo(sexo)
+    claves = []
+    for anomalia in evaluar_anomalias(valores, sexo, edad):
+        claves.extend(SUPLEMENTOS_POR_HALLAZGO.get((anomalia["campo"], anomalia["tipo"]), []))
+    if not claves:
+        claves = list(SUPLEMENTOS_BASE)
+    claves.extend(clave for condicion, clave in SUPLEMENTOS_POR_CONDICION if condicion(sexo, edad))
+    return [dict(SUPLEMENTOS[clave]) for clave in dict.fromkeys(claves)]
@@ -0,0 +1,367 @@
+"""
+Snapshots columnares (Parquet) de las tablas clínicas para analítica fuera del OLTP.
+
+Cada tabla se lee con un cursor del lado del servidor (stream_results) en lotes de
+TAMANO_LOTE filas y se escribe como dataset Parquet particionado estilo Hive:
+
+- historial_medico: mes=YYYY-MM/suplemento=...  (sin suplemento = "sin_dato")
+- medicaciones:     mes=YYYY-MM/suplemento=...  (a partir del código)
+- observaciones:    mes=YYYY-MM/codigo=...
+- pacientes:        sin particiones, se reescribe completo en cada ejecución
+
+Los valores de partición se escriben con codificación URI (un código "a/b" queda en la
+carpeta codigo=a%2Fb) y Arrow/DuckDB los decodifican al leer, así no se confunden con "a_b".
+
+Las tablas clínicas se exportan de forma incremental con una marca de transacción: cada
+exportación lee la tabla en una transacción REPEATABLE READ y guarda en _estado.json el
+xmin de su snapshot (la transacción más antigua aún en curso). La siguiente exporta las
+filas cuyo xmin es posterior a esa marca, es decir, las insertadas o modificadas desde
+entonces (la sincronización incremental de FHIR actualiza observaciones y medicaciones en
+el lugar), incluidas las que tenían un id menor pero se confirmaron después. Antes de
+escribirlas se quitan de los archivos ya exportados, así el snapshot no guarda versiones
+viejas ni duplicados. Los archivos reescritos se ocultan (".<nombre>.reemplazado-<ejecución>")
+hasta que la ejecución termina.
+
+Para no leer todo el dataset en cada ejecución, _ubicaciones/<tabla>-<ejecución>.parquet
+guarda la partición de cada id exportado: solo se abren los archivos de las particiones que
+contienen filas a quitar. El mismo índice detecta las filas borradas en el origen (el conteo
+de la tabla no cuadra con el índice) y también se quitan del snapshot.
+
+Los archivos de una ejecución llevan su identificador en el nombre; si una ejecución se
+interrumpe, la siguiente borra sus archivos y restaura los ocultos antes de continuar.
+
+Requiere pyarrow (pip install pyarrow).
+
+Uso:
+    python snapshots.py exportar [--completo] [--destino /datos/snapshots]
+    python snapshots.py resumen
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import sys
+from datetime import datetime
+from urllib.parse import unquote
+
+import pandas as pd
+from sqlalchemy import text
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+DESTINO = os.getenv("SNAPSHOTS_PATH", "/data/snapshots")
+TAMANO_LOTE = int(os.getenv("SNAPSHOTS_TAMANO_LOTE", "50000"))
+
+# columna_fecha define la partición mensual; grupo = (nombre de la partición, columna de origen).
+# incremental = tabla que se exporta por marca de transacción (xmin) en lugar de completa
+TABLAS = {
+    "historial_medico": {"columna_fecha": "fecha_inicio", "grupo": ("suplemento", "suplemento"), "incremental": True},
+    "medicaciones": {"columna_fecha": "fecha_inicio", "grupo": ("suplemento", "codigo"), "incremental": True},
+    "observaciones": {"columna_fecha": "fecha_efectiva", "grupo": ("codigo", "codigo"), "incremental": True},
+    "pacientes": {"columna_fecha": None, "grupo": None, "incremental": False},
+}
+
+# El primer SELECT de la transacción fija el snapshot: su xmin es la marca de la exportación
+SQL_MARCA = text("SELECT txid_snapshot_xmin(txid_current_snapshot())")
+# xmin de la fila posterior a la marca; age() compara ids de 32 bits sin problemas de vuelta.
+# Las filas congeladas tienen la edad máxima y nunca cuentan como cambiadas.
+CONDICION_CAMBIO = "age(xmin) <= age(CAST(CAST(:marca AS text) AS xid))"
+# Con más distancia que esto la comparación de 32 bits ya no es confiable: exportación completa
+MAX_DISTANCIA_XID = 2 ** 31 - 10 ** 7
+
+def requerir_pyarrow():
+    if pa is None:
+        raise RuntimeError("Los snapshots requieren pyarrow: pip install pyarrow")
+
+def ruta_estado(destino):
+    return os.path.join(destino, "_estado.json")
+
+def leer_estado(destino):
+    if not os.path.exists(ruta_estado(destino)):
+        return {"tablas": {}, "ejecucion_en_curso": None}
+    with open(ruta_estado(destino), encoding="utf-8") as f:
+        return json.load(f)
+
+def escribir_estado(destino, estado):
+    # Escritura atómica: un corte a mitad nunca deja un estado corrupto
+    temporal = ruta_estado(destino) + ".tmp"
+    with open(temporal, "w", encoding="utf-8") as f:
+        json.dump(estado, f, indent=2)
+    os.replace(temporal, ruta_estado(destino))
+
+def ocultos(destino, ejecucion):
+    return glob.glob(os.path.join(destino, "**", f".*.reemplazado-{ejecucion}"), recursive=True)
+
+def limpiar_ejecucion(destino, ejecucion):
+    """Borra los archivos escritos por una ejecución que no terminó y restaura los que reemplazó"""
+    archivos = glob.glob(os.path.join(destino, "**", f"parte-{ejecucion}-*.parquet"), recursive=True)
+    for archivo in archivos:
+        os.remove(archivo)
+    restaurados = ocultos(destino, ejecucion)
+    for archivo in restaurados:
+        nombre = os.path.basename(archivo)[1:-len(f".reemplazado-{ejecucion}")]
+        os.replace(archivo, os.path.join(os.path.dirname(archivo), nombre))
+    if archivos or restaurados:
+        print(f"Ejecución interrumpida {ejecucion}: {len(archivos)} archivos eliminados, {len(restaurados)} restaurados")
+
+def archivos_tabla(ruta_tabla):
+    # glob no incluye los archivos ocultos (".<nombre>.reemplazado-...")
+    return glob.glob(os.path.join(ruta_tabla, "**", "*.parquet"), recursive=True)
+
+def particion_de_archivo(ruta_tabla, archivo):
+    """Valores de partición (decodificados) de un archivo según sus carpetas Hive"""
+    carpetas = os.path.relpath(os.path.dirname(archivo), ruta_tabla).split(os.sep)
+    return tuple(unquote(c.split("=", 1)[1]) for c in carpetas if "=" in c)
+
+def esquema_ubicaciones(config):
+    return pa.schema([("id", pa.int64())] + [(c, pa.string()) for c in columnas_particion(config)])
+
+def ruta_ubicaciones(destino, nombre):
+    return os.path.join(destino, "_ubicaciones", nombre)
+
+def reconstruir_ubicaciones(ruta_tabla, config):
+    """Índice id -> partición a partir de los archivos; solo se usa si falta el índice guardado"""
+    esquema = esquema_ubicaciones(config)
+    partes = []
+    for archivo in archivos_tabla(ruta_tabla):
+        ids = pq.ParquetFile(archivo).read(columns=["id"]).column("id").combine_chunks().cast(pa.int64())
+        valores = particion_de_archivo(ruta_tabla, archivo)
+        partes.append(pa.Table.from_arrays(
+            [ids] + [pa.array([v] * len(ids), pa.string()) for v in valores], schema=esquema
+        ))
+    return pa.concat_tables(partes) if partes else esquema.empty_table()
+
+def cargar_ubicaciones(destino, tabla, config, info):
+    nombre = info.get("ubicaciones")
+    if nombre and os.path.exists(ruta_ubicaciones(destino, nombre)):
+        return pq.read_table(ruta_ubicaciones(destino, nombre))
+    print(f"{tabla}: sin índice de ubicaciones, se reconstruye leyendo los archivos exportados")
+    return reconstruir_ubicaciones(os.path.join(destino, tabla), config)
+
+def guardar_ubicaciones(destino, tabla, ejecucion, ubicaciones):
+    """Escribe el índice de esta ejecución; _estado.json apunta a él solo si la ejecución termina"""
+    nombre = f"{tabla}-{ejecucion}.parquet"
+    os.makedirs(ruta_ubicaciones(destino, ""), exist_ok=True)
+    pq.write_table(ubicaciones, ruta_ubicaciones(destino, nombre))
+    return nombre
+
+def limpiar_ubicaciones(destino, estado):
+    """Borra los índices que ya no referencia _estado.json (anteriores o de ejecuciones interrumpidas)"""
+    vigentes = {info.get("ubicaciones") for info in estado["tablas"].values()}
+    for archivo in glob.glob(ruta_ubicaciones(destino, "*.parquet")):
+        if os.path.basename(archivo) not in vigentes:
+            os.remove(archivo)
+
+def ids_arrow(conn, sql, parametros):
+    """Columna id de una consulta, leída con cursor del servidor directo a un arreglo de Arrow"""
+    resultado = conn.execution_options(stream_results=True, max_row_buffer=TAMANO_LOTE).execute(sql, parametros)
+    lotes = [pa.array([fila[0] for fila in filas], pa.int64()) for filas in resultado.partitions(TAMANO_LOTE)]
+    return pa.concat_arrays(lotes) if lotes else pa.array([], pa.int64())
+
+def sin_ids(ubicaciones, ids):
+    return ubicaciones.filter(pc.invert(pc.is_in(ubicaciones.column("id"), value_set=ids)))
+
+def quitar_filas(ruta_tabla, config, ubicaciones, ids, ejecucion):
+    """
+    Quita de los archivos ya exportados las filas que se van a volver a exportar o que se
+    borraron en el origen. Solo se abren los archivos de las particiones donde el índice de
+    ubicaciones tiene alguno de esos ids; cada archivo afectado se reescribe sin ellos y el
+    original queda oculto. Devuelve la cantidad de archivos reescritos.
+    """
+    if not len(ids):
+        return 0
+    afectadas = ubicaciones.filter(pc.is_in(ubicaciones.column("id"), value_set=ids))
+    particiones = set(zip(*(afectadas.column(c).to_pylist() for c in columnas_particion(config))))
+    reescritos = 0
+    for archivo in archivos_tabla(ruta_tabla):
+        if particion_de_archivo(ruta_tabla, archivo) not in particiones:
+            continue
+        parquet = pq.ParquetFile(archivo)
+        columna = parquet.read(columns=["id"]).column("id")
+        valores = ids.cast(columna.type)
+        if not pc.any(pc.is_in(columna, value_set=valores)).as_py():
+            continue
+        completa = parquet.read()
+        restante = completa.filter(pc.invert(pc.is_in(completa.column("id"), value_set=valores)))
+        carpeta = os.path.dirname(archivo)
+        if restante.num_rows:
+            pq.write_table(restante, os.path.join(carpeta, f"parte-{ejecucion}-r{reescritos}.parquet"))
+        os.replace(archivo, os.path.join(carpeta, f".{os.path.basename(archivo)}.reemplazado-{ejecucion}"))
+        reescritos += 1
+    return reescritos
+
+def preparar_lote(filas, columnas, config):
+    """DataFrame con tipos estables entre lotes y las columnas de partición"""
+    df = pd.DataFrame(filas, columns=columnas)
+    for columna in df.columns:
+        if df[columna].dtype == object:
+            # UUID, fechas en texto, etc. -> string de Arrow en todos los lotes
+            df[columna] = df[columna].map(lambda v: None if v is None else str(v)).astype("string")
+    if config["columna_fecha"]:
+        fechas = pd.to_datetime(df[config["columna_fecha"]], errors="coerce")
+        df["mes"] = fechas.dt.strftime("%Y-%m").fillna("sin_fecha")
+    if config["grupo"]:
+        nombre, origen = config["grupo"]
+        # Los valores con '/' u otros caracteres especiales los codifica el particionado (URI)
+        df[nombre] = df[origen].fillna("sin_dato").astype(str)
+    return df
+
+def columnas_particion(config):
+    columnas = []
+    if config["columna_fecha"]:
+        columnas.append("mes")
+    if config["grupo"]:
+        columnas.append(config["grupo"][0])
+    return columnas
+
+def particionado(tabla):
+    """Esquema de particiones explícito: sin él Arrow inferiría '2024-01' o códigos numéricos como enteros"""
+    columnas = columnas_particion(TABLAS[tabla])
+    if not columnas:
+        return None
+    return ds.partitioning(pa.schema([(c, pa.string()) for c in columnas]), flavor="hive")
+
+def exportar_tabla(engine, destino, tabla, config, estado, ejecucion, completo):
+    """
+    Exporta una tabla en lotes con un cursor del servidor; devuelve (filas, marca xid,
+    nombre del índice de ubicaciones)
+    """
+    ruta_tabla = os.path.join(destino, tabla)
+    info = estado["tablas"].get(tabla, {})
+    marca_anterior = info.get("marca_xid")
+    incremental = config["incremental"] and not completo and marca_anterior is not None and os.path.isdir(ruta_tabla)
+
+    total = 0
+    escritas = []
+    with engine.connect().execution_options(isolation_level="REPEATABLE READ") as conn, conn.begin():
+        marca = conn.execute(SQL_MARCA).scalar()
+        if incremental and marca - marca_anterior > MAX_DISTANCIA_XID:
+            print(f"{tabla}: la marca anterior es demasiado antigua, se exporta completa")
+            incremental = False
+
+        parametros = {}
+        if incremental:
+            parametros = {"marca": str(marca_anterior % 2 ** 32)}
+            previas = cargar_ubicaciones(destino, tabla, config, info)
+            cambiados = ids_arrow(conn, text(f"SELECT id FROM {tabla} WHERE {CONDICION_CAMBIO}"), parametros)
+            ubicaciones = sin_ids(previas, cambiados)
+            # Toda fila viva está en el índice o entre las cambiadas: si el conteo no cuadra hubo
+            # borrados en el origen y se buscan comparando el índice con los ids actuales
+            vivas = conn.execute(text(f"SELECT count(*) FROM {tabla}")).scalar()
+            borrados = pa.array([], pa.int64())
+            if vivas < ubicaciones.num_rows + len(cambiados):
+                actuales = ids_arrow(conn, text(f"SELECT id FROM {tabla}"), {})
+                borrados = sin_ids(ubicaciones.select(["id"]), actuales).column("id").combine_chunks()
+                ubicaciones = sin_ids(ubicaciones, borrados)
+            reescritos = quitar_filas(ruta_tabla, config, previas, pa.concat_arrays([cambiados, borrados]), ejecucion)
+            if reescritos or len(borrados):
+                print(f"{tabla}: {reescritos} archivos reescritos, {len(borrados)} filas borradas en el origen")
+            sql = text(f"SELECT * FROM {tabla} WHERE {CONDICION_CAMBIO} ORDER BY id")
+        else:
+            shutil.rmtree(ruta_tabla, ignore_errors=True)
+            ubicaciones = esquema_ubicaciones(config).empty_table() if config["incremental"] else None
+            sql = text(f"SELECT * FROM {tabla}")
+
+        resultado = conn.execution_options(stream_results=True, max_row_buffer=TAMANO_LOTE).execute(sql, parametros)
+        columnas = list(resultado.keys())
+        for numero, filas in enumerate(resultado.partitions(TAMANO_LOTE)):
+            df = preparar_lote(filas, columnas, config)
+            tabla_arrow = pa.Table.from_pandas(df, preserve_index=False)
+            pq.write_to_dataset(
+                tabla_arrow,
+                root_path=ruta_tabla,
+                partitioning=particionado(tabla),
+                basename_template=f"parte-{ejecucion}-{numero}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+            )
+            if ubicaciones is not None:
+                escritas.append(tabla_arrow.select(ubicaciones.column_names).cast(ubicaciones.schema))
+            total += len(df)
+
+    nombre = None
+    if ubicaciones is not None:
+        nombre = guardar_ubicaciones(destino, tabla, ejecucion, pa.concat_tables([ubicaciones] + escritas))
+    return total, (marca if config["incremental"] else None), nombre
+
+def exportar(engine, destino=DESTINO, completo=False, tablas=None):
+    """Exporta las tablas indicadas (todas por defecto) y actualiza las marcas incrementales"""
+    requerir_pyarrow()
+    os.makedirs(destino, exist_ok=True)
+    estado = leer_estado(destino)
+    if estado.get("ejecucion_en_curso"):
+        limpiar_ejecucion(destino, estado["ejecucion_en_curso"])
+
+    ejecucion = datetime.now().strftime("%Y%m%d%H%M%S")
+    estado["ejecucion_en_curso"] = ejecucion
+    escribir_estado(destino, estado)
+
+    resumen = {}
+    for tabla in tablas or TABLAS:
+        config = TABLAS[tabla]
+        filas, marca, ubicaciones = exportar_tabla(engine, destino, tabla, config, estado, ejecucion, completo)
+        resumen[tabla] = filas
+        estado["tablas"][tabla] = {"marca_xid": marca, "exportado": datetime.now().isoformat(), "ubicaciones": ubicaciones}
+        print(f"{tabla}: {filas} filas exportadas")
+
+    estado["ejecucion_en_curso"] = None
+    escribir_estado(destino, estado)
+    # La ejecución quedó registrada: los originales reemplazados ya no hacen falta
+    for archivo in ocultos(destino, ejecucion):
+        os.remove(archivo)
+    limpiar_ubicaciones(destino, estado)
+    return resumen
+
+# Lectura para el código de analítica
+
+def dataset(tabla, destino=DESTINO):
+    """Dataset de Arrow con las particiones Hive como columnas (sin leer los datos)"""
+    requerir_pyarrow()
+    return ds.dataset(os.path.join(destino, tabla), format="parquet", partitioning=particionado(tabla))
+
+def cargar_arrow(tabla, columnas=None, filtro=None, destino=DESTINO):
+    """
+    Tabla de Arrow leída con memory map. filtro es una expresión de pyarrow.dataset,
+    p. ej. ds.field("mes") >= "2024-01"; las particiones que no cumplen no se leen.
+    """
+    requerir_pyarrow()
+    ruta = os.path.join(destino, tabla)
+    return pq.read_table(ruta, columns=columnas, filters=filtro, memory_map=True, partitioning=particionado(tabla))
+
+def cargar_pandas(tabla, columnas=None, filtro=None, destino=DESTINO):
+    return cargar_arrow(tabla, columnas, filtro, destino).to_pandas()
+
+def existe(tabla, destino=DESTINO):
+    return os.path.isdir(os.path.join(destino, tabla))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Snapshots Parquet de las tablas clínicas")
+    sub = parser.add_subparsers(dest="comando")
+    p_exportar = sub.add_parser("exportar")
+    p_exportar.add_argument("--completo", action="store_true", help="Reescribe todo en lugar de agregar")
+    p_exportar.add_argument("--destino", default=DESTINO)
+    p_exportar.add_argument("--tabla", action="append", choices=list(TABLAS))
+    p_resumen = sub.add_parser("resumen")
+    p_resumen.add_argument("--destino", default=DESTINO)
+    args = parser.parse_args()
+
+    if args.comando == "exportar":
+        from database import engine
+
+        inicio = datetime.now()
+        exportar(engine, args.destino, args.completo, args.tabla)
+        print(f"✅ Snapshot completado en {(datetime.now() - inicio).total_seconds():.1f}s")
+    elif args.comando == "resumen":
+        estado = leer_estado(args.destino)
+        for tabla, info in estado["tablas"].items():
+            filas = dataset(tabla, args.destino).count_rows() if existe(tabla, args.destino) else 0
+            print(f"{tabla}: {filas} filas, marca xid {info.get('marca_xid')}, exportado {info['exportado']}")
+    else:
+        parser.print_help()
+        sys.exit(1)
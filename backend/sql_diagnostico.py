@@ -0,0 +1,188 @@
+"""
+Diagnóstico de SQL para desarrollo y pruebas: detector de N+1 y registro de consultas lentas.
+
+Se activa con SQL_DIAGNOSTICO=1 (nunca en producción: cada consulta captura su pila).
+Con los eventos before/after_cursor_execute de todos los engines se registra, por
+solicitud HTTP o por bloque observar(), cuántas veces se ejecutó cada sentencia
+(normalizada: sin literales ni espacios repetidos) y desde qué línea del backend:
+
+- N+1: una misma sentencia repetida SQL_UMBRAL_REPETICIONES veces o más en la misma
+  solicitud (p. ej. un SELECT del paciente por cada entrada de un bundle).
+- Lentas: las consultas que tardan más de SQL_LENTA_MS se imprimen al momento con la pila
+  de llamadas del backend que las originó.
+
+Las advertencias se imprimen al terminar la solicitud, se emiten como AdvertenciaSQL con
+warnings.warn (visibles en pytest, p. ej. con -W error::sql_diagnostico.AdvertenciaSQL) y
+viajan en las cabeceras X-SQL-Consultas, X-SQL-Tiempo-Ms y X-SQL-Advertencias de la respuesta.
+"""
+import contextvars
+import os
+import re
+import time
+import traceback
+import warnings
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+ACTIVO = os.getenv("SQL_DIAGNOSTICO", "").lower() in ("1", "true", "si")
+UMBRAL_REPETICIONES = int(os.getenv("SQL_UMBRAL_REPETICIONES", "5"))
+LENTA_MS = float(os.getenv("SQL_LENTA_MS", "200"))
+
+DIRECTORIO_BACKEND = os.path.dirname(os.path.abspath(__file__))
+LARGO_CABECERA = 512
+
+registro_actual = contextvars.ContextVar("registro_sql", default=None)
+
+class AdvertenciaSQL(UserWarning):
+    """N+1 o consulta lenta detectada por el diagnóstico"""
+
+LITERALES = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+ESPACIOS = re.compile(r"\s+")
+
+def normalizar(sentencia):
+    """Misma forma para sentencias que solo difieren en literales o formato"""
+    return ESPACIOS.sub(" ", LITERALES.sub("?", sentencia)).strip()
+
+def sitio_llamada(profundidad=4):
+    """Últimos frames del backend (sin SQLAlchemy ni este módulo) que llevaron a la consulta"""
+    propio = os.path.abspath(__file__)
+    frames = [
+        f for f in traceback.extract_stack()[:-1]
+        if os.path.abspath(f.filename).startswith(DIRECTORIO_BACKEND) and os.path.abspath(f.filename) != propio
+    ]
+    return [f"{os.path.basename(f.filename)}:{f.lineno} {f.name}" for f in frames[-profundidad:]]
+
+class RegistroSQL:
+    """Consultas de una solicitud agrupadas por sentencia normalizada"""
+
+    def __init__(self, etiqueta):
+        self.etiqueta = etiqueta
+        self.consultas = 0
+        self.tiempo_ms = 0.0
+        self.sentencias = {}  # normalizada -> {"veces", "tiempo_ms", "origen"}
+        self.lentas = []
+
+    def agregar(self, sentencia, duracion_ms):
+        self.consultas += 1
+        self.tiempo_ms += duracion_ms
+        grupo = self.sentencias.get(sentencia)
+        if grupo is None:
+            grupo = self.sentencias[sentencia] = {"veces": 0, "tiempo_ms": 0.0, "origen": sitio_llamada(1)}
+        grupo["veces"] += 1
+        grupo["tiempo_ms"] += duracion_ms
+
+    def repetidas(self):
+        """Sentencias que superan el umbral de repeticiones, de la más repetida a la menos"""
+        return sorted(
+            ((s, g) for s, g in self.sentencias.items() if g["veces"] >= UMBRAL_REPETICIONES),
+            key=lambda item: -item[1]["veces"],
+        )
+
+    def avisos_repetidas(self):
+        return [
+            f"N+1: {g['veces']}x ({g['tiempo_ms']:.0f} ms) {s[:120]} [{', '.join(g['origen'])}]"
+            for s, g in self.repetidas()
+        ]
+
+    def advertencias(self):
+        avisos = self.avisos_repetidas()
+        avisos += [f"Lenta: {duracion:.0f} ms {s[:120]} [{', '.join(origen)}]" for s, duracion, origen in self.lentas]
+        return avisos
+
+    def cabeceras(self):
+        """Cabeceras de depuración (latin-1, largo acotado)"""
+        cabeceras = [
+            (b"x-sql-consultas", str(self.consultas).encode()),
+            (b"x-sql-tiempo-ms", f"{self.tiempo_ms:.1f}".encode()),
+        ]
+        avisos = self.advertencias()
+        if avisos:
+            cabeceras.append((b"x-sql-advertencias", " | ".join(avisos)[:LARGO_CABECERA].encode("latin-1", "replace")))
+        return cabeceras
+
+    def imprimir(self):
+        for aviso in self.advertencias():
+            print(f"⚠️ SQL {self.etiqueta}: {aviso}")
+        # Las lentas ya se emitieron como advertencia al ejecutarse
+        for aviso in self.avisos_repetidas():
+            advertir(f"{self.etiqueta}: {aviso}")
+
+def advertir(mensaje):
+    warnings.warn(mensaje, AdvertenciaSQL, stacklevel=2)
+
+def antes_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("inicios_sql", []).append(time.perf_counter())
+
+def despues_de_ejecutar(conn, cursor, statement, parameters, context, executemany):
+    inicios = conn.info.get("inicios_sql")
+    if not inicios:
+        return
+    duracion_ms = (time.perf_counter() - inicios.pop()) * 1000
+    sentencia = normalizar(statement)
+    registro = registro_actual.get()
+    if registro is not None:
+        registro.agregar(sentencia, duracion_ms)
+    if duracion_ms >= LENTA_MS:
+        origen = sitio_llamada()
+        print(f"🐢 Consulta lenta ({duracion_ms:.0f} ms): {sentencia[:200]}")
+        for linea in origen:
+            print(f"    {linea}")
+        advertir(f"Lenta: {duracion_ms:.0f} ms {sentencia[:120]} [{', '.join(origen)}]")
+        if registro is not None:
+            registro.lentas.append((sentencia, duracion_ms, origen))
+
+def al_fallar(contexto):
+    """Una sentencia que falla no llega a after_cursor_execute: se descarta su inicio"""
+    conn = contexto.connection
+    if conn is not None and contexto.execution_context is not None and conn.info.get("inicios_sql"):
+        conn.info["inicios_sql"].pop()
+
+_instalado = False
+
+def instalar():
+    """Registra los eventos en todos los engines (primario y réplicas); idempotente"""
+    global _instalado
+    if _instalado:
+        return
+    event.listen(Engine, "before_cursor_execute", antes_de_ejecutar)
+    event.listen(Engine, "after_cursor_execute", despues_de_ejecutar)
+    event.listen(Engine, "handle_error", al_fallar)
+    _instalado = True
+
+@contextmanager
+def observar(etiqueta):
+    """Registra las consultas del bloque e imprime sus advertencias al salir (scripts y pruebas)"""
+    instalar()
+    registro = RegistroSQL(etiqueta)
+    token = registro_actual.set(registro)
+    try:
+        yield registro
+    finally:
+        registro_actual.reset(token)
+        registro.imprimir()
+
+class MiddlewareDiagnosticoSQL:
+    """Middleware ASGI: un RegistroSQL por solicitud y cabeceras X-SQL-* en la respuesta"""
+
+    def __init__(self, app):
+        self.app = app
+        instalar()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        registro = RegistroSQL(f"{scope['method']} {scope['path']}")
+        token = registro_actual.set(registro)
+
+        async def send_con_cabeceras(mensaje):
+            if mensaje["type"] == "http.response.start":
+                mensaje = {**mensaje, "headers": list(mensaje.get("headers", [])) + registro.cabeceras()}
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, send_con_cabeceras)
+        finally:
+            registro_actual.reset(token)
+            registro.imprimir()
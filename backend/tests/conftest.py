@@ -0,0 +1,48 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+# Los módulos del backend se importan de forma plana (import prompts), como en main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Las pruebas de integración usan una base PostgreSQL propia (PRUEBAS_DATABASE_URL). Debe
+# fijarse antes de que algún módulo importe database.py, que crea el engine al importarse.
+BASE_PRUEBAS = os.getenv("PRUEBAS_DATABASE_URL")
+if BASE_PRUEBAS:
+    os.environ["DATABASE_URL"] = BASE_PRUEBAS
+
+@pytest.fixture(scope="session")
+def app_principal():
+    """Módulo main contra la base de pruebas; se omite si no hay PostgreSQL configurado"""
+    if not BASE_PRUEBAS:
+        pytest.skip("PRUEBAS_DATABASE_URL no definida")
+    import main
+    return main
+
+@pytest.fixture(scope="session")
+def cliente(app_principal):
+    """TestClient sin eventos de inicio (hilos de refresco, listener de notificaciones)"""
+    from fastapi.testclient import TestClient
+    return TestClient(app_principal.app)
+
+@pytest.fixture
+def pacientes_creados(app_principal):
+    """Lista donde cada prueba anota los ids de paciente que crea; se eliminan al terminar"""
+    ids = []
+    yield ids
+    if not ids:
+        return
+    import models
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        uuids = [uuid.UUID(str(i)) for i in ids]
+        for modelo in (models.Observacion, models.Medicacion, models.HistorialMedico):
+            db.query(modelo).filter(modelo.paciente_id.in_(uuids)).delete(synchronize_session=False)
+        db.query(models.Paciente).filter(models.Paciente.id.in_(uuids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
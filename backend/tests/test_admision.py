@@ -0,0 +1,129 @@
+"""Control de admisión: cupos por clase, cola por prioridad y rechazos con Retry-After"""
+import asyncio
+import json
+
+import pytest
+
+import admision
+
+LIMITES = {"interactiva": 2, "ia": 1, "lote": 1}
+ESPERAS = {"interactiva": 1.0, "ia": 1.0, "lote": 1.0}
+
+def crear_control(**cambios):
+    opciones = {"capacidad": 2, "limites": LIMITES, "tamano_cola": 4, "espera_maxima": ESPERAS, "cubetas": {}}
+    opciones.update(cambios)
+    return admision.ControlAdmision(**opciones)
+
+async def llamar(app, ruta, cliente="c1"):
+    """Solicitud POST directa al ASGI; devuelve (status, cabeceras, cuerpo)"""
+    scope = {"type": "http", "method": "POST", "path": ruta, "query_string": b"",
+             "headers": [(b"x-cliente-id", cliente.encode())]}
+    mensajes = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"{}", "more_body": False}
+
+    async def send(mensaje):
+        mensajes.append(mensaje)
+
+    await app(scope, receive, send)
+    inicio = mensajes[0]
+    cuerpo = b"".join(m.get("body", b"") for m in mensajes[1:])
+    return inicio["status"], dict(inicio["headers"]), cuerpo
+
+class AppLenta:
+    """App ASGI falsa que tarda hasta que se libera y registra cuántas corren a la vez"""
+
+    def __init__(self):
+        self.liberar = asyncio.Event()
+        self.activas = 0
+        self.max_activas = 0
+
+    async def __call__(self, scope, receive, send):
+        self.activas += 1
+        self.max_activas = max(self.max_activas, self.activas)
+        try:
+            await self.liberar.wait()
+        finally:
+            self.activas -= 1
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+@pytest.mark.parametrize("metodo, ruta, clase", [
+    ("GET", "/health", None),
+    ("GET", "/eventos/cambios", None),
+    ("POST", "/ai/prediccion-tendencias", "ia"),
+    ("POST", "/fhir/import", "lote"),
+    ("POST", "/analytics/cohortes/calcular", "lote"),
+    ("GET", "/fhir/Patient/123", "interactiva"),
+])
+def test_clasificar(metodo, ruta, clase):
+    assert admision.clasificar(metodo, ruta) == clase
+
+def test_limite_por_clase_encola_hasta_liberar():
+    async def escenario():
+        app = AppLenta()
+        middleware = admision.MiddlewareAdmision(app, control=crear_control())
+        tareas = [asyncio.create_task(llamar(middleware, "/ai/x", f"c{i}")) for i in range(3)]
+        await asyncio.sleep(0.05)
+        en_cola = middleware.control.estado()["en_cola"]["ia"]
+        app.liberar.set()
+        return app.max_activas, en_cola, await asyncio.gather(*tareas)
+
+    max_activas, en_cola, resultados = asyncio.run(escenario())
+    assert max_activas == 1
+    assert en_cola == 2
+    assert [status for status, _, _ in resultados] == [200, 200, 200]
+
+def test_prioridad_interactiva_antes_que_lote():
+    async def escenario():
+        control = crear_control(capacidad=1)
+        await control.admitir("lote", "c1")
+        orden = []
+
+        async def esperar(clase):
+            await control.admitir(clase, "c1")
+            orden.append(clase)
+            control.liberar(clase)
+
+        tareas = [asyncio.create_task(esperar("lote")), asyncio.create_task(esperar("interactiva"))]
+        await asyncio.sleep(0.01)
+        control.liberar("lote")
+        await asyncio.gather(*tareas)
+        return orden
+
+    assert asyncio.run(escenario()) == ["interactiva", "lote"]
+
+def test_espera_excedida_responde_503_con_retry_after():
+    async def escenario():
+        app = AppLenta()
+        control = crear_control(espera_maxima={**ESPERAS, "ia": 0.05})
+        middleware = admision.MiddlewareAdmision(app, control=control)
+        primera = asyncio.create_task(llamar(middleware, "/ai/x"))
+        await asyncio.sleep(0.01)
+        rechazada = await llamar(middleware, "/ai/x", "c2")
+        app.liberar.set()
+        await primera
+        return rechazada, control.estado()
+
+    (status, cabeceras, cuerpo), estado = asyncio.run(escenario())
+    assert status == 503
+    assert int(cabeceras[b"retry-after"]) >= 1
+    assert json.loads(cuerpo)["clase"] == "ia"
+    assert estado["rechazos"]["ia"]["espera_excedida"] == 1
+    assert estado["en_curso"]["ia"] == 0
+
+def test_cubeta_por_cliente_responde_429():
+    async def escenario():
+        app = AppLenta()
+        app.liberar.set()
+        control = crear_control(cubetas={"ia": (0.01, 2)})
+        middleware = admision.MiddlewareAdmision(app, control=control)
+        propias = [await llamar(middleware, "/ai/x", "c1") for _ in range(3)]
+        otro = await llamar(middleware, "/ai/x", "c2")
+        return propias, otro
+
+    propias, otro = asyncio.run(escenario())
+    assert [status for status, _, _ in propias] == [200, 200, 429]
+    assert int(propias[2][1][b"retry-after"]) >= 1
+    assert otro[0] == 200
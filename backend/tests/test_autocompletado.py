@@ -0,0 +1,89 @@
+"""Autocompletado: búsqueda por prefijo con bisect y actualización del índice al hacer commit"""
+import uuid
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+import autocompletado
+
+def crear_indice(*pacientes):
+    indice = autocompletado.IndicePrefijos()
+    for pid, rut, nombre, apellido in pacientes:
+        indice.actualizar(pid, rut, nombre, apellido)
+    return indice
+
+def ids(resultado):
+    return [p["id"] for p in resultado]
+
+def test_claves_normalizadas():
+    claves = autocompletado.claves_paciente("José Luis", "Pérez", "12.345.678-K")
+    assert {"jose luis", "perez", "jose luis perez", "perez jose luis", "jose", "luis", "12345678k"} == claves
+
+@pytest.mark.parametrize("prefijo, esperado", [
+    ("jo", ["p1"]),
+    ("PÉR", ["p1"]),
+    ("perez jo", ["p1"]),
+    # En orden de clave: "sofia" < "soto"
+    ("so", ["p3", "p2"]),
+    ("12.345", ["p1"]),
+    ("12345678-k", ["p1"]),
+    ("9876", ["p2"]),
+    ("x", []),
+    ("  ", []),
+])
+def test_buscar_por_prefijo(prefijo, esperado):
+    indice = crear_indice(
+        ("p1", "12.345.678-K", "José Luis", "Pérez"),
+        ("p2", "9876543-2", "Ana", "Soto"),
+        ("p3", None, "Sofía", "Rojas"),
+    )
+    assert ids(indice.buscar(prefijo)) == esperado
+
+def test_buscar_limita_a_k_pacientes_distintos():
+    indice = crear_indice(*[(f"p{i}", None, "Ana", f"Soto{i}") for i in range(5)])
+    # Cada paciente tiene varias claves que empiezan con "ana"; se cuenta una vez
+    assert len(indice.buscar("ana", k=3)) == 3
+    assert len(set(ids(indice.buscar("ana")))) == 5
+
+def test_actualizar_reemplaza_las_claves_anteriores():
+    indice = crear_indice(("p1", None, "Ana", "Soto"))
+    indice.actualizar("p1", None, "Ana", "Rojas")
+    assert ids(indice.buscar("soto")) == []
+    assert ids(indice.buscar("rojas")) == ["p1"]
+    indice.eliminar("p1")
+    assert indice.entradas == [] and indice.buscar("ana") == []
+
+def test_commit_actualiza_el_indice_y_rollback_no(app_principal, pacientes_creados, monkeypatch):
+    import models
+    from database import SessionLocal
+
+    indice = autocompletado.IndicePrefijos()
+    monkeypatch.setattr(autocompletado, "indice", indice)
+    apellido = f"Autocompletado{uuid.uuid4().hex[:8]}"
+    db = SessionLocal()
+    try:
+        descartado = models.Paciente(id=uuid.uuid4(), nombre="Descartado", apellido=apellido)
+        db.add(descartado)
+        db.flush()
+        db.rollback()
+        assert indice.buscar(apellido) == []
+
+        paciente = models.Paciente(id=uuid.uuid4(), nombre="Marta", apellido=apellido)
+        pacientes_creados.append(paciente.id)
+        db.add(paciente)
+        db.flush()
+        # Hasta el commit el cambio queda pendiente en la sesión
+        assert indice.buscar(apellido) == []
+        db.commit()
+        assert ids(indice.buscar(apellido)) == [str(paciente.id)]
+
+        paciente.nombre = "Martina"
+        db.commit()
+        assert indice.buscar(apellido)[0]["nombre"] == "Martina"
+
+        db.delete(paciente)
+        db.commit()
+        assert indice.buscar(apellido) == []
+    finally:
+        db.close()
@@ -0,0 +1,55 @@
+"""Búsqueda: fragmentos escapados, prefijos LIKE literales e índice en memoria de desarrollo"""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+import busqueda
+import models
+from texto import escapar_like
+
+class SesionFalsa:
+    """Lo mínimo de una sesión SQLite para el índice en memoria"""
+
+    def __init__(self, pacientes, historiales):
+        self.filas = {models.Paciente: pacientes, models.HistorialMedico: historiales}
+
+    def get_bind(self, mapper=None, clause=None):
+        return SimpleNamespace(dialect=SimpleNamespace(name="sqlite"))
+
+    def query(self, modelo):
+        return SimpleNamespace(all=lambda: self.filas[modelo])
+
+def test_marcar_escapa_el_texto_de_la_nota():
+    fragmento = f"<img src=x onerror=alert(1)> {busqueda.SEL_INICIO}dolor{busqueda.SEL_FIN} & fiebre"
+    assert busqueda.marcar(fragmento) == "&lt;img src=x onerror=alert(1)&gt; <mark>dolor</mark> &amp; fiebre"
+
+@pytest.mark.parametrize("prefijo, esperado", [
+    ("12.345", "12.345"),
+    ("12%", "12\\%"),
+    ("1_3", "1\\_3"),
+    ("a\\b", "a\\\\b"),
+])
+def test_escapar_like(prefijo, esperado):
+    assert escapar_like(prefijo) == esperado
+
+def test_indice_en_memoria_fuera_de_postgresql(monkeypatch):
+    monkeypatch.setattr(busqueda, "indice_memoria", busqueda.IndiceBusquedaMemoria())
+    pacientes = [
+        SimpleNamespace(id="p1", rut="12345678-9", nombre="José", apellido="Pérez", alergias="<b>penicilina</b>"),
+        SimpleNamespace(id="p2", rut="9876543-2", nombre="Ana", apellido="Soto", alergias=None),
+    ]
+    historiales = [SimpleNamespace(
+        id=7, paciente_id="p2", observaciones="Cefalea tensional", antecedentes_familiares=None, tratamientos_actuales=None
+    )]
+    db = SesionFalsa(pacientes, historiales)
+
+    resultado = busqueda.buscar(db, "jose perez")
+    assert [p["id"] for p in resultado["pacientes"]] == ["p1"]
+
+    notas = busqueda.buscar(db, "penicilina")["notas"]
+    assert notas[0]["paciente_id"] == "p1"
+    assert notas[0]["fragmento"] == "&lt;b&gt;<mark>penicilina</mark>&lt;/b&gt;"
+
+    assert [n["id"] for n in busqueda.buscar(db, "cefalea")["notas"]] == ["7"]
@@ -0,0 +1,63 @@
+"""Búsqueda FHIR de observaciones: prefijos de comparación y filtros de fecha y valor"""
+import uuid
+from datetime import datetime
+
+import pytest
+
+@pytest.mark.parametrize("valor, esperado", [
+    ("ge2024-01-01", ("ge", "2024-01-01")),
+    ("lt200", ("lt", "200")),
+    ("ne5|http://unitsofmeasure.org|mg/dL", ("ne", "5|http://unitsofmeasure.org|mg/dL")),
+    ("2024-01-01", ("eq", "2024-01-01")),
+    ("200", ("eq", "200")),
+    # "sa"/"eb"/"ap" no están soportados: el valor queda entero y falla al convertirse
+    ("sa2024-01-01", ("eq", "sa2024-01-01")),
+])
+def test_separar_prefijo_busqueda(app_principal, valor, esperado):
+    assert app_principal.separar_prefijo_busqueda(valor) == esperado
+
+@pytest.fixture
+def paciente_con_observaciones(app_principal, pacientes_creados):
+    import models
+    from database import SessionLocal
+
+    paciente_id = uuid.uuid4()
+    pacientes_creados.append(paciente_id)
+    db = SessionLocal()
+    try:
+        db.add(models.Paciente(id=paciente_id, nombre="Busqueda", apellido="Observaciones"))
+        db.flush()
+        for codigo, valor, fecha in (
+            ("2093-3", 240, datetime(2024, 1, 10, 8, 30)),
+            ("2093-3", 210, datetime(2024, 3, 5, 9, 0)),
+            ("2093-3", 190, datetime(2024, 6, 20, 7, 45)),
+            ("2571-8", 150, datetime(2024, 3, 5, 9, 0)),
+        ):
+            db.add(models.Observacion(paciente_id=paciente_id, codigo=codigo, valor=valor, unidad="mg/dL", fecha_efectiva=fecha))
+        db.commit()
+    finally:
+        db.close()
+    return str(paciente_id)
+
+def valores(cliente, paciente_id, consulta):
+    respuesta = cliente.get(f"/fhir/Observation?subject=Patient/{paciente_id}&{consulta}")
+    assert respuesta.status_code == 200, respuesta.text
+    return [e["resource"]["valueQuantity"]["value"] for e in respuesta.json()["entry"]]
+
+@pytest.mark.parametrize("consulta, esperado", [
+    ("code=2093-3", [240, 210, 190]),
+    ("code=http://loinc.org|2093-3,2571-8&_sort=-date,value", [190, 150, 210, 240]),
+    # Una fecha sin prefijo ni hora abarca el día completo
+    ("code=2093-3&date=2024-03-05", [210]),
+    ("code=2093-3&date=ge2024-03-01&date=lt2024-06-01", [210]),
+    ("code=2093-3&value-quantity=gt200&_sort=-value", [240, 210]),
+    ("value-quantity=le190|http://unitsofmeasure.org|mg/dL", [150, 190]),
+    ("code=2093-3&_count=1", [240]),
+])
+def test_filtros_de_busqueda(cliente, paciente_con_observaciones, consulta, esperado):
+    assert valores(cliente, paciente_con_observaciones, consulta) == esperado
+
+@pytest.mark.parametrize("consulta", ["date=ge10-01-2024", "value-quantity=gtalto", "_sort=codigo"])
+def test_parametros_invalidos_responden_400(cliente, paciente_con_observaciones, consulta):
+    respuesta = cliente.get(f"/fhir/Observation?subject=Patient/{paciente_con_observaciones}&{consulta}")
+    assert respuesta.status_code == 400
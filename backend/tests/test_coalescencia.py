@@ -0,0 +1,117 @@
+"""Coalescencia de /ai/*: un cálculo por clave, solo 2xx compartidos y fuera de la admisión"""
+import asyncio
+import json
+
+import admision
+import coalescencia
+
+async def llamar(app, ruta, cuerpo, cliente="c1"):
+    """Solicitud POST directa al ASGI; devuelve (status, cuerpo)"""
+    scope = {"type": "http", "method": "POST", "path": ruta, "query_string": b"",
+             "headers": [(b"x-cliente-id", cliente.encode())]}
+    mensajes = []
+
+    async def receive():
+        return {"type": "http.request", "body": cuerpo, "more_body": False}
+
+    async def send(mensaje):
+        mensajes.append(mensaje)
+
+    await app(scope, receive, send)
+    return mensajes[0]["status"], b"".join(m.get("body", b"") for m in mensajes[1:])
+
+class AppContada:
+    """App ASGI falsa: cuenta las ejecuciones y responde con el estado configurado"""
+
+    def __init__(self, status=200):
+        self.status = status
+        self.ejecuciones = 0
+        self.liberar = asyncio.Event()
+
+    async def __call__(self, scope, receive, send):
+        mensaje = await receive()
+        self.ejecuciones += 1
+        await self.liberar.wait()
+        cuerpo = json.dumps({"n": self.ejecuciones, "eco": json.loads(mensaje["body"])}).encode()
+        await send({"type": "http.response.start", "status": self.status, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": cuerpo})
+
+async def en_paralelo(app, aplicacion, solicitudes):
+    tareas = [asyncio.create_task(llamar(app, *s)) for s in solicitudes]
+    await asyncio.sleep(0.02)
+    aplicacion.liberar.set()
+    return await asyncio.gather(*tareas)
+
+def test_clave_ignora_orden_y_formato_del_json():
+    scope = {"method": "POST", "path": "/ai/x", "query_string": b""}
+    assert coalescencia.clave_solicitud(scope, b'{"a": 1, "b": 2}') == coalescencia.clave_solicitud(scope, b'{"b":2,"a":1}')
+
+def test_coalescible():
+    assert coalescencia.coalescible({"type": "http", "method": "POST", "path": "/ai/prediccion"})
+    assert not coalescencia.coalescible({"type": "http", "method": "POST", "path": "/ai/chat/stream"})
+    assert not coalescencia.coalescible({"type": "http", "method": "GET", "path": "/ai/prediccion"})
+
+def test_duplicados_comparten_una_ejecucion():
+    async def escenario():
+        aplicacion = AppContada()
+        coalescedor = coalescencia.Coalescedor()
+        app = coalescencia.MiddlewareCoalescencia(aplicacion, coalescedor=coalescedor)
+        resultados = await en_paralelo(app, aplicacion, [
+            ("/ai/x", b'{"a": 1, "b": 2}'), ("/ai/x", b'{"b": 2, "a": 1}'), ("/ai/x", b'{"a": 1, "b": 3}'),
+        ])
+        return aplicacion.ejecuciones, coalescedor.estado(), resultados
+
+    ejecuciones, estado, resultados = asyncio.run(escenario())
+    assert ejecuciones == 2
+    assert estado["compartidas"] == 1
+    assert resultados[0] == resultados[1]
+    assert resultados[2] != resultados[0]
+
+def test_error_del_lider_no_se_comparte():
+    async def escenario():
+        aplicacion = AppContada(status=500)
+        app = coalescencia.MiddlewareCoalescencia(aplicacion, coalescedor=coalescencia.Coalescedor())
+        resultados = await en_paralelo(app, aplicacion, [("/ai/x", b"{}")] * 3)
+        return aplicacion.ejecuciones, resultados
+
+    ejecuciones, resultados = asyncio.run(escenario())
+    assert ejecuciones == 3
+    assert [status for status, _ in resultados] == [500, 500, 500]
+
+def test_lider_cancelado_promueve_a_una_en_espera():
+    async def escenario():
+        aplicacion = AppContada()
+        app = coalescencia.MiddlewareCoalescencia(aplicacion, coalescedor=coalescencia.Coalescedor())
+        lider = asyncio.create_task(llamar(app, "/ai/x", b"{}"))
+        await asyncio.sleep(0.01)
+        seguidoras = [asyncio.create_task(llamar(app, "/ai/x", b"{}")) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        lider.cancel()
+        await asyncio.sleep(0.01)
+        aplicacion.liberar.set()
+        return aplicacion.ejecuciones, await asyncio.gather(*seguidoras)
+
+    ejecuciones, resultados = asyncio.run(escenario())
+    assert ejecuciones == 2
+    assert resultados[0] == resultados[1]
+    assert resultados[0][0] == 200
+
+def test_duplicados_ocupan_un_solo_cupo_de_ia():
+    # Mismo orden que en main: la coalescencia envuelve a la admisión
+    async def escenario():
+        aplicacion = AppContada()
+        control = admision.ControlAdmision(
+            capacidad=4, limites={"interactiva": 4, "ia": 1, "lote": 1}, tamano_cola=1,
+            espera_maxima={"interactiva": 1.0, "ia": 1.0, "lote": 1.0}, cubetas={},
+        )
+        app = coalescencia.MiddlewareCoalescencia(
+            admision.MiddlewareAdmision(aplicacion, control=control), coalescedor=coalescencia.Coalescedor()
+        )
+        resultados = await en_paralelo(app, aplicacion, [("/ai/x", b"{}", f"c{i}") for i in range(5)])
+        return aplicacion.ejecuciones, control.estado(), resultados
+
+    ejecuciones, estado, resultados = asyncio.run(escenario())
+    assert ejecuciones == 1
+    assert [status for status, _ in resultados] == [200] * 5
+    assert estado["admitidas"]["ia"] == 1
+    assert estado["rechazos"]["ia"]["cola_llena"] == 0
@@ -0,0 +1,28 @@
+"""Cohortes: el suplemento vigente de cada paciente es el de fecha_inicio más reciente como fecha"""
+import uuid
+
+from sqlalchemy import text
+
+def suplemento_vigente(db, paciente_id):
+    import cohortes
+
+    sql = text(cohortes.SQL_BASE + " SELECT suplemento FROM suplementos WHERE paciente_id = :paciente_id")
+    return db.execute(sql, {"paciente_id": paciente_id}).scalar()
+
+def test_suplemento_vigente_ordena_por_fecha(app_principal, pacientes_creados):
+    import models
+    from database import SessionLocal
+
+    paciente_id = uuid.uuid4()
+    pacientes_creados.append(paciente_id)
+    db = SessionLocal()
+    try:
+        db.add(models.Paciente(id=paciente_id, nombre="Cohorte"))
+        db.flush()
+        # Como texto "2024-9-01" > "2024-10-01"; como fecha octubre es el más reciente
+        for suplemento, fecha in (("Vitamina D", "2024-9-01"), ("Omega-3", "2024-10-01"), ("Zinc", "sin fecha")):
+            db.add(models.HistorialMedico(paciente_id=paciente_id, suplemento=suplemento, fecha_inicio=fecha))
+        db.commit()
+        assert suplemento_vigente(db, paciente_id) == "Omega-3"
+    finally:
+        db.close()
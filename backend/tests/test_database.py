@@ -0,0 +1,51 @@
+"""Enrutamiento de SesionEnrutada entre réplica y primario (sin conectarse a ninguna base)"""
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("psycopg2")
+
+from sqlalchemy import create_engine, select, text
+
+import database
+import models
+
+class ReplicaFalsa:
+    def __init__(self):
+        self.engine = create_engine("postgresql://replica.invalid/salud_db")
+        self.sana = True
+
+    def disponible(self):
+        return True
+
+@pytest.fixture
+def sesion(monkeypatch):
+    replica = ReplicaFalsa()
+    monkeypatch.setattr(database, "replicas", [replica])
+    sesion = database.SessionLectura()
+    yield sesion, replica.engine
+    sesion.close()
+
+def test_lecturas_van_a_la_replica(sesion):
+    db, replica = sesion
+    assert db.get_bind(clause=select(models.Paciente)) is replica
+    assert db.get_bind(clause=text("SELECT 1")) is replica
+    assert not db.escribio
+
+@pytest.mark.parametrize("clausula", [
+    select(models.Paciente).with_for_update(),
+    select(models.Paciente).with_for_update(read=True),
+    select(models.Paciente).with_for_update(of=models.Paciente.__table__),
+    text("UPDATE pacientes SET nombre = 'x'"),
+    text("SELECT nextval('observaciones_id_seq')").columns(),
+])
+def test_no_lectura_va_al_primario_y_fija_la_sesion(sesion, clausula):
+    db, replica = sesion
+    assert db.get_bind(clause=clausula) is database.engine
+    assert db.escribio
+    # read-your-writes: lo siguiente también se lee del primario
+    assert db.get_bind(clause=select(models.Paciente)) is database.engine
+
+def test_opcion_solo_lectura_manda(sesion):
+    db, replica = sesion
+    assert db.get_bind(clause=text("SELECT pg_advisory_lock(1)").execution_options(solo_lectura=False)) is database.engine
+    assert db.escribio
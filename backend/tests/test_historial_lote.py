@@ -0,0 +1,74 @@
+"""POST /historial/batch: estado por fila y modo todo_o_nada"""
+import uuid
+
+import pytest
+
+def registro(paciente_id, fecha_inicio="2024-02-01", **cambios):
+    return {
+        "paciente_id": str(paciente_id), "suplemento": "Omega-3", "dosis": "1000mg",
+        "fecha_inicio": fecha_inicio, "duracion": "3 meses",
+        "colesterol_total": 210, "trigliceridos": 150, "vitamina_d": 0, "omega3_indice": 6,
+        "observaciones": "Lote", **cambios,
+    }
+
+@pytest.fixture
+def paciente(app_principal, pacientes_creados):
+    import models
+    from database import SessionLocal
+
+    paciente_id = uuid.uuid4()
+    pacientes_creados.append(paciente_id)
+    db = SessionLocal()
+    try:
+        db.add(models.Paciente(id=paciente_id, nombre="Historial", apellido="Lote"))
+        db.commit()
+    finally:
+        db.close()
+    return paciente_id
+
+def contar(modelo, paciente_id):
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        return db.query(modelo).filter(modelo.paciente_id == paciente_id).count()
+    finally:
+        db.close()
+
+def lote(cliente, registros, **parametros):
+    return cliente.post("/historial/batch", params=parametros, json=registros,
+                        headers={"X-Cliente-Id": f"historial-{uuid.uuid4()}"})
+
+def test_lote_parcial_informa_cada_fila(cliente, paciente):
+    import models
+
+    respuesta = lote(cliente, [
+        registro(paciente),
+        registro("no-es-uuid"),
+        registro(uuid.uuid4()),
+        # Fecha en texto libre: se guarda sin observaciones derivadas
+        registro(paciente, fecha_inicio="marzo"),
+    ])
+    assert respuesta.status_code == 200, respuesta.text
+    cuerpo = respuesta.json()
+    assert (cuerpo["creados"], cuerpo["rechazados"]) == (2, 2)
+    assert [(r["estado"], r.get("motivo"), r.get("observaciones")) for r in cuerpo["resultados"]] == [
+        ("creado", None, 3),
+        ("rechazado", "paciente_id inválido", None),
+        ("rechazado", "Paciente no encontrado", None),
+        ("creado", None, 0),
+    ]
+    assert contar(models.HistorialMedico, paciente) == 2
+    assert contar(models.Observacion, paciente) == 3
+
+def test_todo_o_nada_no_escribe_si_hay_rechazos(cliente, paciente):
+    import models
+
+    respuesta = lote(cliente, [registro(paciente), registro(uuid.uuid4())], todo_o_nada="true")
+    assert respuesta.status_code == 422
+    assert respuesta.json()["detail"]["rechazados"] == 1
+    assert contar(models.HistorialMedico, paciente) == 0
+
+def test_lote_demasiado_grande(cliente, app_principal, paciente, monkeypatch):
+    monkeypatch.setattr(app_principal, "MAX_HISTORIAL_LOTE", 1)
+    assert lote(cliente, [registro(paciente)] * 2).status_code == 413
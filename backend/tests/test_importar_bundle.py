@@ -0,0 +1,70 @@
+"""Importación de bundles FHIR: en modo batch una entrada inválida solo afecta a esa entrada"""
+import random
+import uuid
+
+def rut_aleatorio():
+    return f"{random.randint(1000000, 25000000)}-{random.choice('0123456789K')}"
+
+def paciente(paciente_id, rut):
+    return {
+        "fullUrl": f"urn:uuid:{paciente_id}",
+        "resource": {
+            "resourceType": "Patient",
+            "id": str(paciente_id),
+            "identifier": [{"system": "http://minsal.cl/rut", "value": rut}],
+            "name": [{"family": "Prueba", "given": ["Lote"]}],
+            "gender": "female",
+            "birthDate": "1980-05-01",
+        },
+        "request": {"method": "POST", "url": "Patient"},
+    }
+
+def observacion(paciente_id):
+    return {
+        "resource": {
+            "resourceType": "Observation",
+            "status": "final",
+            "subject": {"reference": f"urn:uuid:{paciente_id}"},
+            "code": {"coding": [{"system": "http://loinc.org", "code": "2093-3"}]},
+            "valueQuantity": {"value": 190, "unit": "mg/dL"},
+            "effectiveDateTime": "2024-01-15",
+        },
+        "request": {"method": "POST", "url": "Observation"},
+    }
+
+def test_batch_con_rut_demasiado_largo(cliente, pacientes_creados):
+    valido, invalido = uuid.uuid4(), uuid.uuid4()
+    pacientes_creados.extend([valido, invalido])
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "batch",
+        "entry": [
+            paciente(valido, rut_aleatorio()),
+            # Cumple el esquema FHIR pero no cabe en pacientes.rut (String(12)): DataError
+            paciente(invalido, "1" * 40),
+            observacion(valido),
+        ],
+    }
+    respuesta = cliente.post("/fhir/import", json=bundle)
+    assert respuesta.status_code == 200, respuesta.text
+    estados = [e["response"]["status"] for e in respuesta.json()["entry"]]
+    assert estados[0].startswith("201")
+    assert estados[1].startswith("400")
+    assert estados[2].startswith("201")
+
+    assert cliente.get(f"/fhir/Patient/{valido}").status_code == 200
+    assert cliente.get(f"/fhir/Patient/{invalido}").status_code == 404
+
+def test_transaction_con_rut_demasiado_largo_es_400(cliente, pacientes_creados):
+    valido, invalido = uuid.uuid4(), uuid.uuid4()
+    pacientes_creados.extend([valido, invalido])
+    bundle = {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "entry": [paciente(valido, rut_aleatorio()), paciente(invalido, "1" * 40)],
+    }
+    respuesta = cliente.post("/fhir/import", json=bundle)
+    assert respuesta.status_code == 400
+    assert respuesta.json()["resourceType"] == "OperationOutcome"
+    # La transacción se deshace completa
+    assert cliente.get(f"/fhir/Patient/{valido}").status_code == 404
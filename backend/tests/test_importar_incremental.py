@@ -0,0 +1,101 @@
+"""Sincronización incremental: hashes por recurso y upsert de pacientes (también por RUT)"""
+import random
+import uuid
+
+import pytest
+
+@pytest.fixture
+def sistema(app_principal):
+    """Sistema de origen propio de la prueba; sus hashes se eliminan al terminar"""
+    nombre = f"pruebas-{uuid.uuid4()}"
+    yield nombre
+    import models
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        db.query(models.RecursoFuente).filter(models.RecursoFuente.sistema == nombre).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+def rut_aleatorio():
+    return f"{random.randint(1000000, 25000000)}-{random.choice('0123456789K')}"
+
+def paciente(recurso_id, rut, nombre="Ana"):
+    return {"resource": {
+        "resourceType": "Patient",
+        "id": recurso_id,
+        "identifier": [{"system": "http://minsal.cl/rut", "value": rut}],
+        "name": [{"family": "Incremental", "given": [nombre]}],
+        "gender": "female",
+        "birthDate": "1975-03-02",
+    }}
+
+def observacion(recurso_id, paciente_id, valor=180):
+    return {"resource": {
+        "resourceType": "Observation",
+        "id": recurso_id,
+        "status": "final",
+        "subject": {"reference": f"Patient/{paciente_id}"},
+        "code": {"coding": [{"system": "http://loinc.org", "code": "2093-3"}]},
+        "valueQuantity": {"value": valor, "unit": "mg/dL"},
+        "effectiveDateTime": "2024-02-01",
+    }}
+
+def importar(cliente, sistema, *entradas):
+    respuesta = cliente.post(
+        f"/fhir/import?modo=incremental&sistema={sistema}",
+        json={"resourceType": "Bundle", "type": "collection", "entry": list(entradas)},
+        # Cliente distinto por llamada: la cubeta de tokens de la clase lote admite solo ráfagas de 2
+        headers={"X-Cliente-Id": str(uuid.uuid4())},
+    )
+    assert respuesta.status_code == 200, respuesta.text
+    return respuesta.json()
+
+def test_reimportar_sin_cambios_no_escribe(cliente, sistema, pacientes_creados):
+    paciente_id = str(uuid.uuid4())
+    pacientes_creados.append(paciente_id)
+    entradas = [paciente(paciente_id, rut_aleatorio()), observacion("obs-1", paciente_id)]
+
+    primera = importar(cliente, sistema, *entradas)
+    assert (primera["nuevos"], primera["actualizados"], primera["rechazados"]) == (2, 0, [])
+
+    segunda = importar(cliente, sistema, *entradas)
+    assert (segunda["nuevos"], segunda["actualizados"], segunda["sin_cambios"]) == (0, 0, 2)
+
+def test_recurso_modificado_se_actualiza(cliente, sistema, pacientes_creados):
+    paciente_id = str(uuid.uuid4())
+    pacientes_creados.append(paciente_id)
+    rut = rut_aleatorio()
+    importar(cliente, sistema, paciente(paciente_id, rut), observacion("obs-1", paciente_id, 180))
+
+    resultado = importar(cliente, sistema, paciente(paciente_id, rut), observacion("obs-1", paciente_id, 210))
+    assert (resultado["nuevos"], resultado["actualizados"], resultado["sin_cambios"]) == (0, 1, 1)
+    valores = [o["valueQuantity"]["value"] for o in cliente.get(f"/fhir/Observation/{paciente_id}").json()]
+    assert valores == [210]
+
+def test_id_nuevo_con_rut_existente_enlaza_al_paciente(cliente, sistema, pacientes_creados):
+    existente = str(uuid.uuid4())
+    pacientes_creados.append(existente)
+    rut = rut_aleatorio()
+    importar(cliente, f"{sistema}-otro", paciente(existente, rut))
+
+    # Otro sistema envía a la misma persona (mismo RUT) con su propio id, no UUID
+    resultado = importar(cliente, sistema, paciente("hce-991", rut, "Ana María"), observacion("obs-9", "hce-991"))
+    assert resultado["rechazados"] == []
+    assert cliente.get(f"/fhir/Patient/{existente}").json()["name"][0]["given"] == ["Ana María"]
+    assert len(cliente.get(f"/fhir/Observation/{existente}").json()) == 1
+
+    # Una importación posterior solo con la observación resuelve el paciente por su hash registrado
+    resultado = importar(cliente, sistema, observacion("obs-10", "hce-991"))
+    assert resultado["rechazados"] == []
+    assert len(cliente.get(f"/fhir/Observation/{existente}").json()) == 2
+
+def test_rut_repetido_en_el_bundle_se_rechaza_por_entrada(cliente, sistema, pacientes_creados):
+    primero, segundo = str(uuid.uuid4()), str(uuid.uuid4())
+    pacientes_creados.extend([primero, segundo])
+    rut = rut_aleatorio()
+    resultado = importar(cliente, sistema, paciente(primero, rut), paciente(segundo, rut))
+    assert resultado["nuevos"] == 1
+    assert [r["id"] for r in resultado["rechazados"]] == [segundo]
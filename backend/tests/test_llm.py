@@ -0,0 +1,60 @@
+"""Streaming del LLM: un fragmento que no llega corta la respuesta y cuenta para el interruptor"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("openai")
+
+import llm
+
+def fragmento(texto):
+    return SimpleNamespace(choices=[SimpleNamespace(delta={"content": texto})])
+
+def stream_falso(monkeypatch, pausas):
+    """acreate devuelve un stream que espera pausas[i] segundos antes del fragmento i"""
+    cerrado = []
+
+    async def generar():
+        try:
+            for i, pausa in enumerate(pausas):
+                await asyncio.sleep(pausa)
+                yield fragmento(f"t{i}")
+        finally:
+            cerrado.append(True)
+
+    async def acreate(**kwargs):
+        return generar()
+
+    monkeypatch.setattr(llm.openai.ChatCompletion, "acreate", acreate)
+    return cerrado
+
+@pytest.fixture
+def interruptor(monkeypatch):
+    nuevo = llm.InterruptorCircuito(min_llamadas=1, tasa_error=0.5)
+    monkeypatch.setattr(llm, "interruptor", nuevo)
+    monkeypatch.setattr(llm, "TIMEOUT_FRAGMENTO", 0.05)
+    return nuevo
+
+async def consumir():
+    return [texto async for texto in llm.completar_streaming([{"role": "user", "content": "hola"}])]
+
+def test_stream_completo_registra_exito(monkeypatch, interruptor):
+    stream_falso(monkeypatch, [0, 0, 0])
+    assert asyncio.run(consumir()) == ["t0", "t1", "t2"]
+    assert interruptor.resumen()["errores_en_ventana"] == 0
+    assert interruptor.estado == llm.CERRADO
+
+def test_fragmento_lento_corta_y_abre_el_interruptor(monkeypatch, interruptor):
+    cerrado = stream_falso(monkeypatch, [0, 5, 0])
+    recibidos = []
+
+    async def consumir_parcial():
+        async for texto in llm.completar_streaming([{"role": "user", "content": "hola"}]):
+            recibidos.append(texto)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(consumir_parcial())
+    assert recibidos == ["t0"]
+    assert cerrado == [True]
+    assert interruptor.estado == llm.ABIERTO
@@ -0,0 +1,116 @@
+"""Notificaciones de cambios: filtros, contrapresión y entrega por WebSocket y SSE"""
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+import notificaciones
+
+def cambio(tabla="observaciones", paciente_id="p1"):
+    return {"tipo": "cambio", "tabla": tabla, "operacion": "insert", "paciente_id": paciente_id}
+
+@pytest.fixture
+def distribuidor(monkeypatch):
+    nuevo = notificaciones.Distribuidor()
+    monkeypatch.setattr(notificaciones, "distribuidor", nuevo)
+    return nuevo
+
+def test_suscriptor_filtra_por_paciente_y_tabla():
+    suscriptor = notificaciones.Suscriptor("p1", ["observaciones"])
+    assert suscriptor.acepta(cambio())
+    assert not suscriptor.acepta(cambio(paciente_id="p2"))
+    assert not suscriptor.acepta(cambio(tabla="medicaciones"))
+    assert notificaciones.Suscriptor().acepta(cambio(tabla="pacientes", paciente_id="p9"))
+
+def test_cola_llena_descarta_y_pide_resincronizar(monkeypatch):
+    monkeypatch.setattr(notificaciones, "TAMANO_COLA", 2)
+    suscriptor = notificaciones.Suscriptor("p1", ["medicaciones", "observaciones"])
+    for _ in range(3):
+        suscriptor.entregar(cambio())
+    assert suscriptor.descartados == 1
+    assert suscriptor.cola.qsize() == 1
+    assert suscriptor.cola.get_nowait() == {
+        "tipo": "resincronizar", "motivo": "cliente lento", "tablas": ["medicaciones", "observaciones"]
+    }
+
+def test_publicar_reparte_y_aisla_oyentes_con_error(distribuidor):
+    recibidos = []
+
+    def oyente_roto(evento):
+        raise RuntimeError("falla")
+
+    distribuidor.agregar_oyente(oyente_roto)
+    distribuidor.agregar_oyente(recibidos.append)
+    propio = distribuidor.suscribir("p1")
+    ajeno = distribuidor.suscribir("p2")
+    distribuidor.publicar(cambio())
+
+    assert recibidos == [cambio()]
+    assert propio.cola.get_nowait() == cambio()
+    assert ajeno.cola.empty()
+    distribuidor.desuscribir(ajeno)
+    assert distribuidor.estado()["suscriptores"] == 1
+
+def test_resincronizacion_tras_reconexion(distribuidor):
+    suscriptor = distribuidor.suscribir(tablas=["pacientes"])
+    distribuidor.publicar_resincronizacion()
+    assert suscriptor.cola.get_nowait() == {"tipo": "resincronizar", "motivo": "reconexion", "tablas": ["pacientes"]}
+
+def test_formato_sse():
+    assert notificaciones.formato_sse({"tipo": "latido"}) == 'event: latido\ndata: {"tipo": "latido"}\n\n'
+
+async def conectar(app, scope, primer_mensaje, esperados):
+    """Abre el canal sobre el ASGI, publica un cambio y devuelve los mensajes enviados al cliente"""
+    enviados = []
+    recibido = asyncio.Event()
+    mensajes_cliente = [primer_mensaje]
+
+    async def receive():
+        if mensajes_cliente:
+            return mensajes_cliente.pop()
+        # El cliente sigue conectado sin enviar nada
+        await asyncio.Event().wait()
+
+    async def send(mensaje):
+        enviados.append(mensaje)
+        if len(enviados) >= esperados:
+            recibido.set()
+
+    tarea = asyncio.create_task(app(scope, receive, send))
+    while not notificaciones.distribuidor.suscriptores:
+        await asyncio.sleep(0.01)
+    notificaciones.distribuidor.publicar(cambio(paciente_id="p2"))
+    notificaciones.distribuidor.publicar(cambio())
+    await asyncio.wait_for(recibido.wait(), 5)
+    # La desconexión cancela la tarea; la suscripción debe liberarse
+    tarea.cancel()
+    await asyncio.gather(tarea, return_exceptions=True)
+    return enviados, notificaciones.distribuidor.estado()["suscriptores"]
+
+def test_websocket_entrega_cambios_del_paciente(app_principal, distribuidor):
+    scope = {"type": "websocket", "path": "/ws/cambios", "query_string": b"paciente_id=p1&tablas=observaciones",
+             "headers": [], "subprotocols": []}
+    # accept, suscrito y el cambio de p1
+    enviados, suscriptores = asyncio.run(conectar(app_principal.app, scope, {"type": "websocket.connect"}, 3))
+    assert enviados[0]["type"] == "websocket.accept"
+    assert json.loads(enviados[1]["text"])["tipo"] == "suscrito"
+    assert json.loads(enviados[2]["text"]) == cambio()
+    assert suscriptores == 0
+
+def test_sse_entrega_cambios_del_paciente(app_principal, distribuidor):
+    scope = {"type": "http", "method": "GET", "path": "/eventos/cambios", "query_string": b"paciente_id=p1",
+             "headers": [], "http_version": "1.1", "scheme": "http", "server": ("test", 80), "client": ("test", 1)}
+    # inicio de la respuesta, suscrito y el cambio de p1
+    enviados, suscriptores = asyncio.run(conectar(app_principal.app, scope, {"type": "http.request", "body": b""}, 3))
+    assert enviados[0]["status"] == 200
+    assert (b"content-type", b"text/event-stream; charset=utf-8") in enviados[0]["headers"]
+    assert enviados[1]["body"].startswith(b"event: suscrito\n")
+    assert enviados[2]["body"].decode() == notificaciones.formato_sse(cambio())
+    assert suscriptores == 0
+
+def test_sse_tablas_invalidas(cliente):
+    respuesta = cliente.get("/eventos/cambios?tablas=observaciones,usuarios")
+    assert respuesta.status_code == 400
+    assert "usuarios" in respuesta.json()["detail"]
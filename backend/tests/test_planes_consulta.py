@@ -0,0 +1,179 @@
+"""
+Regresiones de planes de consulta de los endpoints críticos.
+
+Cada caso llama a un endpoint con el TestClient de conftest y captura el SQL que emite
+(evento before_cursor_execute). Luego:
+- compara la cantidad de consultas con el presupuesto declarado del caso, y
+- ejecuta EXPLAIN de cada SELECT con enable_seqscan = off: si aun así el plan recorre
+  una tabla grande con Seq Scan es porque ningún índice sirve para esa consulta (p. ej.
+  un cast sobre la columna indexada o un filtro por una columna sin índice). Con esto
+  el resultado no depende del tamaño de los datos, y basta con los que siembra el módulo.
+
+Las repeticiones (N+1) se informan como sql_diagnostico.AdvertenciaSQL, sin fallar.
+Se omite sin PostgreSQL (PRUEBAS_DATABASE_URL).
+"""
+import random
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Tablas que crecen con el uso: un Seq Scan sobre ellas (o sus particiones) es una regresión
+TABLAS_GRANDES = ["pacientes", "historial_medico", "observaciones", "medicaciones", "recursos_fuente"]
+
+# nombre -> método, ruta (con {paciente_id}, {rut}, {inexistente}), cuerpo, presupuesto de consultas
+# y tablas en las que el Seq Scan es esperado
+CASOS = {
+    "paciente_fhir": {"metodo": "GET", "ruta": "/fhir/Patient/{paciente_id}", "max_consultas": 1},
+    "paciente_fhir_inexistente": {"metodo": "GET", "ruta": "/fhir/Patient/{inexistente}", "max_consultas": 2, "status": 404},
+    "paciente_por_rut": {"metodo": "GET", "ruta": "/fhir/Patient/{rut}", "max_consultas": 1},
+    "paciente": {"metodo": "GET", "ruta": "/pacientes/{paciente_id}", "max_consultas": 1},
+    "observaciones_fhir": {"metodo": "GET", "ruta": "/fhir/Observation/{paciente_id}", "max_consultas": 1},
+    "busqueda_observaciones": {
+        "metodo": "GET",
+        "ruta": "/fhir/Observation?subject=Patient/{paciente_id}&code=2093-3&date=ge2020-01-01&_sort=-date",
+        "max_consultas": 1,
+    },
+    "medicaciones_fhir": {"metodo": "GET", "ruta": "/fhir/MedicationStatement/{paciente_id}", "max_consultas": 1},
+    "ficha_completa": {"metodo": "GET", "ruta": "/fhir/Patient/{rut}/complete", "max_consultas": 3},
+    "prediccion_tendencias": {
+        "metodo": "POST",
+        "ruta": "/ai/prediccion-tendencias",
+        "cuerpo": {"paciente_id": "{paciente_id}", "biomarcador": "colesterol_total", "dias_prediccion": 90},
+        "max_consultas": 3,
+    },
+    "deteccion_anomalias": {
+        "metodo": "POST",
+        "ruta": "/ai/deteccion-anomalias",
+        "cuerpo": {"paciente_id": "{paciente_id}"},
+        "max_consultas": 2,
+    },
+    "lista_pacientes": {"metodo": "GET", "ruta": "/fhir/Patient", "max_consultas": 1, "seq_scan_permitido": ["pacientes"]},
+}
+
+class Captura:
+    """Registra las sentencias ejecutadas por cualquier engine mientras está activa"""
+
+    def __init__(self):
+        self.activa = False
+        self.sentencias = []
+
+    def registrar(self, conn, cursor, statement, parameters, context, executemany):
+        if self.activa:
+            self.sentencias.append((statement, None if executemany else parameters))
+
+    def iniciar(self):
+        self.sentencias = []
+        self.activa = True
+
+    def detener(self):
+        self.activa = False
+        return self.sentencias
+
+@pytest.fixture(scope="module")
+def captura():
+    captura = Captura()
+    event.listen(Engine, "before_cursor_execute", captura.registrar)
+    yield captura
+    event.remove(Engine, "before_cursor_execute", captura.registrar)
+
+@pytest.fixture(scope="module")
+def datos(app_principal):
+    """Paciente con observaciones, historial y medicaciones para que los planes recorran datos reales"""
+    import models
+    from database import SessionLocal
+
+    paciente_id = uuid.uuid4()
+    rut = f"{random.randint(1000000, 25000000)}-{random.choice('0123456789K')}"
+    db = SessionLocal()
+    try:
+        db.add(models.Paciente(
+            id=paciente_id, rut=rut, nombre="Plan", apellido="Consulta",
+            fecha_nacimiento="1970-06-15", sexo="femenino"
+        ))
+        db.flush()
+        inicio = datetime(2023, 1, 10)
+        for i in range(6):
+            fecha = inicio + timedelta(days=60 * i)
+            db.add(models.Observacion(paciente_id=paciente_id, codigo="2093-3", valor=230 - 8 * i, unidad="mg/dL", fecha_efectiva=fecha))
+            db.add(models.Observacion(paciente_id=paciente_id, codigo="2571-8", valor=180 - 5 * i, unidad="mg/dL", fecha_efectiva=fecha))
+        db.add(models.HistorialMedico(paciente_id=paciente_id, suplemento="Omega-3", dosis="1000mg", fecha_inicio="2023-01-10"))
+        db.add(models.Medicacion(paciente_id=paciente_id, codigo="omega-3", nombre="Omega-3", dosis="1000mg", fecha_inicio="2023-01-10"))
+        db.commit()
+        yield {"paciente_id": str(paciente_id), "rut": rut, "inexistente": str(uuid.uuid4())}
+    finally:
+        for modelo in (models.Observacion, models.Medicacion, models.HistorialMedico):
+            db.query(modelo).filter(modelo.paciente_id == paciente_id).delete(synchronize_session=False)
+        db.query(models.Paciente).filter(models.Paciente.id == paciente_id).delete(synchronize_session=False)
+        db.commit()
+        db.close()
+
+def nodos(plan):
+    yield plan
+    for hijo in plan.get("Plans", []):
+        yield from nodos(hijo)
+
+def es_tabla_grande(relacion):
+    # Las particiones se llaman <tabla>_<sufijo>
+    return any(relacion == t or relacion.startswith(t + "_") for t in TABLAS_GRANDES)
+
+def explicar(engine, sentencia, parametros):
+    """Plan JSON con los mismos parámetros; con enable_seqscan = off solo quedan Seq Scan inevitables"""
+    conexion = engine.raw_connection()
+    try:
+        cursor = conexion.cursor()
+        cursor.execute("SET enable_seqscan = off")
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sentencia, parametros)
+        return cursor.fetchone()[0][0]["Plan"]
+    finally:
+        conexion.rollback()
+        conexion.close()
+
+def completar(valor, datos):
+    if isinstance(valor, str):
+        return valor.format(**datos)
+    if isinstance(valor, dict):
+        return {k: completar(v, datos) for k, v in valor.items()}
+    return valor
+
+@pytest.mark.parametrize("nombre", list(CASOS))
+def test_plan_de_consulta(nombre, cliente, captura, datos):
+    import sql_diagnostico
+    from database import engine
+
+    caso = CASOS[nombre]
+    captura.iniciar()
+    respuesta = cliente.request(
+        caso["metodo"], completar(caso["ruta"], datos), json=completar(caso.get("cuerpo"), datos),
+        # Cliente propio por caso: las cubetas de tokens de /ai/* no deben limitar la prueba
+        headers={"X-Cliente-Id": f"planes-{nombre}"},
+    )
+    sentencias = captura.detener()
+
+    fallas = []
+    if respuesta.status_code != caso.get("status", 200):
+        fallas.append(f"status {respuesta.status_code} (esperado {caso.get('status', 200)})")
+    if len(sentencias) > caso["max_consultas"]:
+        fallas.append(f"{len(sentencias)} consultas (presupuesto {caso['max_consultas']})")
+
+    permitidas = set(caso.get("seq_scan_permitido", []))
+    for sentencia, parametros in sentencias:
+        if not sentencia.lstrip().upper().startswith(("SELECT", "WITH")):
+            continue
+        for nodo in nodos(explicar(engine, sentencia, parametros)):
+            relacion = nodo.get("Relation Name", "")
+            if nodo["Node Type"] == "Seq Scan" and es_tabla_grande(relacion) and relacion not in permitidas:
+                fallas.append(f"Seq Scan en {relacion}: {' '.join(sentencia.split())[:160]}")
+
+    # Las sentencias repetidas se informan igual que con SQL_DIAGNOSTICO=1
+    registro = sql_diagnostico.RegistroSQL(nombre)
+    for sentencia, _ in sentencias:
+        registro.agregar(sql_diagnostico.normalizar(sentencia), 0.0)
+    registro.imprimir()
+
+    assert not fallas, "\n".join(fallas + [f"SQL: {' '.join(s.split())}" for s, _ in sentencias])
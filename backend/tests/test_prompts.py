@@ -0,0 +1,75 @@
+"""El prompt de recomendaciones queda acotado sin importar el largo del historial"""
+import random
+from datetime import datetime, timedelta
+
+import pytest
+
+pytest.importorskip("numpy")
+
+import prompts
+
+PACIENTE = {
+    "edad": 52,
+    "sexo": "femenino",
+    "problema_principal": "Colesterol alto",
+    "objetivo": "Bajar LDL " * 50,
+    "alergias": "Ninguna conocida",
+}
+CODIGOS = ["2093-3", "2571-8", "14635-7", "omega3_index"]
+
+def generar_historial(largo, codigos=CODIGOS, semilla=0):
+    azar = random.Random(semilla)
+    inicio = datetime(2015, 1, 1)
+    observaciones = [
+        {
+            "fecha": inicio + timedelta(days=i * 3),
+            "codigo": codigos[i % len(codigos)],
+            "valor": azar.uniform(5, 250),
+            "unidad": "mg/dL",
+        } for i in range(largo)
+    ]
+    historial = [
+        {
+            "fecha": (inicio + timedelta(days=i * 30)).strftime("%Y-%m-%d"),
+            "suplemento": azar.choice(["Omega3", "Vitamina D", "Magnesio", "CoQ10", f"Otro {i % 40}"]),
+            "dosis": azar.choice(["500mg", "1000mg", "2000UI"]),
+        } for i in range(largo // 10)
+    ]
+    return historial, observaciones
+
+def construir(historial, observaciones, presupuesto=None):
+    return prompts.construir_mensajes("Sistema", "Instrucción", PACIENTE, historial, observaciones, presupuesto)
+
+@pytest.mark.parametrize("largo", [10, 100, 1000, 10000])
+def test_historial_largo_respeta_presupuesto(largo):
+    mensajes, info = construir(*generar_historial(largo))
+    assert prompts.tokens_mensajes(mensajes) == info["tokens"]
+    assert info["tokens"] <= prompts.PRESUPUESTO_TOKENS
+    assert info["codigos_omitidos"] == 0
+
+def test_historial_corto_no_se_compacta():
+    _, info = construir(*generar_historial(10))
+    assert info["nivel_compactacion"] == 0
+
+def test_muchos_codigos_conserva_los_mas_recientes():
+    codigos = [f"LAB-{i:04d}" for i in range(500)]
+    historial, observaciones = generar_historial(5000, codigos)
+    mensajes, info = construir(historial, observaciones)
+
+    assert prompts.tokens_mensajes(mensajes) <= prompts.PRESUPUESTO_TOKENS
+    assert 0 < info["codigos_omitidos"] < len(codigos)
+    # Las mediciones son cada 3 días en orden de código: los últimos códigos son los más recientes
+    conservados = len(codigos) - info["codigos_omitidos"]
+    contenido = mensajes[1]["content"]
+    assert all(codigo in contenido for codigo in codigos[-conservados:])
+    assert not any(f'"{codigo}"' in contenido for codigo in codigos[:-conservados])
+
+@pytest.mark.parametrize("presupuesto", [300, 600, 1000])
+def test_presupuestos_pequenos(presupuesto):
+    codigos = [f"LAB-{i:04d}" for i in range(200)]
+    mensajes, info = construir(*generar_historial(2000, codigos), presupuesto=presupuesto)
+    assert prompts.tokens_mensajes(mensajes) <= presupuesto
+
+def test_presupuesto_inalcanzable():
+    with pytest.raises(prompts.PresupuestoExcedido):
+        construir(*generar_historial(100), presupuesto=20)
@@ -0,0 +1,47 @@
+"""La caché de pronósticos invalida solo las entradas del paciente, con ids normalizados"""
+import uuid
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from pronosticos import CachePronosticos
+
+PACIENTE = uuid.UUID("6f1c3a52-9b0e-4d7a-8c1f-2e5d7b9a0c34")
+
+def test_invalidar_con_id_en_mayusculas():
+    cache = CachePronosticos(capacidad=10)
+    cache.guardar((str(PACIENTE).upper(), "2093-3", 90), "h", {"r": 1})
+    cache.invalidar_paciente(str(PACIENTE))
+    assert cache.estado()["entradas"] == 0
+    assert cache.invalidaciones == 1
+
+def test_invalidar_no_toca_otros_pacientes():
+    cache = CachePronosticos(capacidad=10)
+    otro = uuid.uuid4()
+    cache.guardar((str(PACIENTE), "2093-3", 90), "h", {"r": 1})
+    cache.guardar((str(PACIENTE), "2571-8", 30), "h", {"r": 2})
+    cache.guardar((str(otro), "2093-3", 90), "h", {"r": 3})
+    cache.invalidar_paciente(PACIENTE)
+    assert list(cache.entradas) == [(str(otro), "2093-3", 90)]
+    assert set(cache.por_paciente) == {str(otro)}
+
+def test_desalojo_lru_actualiza_indice():
+    cache = CachePronosticos(capacidad=2)
+    pacientes = [str(uuid.uuid4()) for _ in range(3)]
+    for paciente in pacientes:
+        cache.guardar((paciente, "2093-3", 90), "h", {})
+    assert set(cache.por_paciente) == set(pacientes[1:])
+    cache.invalidar_paciente(pacientes[0])
+    assert cache.invalidaciones == 0
+
+def test_persistencia_reconstruye_indice(tmp_path):
+    cache = CachePronosticos(capacidad=10)
+    cache.guardar((str(PACIENTE), "2093-3", 90), "h", {"r": 1})
+    ruta = tmp_path / "cache.json"
+    cache.guardar_en_disco(ruta)
+
+    cargada = CachePronosticos(capacidad=10)
+    assert cargada.cargar_desde_disco(ruta) == 1
+    cargada.invalidar_paciente(str(PACIENTE).upper())
+    assert cargada.estado()["entradas"] == 0
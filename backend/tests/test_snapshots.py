@@ -0,0 +1,63 @@
+"""Snapshots incrementales: reemplazo de filas modificadas, borrados del origen y códigos con '/'"""
+import uuid
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+@pytest.fixture
+def observaciones(app_principal, pacientes_creados):
+    """Paciente con dos observaciones cuyos códigos solo difieren en '/' y '_'"""
+    import models
+    from database import SessionLocal
+
+    paciente_id = uuid.uuid4()
+    pacientes_creados.append(paciente_id)
+    db = SessionLocal()
+    try:
+        db.add(models.Paciente(id=paciente_id, rut=f"{uuid.uuid4().int % 10 ** 8}-1", nombre="Snap"))
+        filas = [
+            models.Observacion(paciente_id=paciente_id, codigo=codigo, valor=100, fecha_efectiva=datetime(2024, 3, 1))
+            for codigo in ("X-1/2", "X-1_2")
+        ]
+        db.add_all(filas)
+        db.commit()
+        yield paciente_id, [fila.id for fila in filas]
+    finally:
+        db.close()
+
+def leer(destino, paciente_id):
+    import pyarrow.dataset as ds
+    import snapshots
+
+    tabla = snapshots.cargar_arrow("observaciones", ["id", "codigo", "valor"], ds.field("paciente_id") == str(paciente_id), destino)
+    return sorted(zip(*(tabla.column(c).to_pylist() for c in ("id", "codigo", "valor"))))
+
+def test_incremental_reemplaza_y_propaga_borrados(observaciones, tmp_path):
+    import models
+    import snapshots
+    from database import SessionLocal, engine
+
+    paciente_id, (barra, guion) = observaciones
+    snapshots.exportar(engine, str(tmp_path), tablas=["observaciones"])
+    # Los códigos se conservan tal cual aunque la carpeta de la partición los codifique
+    assert leer(tmp_path, paciente_id) == [(barra, "X-1/2", 100), (guion, "X-1_2", 100)]
+
+    db = SessionLocal()
+    try:
+        db.query(models.Observacion).filter(models.Observacion.id == barra).update({"valor": 150})
+        db.query(models.Observacion).filter(models.Observacion.id == guion).delete()
+        db.commit()
+    finally:
+        db.close()
+
+    snapshots.exportar(engine, str(tmp_path), tablas=["observaciones"])
+    assert leer(tmp_path, paciente_id) == [(barra, "X-1/2", 150)]
+
+    # El índice de ubicaciones vigente sigue al snapshot y los anteriores se eliminan
+    estado = snapshots.leer_estado(str(tmp_path))
+    ubicaciones = snapshots.cargar_ubicaciones(str(tmp_path), "observaciones", snapshots.TABLAS["observaciones"], estado["tablas"]["observaciones"])
+    ids = ubicaciones.column("id").to_pylist()
+    assert barra in ids and guion not in ids
+    assert len(list((tmp_path / "_ubicaciones").iterdir())) == 1
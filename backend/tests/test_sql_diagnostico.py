@@ -0,0 +1,46 @@
+"""El diagnóstico SQL emite advertencias visibles y no acumula inicios de sentencias fallidas"""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+import sql_diagnostico
+from sql_diagnostico import AdvertenciaSQL, RegistroSQL
+
+def conexion():
+    return SimpleNamespace(info={})
+
+def test_n_mas_1_emite_advertencia():
+    registro = RegistroSQL("GET /prueba")
+    for _ in range(sql_diagnostico.UMBRAL_REPETICIONES):
+        registro.agregar("SELECT * FROM pacientes WHERE id = ?", 1.0)
+    with pytest.warns(AdvertenciaSQL, match="N\\+1"):
+        registro.imprimir()
+
+def test_sin_repeticiones_no_advierte(recwarn):
+    registro = RegistroSQL("GET /prueba")
+    registro.agregar("SELECT 1", 1.0)
+    registro.imprimir()
+    assert not [w for w in recwarn if issubclass(w.category, AdvertenciaSQL)]
+
+def test_consulta_lenta_emite_advertencia(monkeypatch):
+    monkeypatch.setattr(sql_diagnostico, "LENTA_MS", 0)
+    conn = conexion()
+    sql_diagnostico.antes_de_ejecutar(conn, None, "SELECT pg_sleep(1)", None, None, False)
+    with pytest.warns(AdvertenciaSQL, match="Lenta"):
+        sql_diagnostico.despues_de_ejecutar(conn, None, "SELECT pg_sleep(1)", None, None, False)
+    assert conn.info["inicios_sql"] == []
+
+def test_error_descarta_inicio():
+    conn = conexion()
+    sql_diagnostico.antes_de_ejecutar(conn, None, "SELECT 1", None, None, False)
+    sql_diagnostico.antes_de_ejecutar(conn, None, "SELECT columna_inexistente", None, None, False)
+    sql_diagnostico.al_fallar(SimpleNamespace(connection=conn, execution_context=object()))
+    assert len(conn.info["inicios_sql"]) == 1
+
+def test_error_al_compilar_no_descarta():
+    conn = conexion()
+    sql_diagnostico.antes_de_ejecutar(conn, None, "SELECT 1", None, None, False)
+    sql_diagnostico.al_fallar(SimpleNamespace(connection=conn, execution_context=None))
+    assert len(conn.info["inicios_sql"]) == 1
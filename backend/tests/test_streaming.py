@@ -0,0 +1,64 @@
+"""Streaming SSE de los endpoints de IA: inicio inmediato, tokens y resultado final o de respaldo"""
+import asyncio
+import json
+
+import pytest
+
+MENSAJES = [{"role": "user", "content": "hola"}]
+
+def eventos(respuesta):
+    """Consume la StreamingResponse y devuelve [(evento, datos)]"""
+    async def leer():
+        return [parte async for parte in respuesta.body_iterator]
+
+    resultado = []
+    for bloque in asyncio.run(leer()):
+        evento, datos = bloque.strip().split("\n")
+        resultado.append((evento.removeprefix("event: "), json.loads(datos.removeprefix("data: "))))
+    return resultado
+
+def modelo_falso(monkeypatch, main, textos=None, error=None):
+    async def completar_streaming(mensajes):
+        for texto in textos or []:
+            yield texto
+        if error:
+            raise error
+
+    monkeypatch.setattr(main.llm, "completar_streaming", completar_streaming)
+
+def test_tokens_y_resultado_estructurado(app_principal, monkeypatch):
+    modelo_falso(monkeypatch, app_principal, ["Omega", "-3"])
+    terminados = []
+
+    async def al_terminar(resultado):
+        terminados.append(resultado)
+
+    respuesta = app_principal.respuesta_streaming(
+        MENSAJES, lambda texto: {"texto": texto}, respaldo=lambda: {"origen": "reglas"}, al_terminar=al_terminar
+    )
+    assert respuesta.media_type == "text/event-stream"
+    assert eventos(respuesta) == [
+        ("inicio", {}),
+        ("token", {"texto": "Omega"}),
+        ("token", {"texto": "-3"}),
+        ("resultado", {"texto": "Omega-3"}),
+    ]
+    assert terminados == [{"texto": "Omega-3"}]
+
+@pytest.mark.parametrize("mensajes, error", [
+    (MENSAJES, RuntimeError("desconectado")),
+    (MENSAJES, asyncio.TimeoutError()),
+    # Prompt fuera de presupuesto: no se llama al modelo
+    (None, None),
+])
+def test_falla_del_modelo_responde_con_reglas(app_principal, monkeypatch, mensajes, error):
+    modelo_falso(monkeypatch, app_principal, ["parcial"], error)
+    respuesta = app_principal.respuesta_streaming(mensajes, lambda texto: {"texto": texto}, respaldo=lambda: {"origen": "reglas"})
+    recibidos = eventos(respuesta)
+    assert recibidos[0] == ("inicio", {})
+    assert recibidos[-1] == ("resultado", {"origen": "reglas"})
+
+def test_circuito_abierto_responde_con_reglas(app_principal, monkeypatch):
+    modelo_falso(monkeypatch, app_principal, error=app_principal.llm.CircuitoAbierto("abierto"))
+    respuesta = app_principal.respuesta_streaming(MENSAJES, lambda texto: {"texto": texto}, respaldo=lambda: {"origen": "reglas"})
+    assert eventos(respuesta) == [("inicio", {}), ("resultado", {"origen": "reglas"})]
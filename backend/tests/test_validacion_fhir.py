@@ -0,0 +1,105 @@
+"""Validación FHIR: errores con su ruta, modo confiable solo con la clave de la fuente"""
+import uuid
+
+import pytest
+
+import validacion_fhir
+
+OBSERVACION = {
+    "resourceType": "Observation",
+    "status": "final",
+    "subject": {"reference": "Patient/1"},
+    "code": {"coding": [{"system": "http://loinc.org", "code": "2093-3"}]},
+    "valueQuantity": {"value": 190, "unit": "mg/dL"},
+    "effectiveDateTime": "2024-01-15T08:30:00Z",
+}
+
+@pytest.fixture
+def fuente_confiable(monkeypatch):
+    monkeypatch.setattr(validacion_fhir, "FUENTES_CONFIABLES", {"https://lab.socio.cl": "s3cr3t"})
+    return "https://lab.socio.cl", "s3cr3t"
+
+def test_recurso_valido():
+    assert validacion_fhir.validar_recurso(OBSERVACION) == []
+
+@pytest.mark.parametrize("cambios, error", [
+    ({"valueQuantity": {"value": "190"}}, "valueQuantity.value: se esperaba un número"),
+    ({"valueQuantity": {"value": True}}, "valueQuantity.value: se esperaba un número"),
+    ({"effectiveDateTime": "15-01-2024"}, "effectiveDateTime: formato inválido '15-01-2024'"),
+    ({"status": "borrador"}, "status: valor no permitido 'borrador'"),
+    ({"code": {"coding": []}}, "code.coding: se esperaban al menos 1 elementos"),
+    ({"code": {"coding": [{"display": "Colesterol"}]}}, "code.coding[0].code: campo requerido"),
+    ({"subject": None}, "subject: campo requerido"),
+])
+def test_errores_con_ruta(cambios, error):
+    assert validacion_fhir.validar_recurso({**OBSERVACION, **cambios}) == [error]
+
+def test_errores_acumulados_y_alguno_de():
+    errores = validacion_fhir.validar_recurso({"resourceType": "MedicationStatement", "status": "x"})
+    assert errores == [
+        "subject: campo requerido",
+        "recurso: se requiere medicationCodeableConcept o medicationReference",
+        "status: valor no permitido 'x'",
+    ]
+
+def test_modo_confiable_solo_verifica_lo_imprescindible():
+    profundo = {**OBSERVACION, "status": "borrador", "effectiveDateTime": "ayer"}
+    assert len(validacion_fhir.validar_recurso(profundo)) == 2
+    assert validacion_fhir.validar_recurso(profundo, confiable=True) == []
+    assert validacion_fhir.validar_recurso({**OBSERVACION, "valueQuantity": None}, confiable=True) == [
+        "valueQuantity: campo requerido"
+    ]
+    for confiable in (False, True):
+        assert validacion_fhir.validar_recurso({"resourceType": "Encounter"}, confiable) == [
+            "resourceType: tipo de recurso no soportado 'Encounter'"
+        ]
+
+def test_es_confiable_exige_la_clave(fuente_confiable):
+    sistema, clave = fuente_confiable
+    assert validacion_fhir.es_confiable(sistema, clave)
+    assert not validacion_fhir.es_confiable(sistema, None)
+    assert not validacion_fhir.es_confiable(sistema, "otra")
+    assert not validacion_fhir.es_confiable("https://otro.cl", clave)
+
+def test_operation_outcome_ubica_cada_error():
+    entradas = [{"resource": OBSERVACION}, {"resource": {**OBSERVACION, "status": "x"}}, "no es objeto"]
+    outcome = validacion_fhir.operation_outcome(validacion_fhir.validar_entradas(entradas))
+    assert [issue["expression"] for issue in outcome["issue"]] == [
+        ["Bundle.entry[1].resource.status"], ["Bundle.entry[2].resource"]
+    ]
+
+def bundle_paciente(paciente_id):
+    return {
+        "resourceType": "Bundle",
+        "type": "transaction",
+        "meta": {"source": "https://lab.socio.cl"},
+        "entry": [{
+            "fullUrl": f"urn:uuid:{paciente_id}",
+            "resource": {
+                "resourceType": "Patient", "id": str(paciente_id),
+                "name": [{"family": "Confiable", "given": ["Fuente"]}],
+                # Fuera del value set: solo lo acepta el modo confiable
+                "gender": "mujer",
+            },
+            "request": {"method": "POST", "url": "Patient"},
+        }],
+    }
+
+def test_importar_sin_clave_valida_completo(cliente, fuente_confiable, pacientes_creados):
+    paciente_id = uuid.uuid4()
+    pacientes_creados.append(paciente_id)
+    respuesta = cliente.post("/fhir/import", json=bundle_paciente(paciente_id), headers={
+        "X-Fuente-Clave": "otra", "X-Cliente-Id": f"validacion-{uuid.uuid4()}"
+    })
+    assert respuesta.status_code == 400
+    assert respuesta.json()["issue"][0]["expression"] == ["Bundle.entry[0].resource.gender"]
+
+def test_importar_con_clave_omite_la_validacion_profunda(cliente, fuente_confiable, pacientes_creados):
+    sistema, clave = fuente_confiable
+    paciente_id = uuid.uuid4()
+    pacientes_creados.append(paciente_id)
+    respuesta = cliente.post("/fhir/import", json=bundle_paciente(paciente_id), headers={
+        "X-Fuente-Clave": clave, "X-Cliente-Id": f"validacion-{uuid.uuid4()}"
+    })
+    assert respuesta.status_code == 200, respuesta.text
+    assert respuesta.json()["entry"][0]["response"]["status"].startswith("201")
@@ -0,0 +1,12 @@
+"""Normalización de texto compartida por la búsqueda y el autocompletado de pacientes"""
+import re
+import unicodedata
+
+def normalizar(texto):
+    """Minúsculas y sin tildes"""
+    texto = unicodedata.normalize("NFKD", texto or "").lower()
+    return "".join(c for c in texto if not unicodedata.combining(c))
+
+def escapar_like(texto):
+    """Escapa los comodines de LIKE (% y _) y la barra invertida, que es el carácter de escape"""
+    return re.sub(r"([\\%_])", r"\\\1", texto)
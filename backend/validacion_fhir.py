@@ -0,0 +1,261 @@
+"""
+Validación compilada de recursos FHIR (Patient, Observation, MedicationStatement).
+
+Los esquemas se declaran como datos y se compilan una sola vez al importar el módulo en
+funciones anidadas: validar un recurso es recorrerlo llamando a esas funciones, sin
+interpretar el esquema ni construir modelos Pydantic por recurso. Los errores se
+acumulan con la ruta del campo (p. ej. "valueQuantity.value: se esperaba un número"),
+de modo que un bundle se valida completo y se informan todos sus errores juntos.
+
+Fuentes confiables: FHIR_FUENTES_CONFIABLES lista pares sistema=clave separados por coma
+(p. ej. "https://lab.socio.cl=s3cr3t"). Un feed de esos sistemas que además envía la clave
+en la cabecera X-Fuente-Clave ya fue validado por el socio: solo se verifica el tipo de
+recurso y los campos imprescindibles para guardarlo, sin la validación profunda. El
+sistema declarado en el bundle o en ?sistema= lo elige el cliente, así que por sí solo
+nunca activa el modo confiable.
+
+Uso:
+    python validacion_fhir.py validar bundle.json
+    python validacion_fhir.py benchmark [--bundle ../scripts/datos_prueba.json] [--recursos 200000]
+"""
+import argparse
+import hmac
+import json
+import os
+import re
+import sys
+import time
+
+FUENTES_CONFIABLES = dict(
+    par.strip().split("=", 1) for par in os.getenv("FHIR_FUENTES_CONFIABLES", "").split(",") if "=" in par
+)
+
+PATRON_FECHA = r"^\d{4}(-\d{2}(-\d{2})?)?$"
+PATRON_FECHA_HORA = r"^\d{4}(-\d{2}(-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:\d{2})?)?)?)?$"
+
+TEXTO = {"tipo": "texto"}
+CODING = {"tipo": "objeto", "propiedades": {"system": TEXTO, "code": TEXTO, "display": TEXTO}}
+REFERENCIA = {"tipo": "objeto", "propiedades": {"reference": TEXTO}, "requeridos": ["reference"]}
+CANTIDAD = {
+    "tipo": "objeto",
+    "propiedades": {"value": {"tipo": "numero"}, "unit": TEXTO, "system": TEXTO, "code": TEXTO},
+    "requeridos": ["value"],
+}
+CONCEPTO = {
+    "tipo": "objeto",
+    "propiedades": {"coding": {"tipo": "lista", "elementos": CODING}, "text": TEXTO},
+}
+PERIODO = {
+    "tipo": "objeto",
+    "propiedades": {
+        "start": {"tipo": "texto", "patron": PATRON_FECHA_HORA},
+        "end": {"tipo": "texto", "patron": PATRON_FECHA_HORA},
+    },
+}
+
+ESQUEMAS = {
+    "Patient": {
+        "tipo": "objeto",
+        "propiedades": {
+            "id": TEXTO,
+            "gender": {"tipo": "texto", "valores": ["male", "female", "other", "unknown"]},
+            "birthDate": {"tipo": "texto", "patron": PATRON_FECHA},
+            "name": {"tipo": "lista", "elementos": {
+                "tipo": "objeto",
+                "propiedades": {"family": TEXTO, "given": {"tipo": "lista", "elementos": TEXTO}, "text": TEXTO},
+            }},
+            "identifier": {"tipo": "lista", "elementos": {
+                "tipo": "objeto", "propiedades": {"system": TEXTO, "value": TEXTO}, "requeridos": ["value"],
+            }},
+            "telecom": {"tipo": "lista", "elementos": {
+                "tipo": "objeto",
+                "propiedades": {"system": {"tipo": "texto", "valores": ["phone", "fax", "email", "pager", "url", "sms", "other"]},
+                                "value": TEXTO},
+            }},
+            "address": {"tipo": "lista", "elementos": {"tipo": "objeto", "propiedades": {
+                "line": {"tipo": "lista", "elementos": TEXTO}, "city": TEXTO, "country": TEXTO,
+            }}},
+        },
+    },
+    "Observation": {
+        "tipo": "objeto",
+        "propiedades": {
+            "id": TEXTO,
+            "status": {"tipo": "texto", "valores": ["registered", "preliminary", "final", "amended", "corrected", "cancelled", "entered-in-error", "unknown"]},
+            "subject": REFERENCIA,
+            "code": {**CONCEPTO, "propiedades": {"coding": {"tipo": "lista", "elementos": {**CODING, "requeridos": ["code"]}, "minimo": 1}, "text": TEXTO}, "requeridos": ["coding"]},
+            "valueQuantity": CANTIDAD,
+            "effectiveDateTime": {"tipo": "texto", "patron": PATRON_FECHA_HORA},
+        },
+        "requeridos": ["subject", "code", "valueQuantity"],
+    },
+    "MedicationStatement": {
+        "tipo": "objeto",
+        "propiedades": {
+            "id": TEXTO,
+            "status": {"tipo": "texto", "valores": ["active", "completed", "entered-in-error", "intended", "stopped", "on-hold", "unknown", "not-taken"]},
+            "subject": REFERENCIA,
+            "medicationCodeableConcept": CONCEPTO,
+            "medicationReference": REFERENCIA,
+            "effectiveDateTime": {"tipo": "texto", "patron": PATRON_FECHA_HORA},
+            "effectivePeriod": PERIODO,
+            "dosage": {"tipo": "lista", "elementos": {"tipo": "objeto", "propiedades": {"text": TEXTO}}},
+        },
+        "requeridos": ["subject"],
+        "alguno_de": ["medicationCodeableConcept", "medicationReference"],
+    },
+}
+
+# Modo confiable: solo lo imprescindible para mapear el recurso a las tablas
+ESQUEMAS_MINIMOS = {
+    "Patient": {"tipo": "objeto"},
+    "Observation": {"tipo": "objeto", "requeridos": ["subject", "code", "valueQuantity"]},
+    "MedicationStatement": {"tipo": "objeto", "requeridos": ["subject"]},
+}
+
+def unir(ruta, campo):
+    return f"{ruta}.{campo}" if ruta else campo
+
+def compilar(esquema):
+    """Convierte un esquema declarativo en una función validar(valor, ruta, errores)"""
+    tipo = esquema["tipo"]
+
+    if tipo == "texto":
+        patron = re.compile(esquema["patron"]).match if "patron" in esquema else None
+        valores = frozenset(esquema["valores"]) if "valores" in esquema else None
+
+        def validar(valor, ruta, errores):
+            if not isinstance(valor, str):
+                errores.append(f"{ruta}: se esperaba texto")
+            elif patron is not None and not patron(valor):
+                errores.append(f"{ruta}: formato inválido '{valor}'")
+            elif valores is not None and valor not in valores:
+                errores.append(f"{ruta}: valor no permitido '{valor}'")
+        return validar
+
+    if tipo == "numero":
+        def validar(valor, ruta, errores):
+            # bool es subclase de int pero no es un número válido en FHIR
+            if isinstance(valor, bool) or not isinstance(valor, (int, float)):
+                errores.append(f"{ruta}: se esperaba un número")
+        return validar
+
+    if tipo == "lista":
+        elemento = compilar(esquema["elementos"])
+        minimo = esquema.get("minimo", 0)
+
+        def validar(valor, ruta, errores):
+            if not isinstance(valor, list):
+                errores.append(f"{ruta}: se esperaba una lista")
+                return
+            if len(valor) < minimo:
+                errores.append(f"{ruta}: se esperaban al menos {minimo} elementos")
+            for i, item in enumerate(valor):
+                elemento(item, f"{ruta}[{i}]", errores)
+        return validar
+
+    if tipo == "objeto":
+        propiedades = [(nombre, compilar(sub)) for nombre, sub in esquema.get("propiedades", {}).items()]
+        requeridos = esquema.get("requeridos", [])
+        alguno_de = esquema.get("alguno_de")
+
+        def validar(valor, ruta, errores):
+            if not isinstance(valor, dict):
+                errores.append(f"{ruta or 'recurso'}: se esperaba un objeto")
+                return
+            for nombre in requeridos:
+                if valor.get(nombre) is None:
+                    errores.append(f"{unir(ruta, nombre)}: campo requerido")
+            if alguno_de and not any(valor.get(nombre) is not None for nombre in alguno_de):
+                errores.append(f"{ruta or 'recurso'}: se requiere {' o '.join(alguno_de)}")
+            for nombre, sub in propiedades:
+                sub_valor = valor.get(nombre)
+                if sub_valor is not None:
+                    sub(sub_valor, unir(ruta, nombre), errores)
+        return validar
+
+    raise ValueError(f"Tipo de esquema desconocido: {tipo}")
+
+VALIDADORES = {tipo: compilar(esquema) for tipo, esquema in ESQUEMAS.items()}
+VALIDADORES_MINIMOS = {tipo: compilar(esquema) for tipo, esquema in ESQUEMAS_MINIMOS.items()}
+
+def es_confiable(sistema, clave):
+    """El sistema está en la lista del servidor y la clave presentada es la suya"""
+    esperada = FUENTES_CONFIABLES.get(sistema)
+    return bool(esperada) and clave is not None and hmac.compare_digest(esperada.encode(), clave.encode())
+
+def validar_recurso(resource, confiable=False):
+    """Lista de errores del recurso (vacía si es válido)"""
+    if not isinstance(resource, dict):
+        return ["recurso: se esperaba un objeto"]
+    tipo = resource.get("resourceType")
+    validador = (VALIDADORES_MINIMOS if confiable else VALIDADORES).get(tipo)
+    if validador is None:
+        return [f"resourceType: tipo de recurso no soportado '{tipo}'"]
+    errores = []
+    validador(resource, "", errores)
+    return errores
+
+def validar_entradas(entradas, confiable=False):
+    """Errores por índice de entrada del bundle; solo incluye las entradas con errores"""
+    errores = {}
+    for i, entry in enumerate(entradas):
+        errores_recurso = validar_recurso(entry.get("resource") if isinstance(entry, dict) else None, confiable)
+        if errores_recurso:
+            errores[i] = errores_recurso
+    return errores
+
+def expresion(indice, error):
+    """FHIRPath del campo con error dentro del bundle"""
+    ruta = error.split(": ")[0]
+    return f"Bundle.entry[{indice}].resource" + ("" if ruta == "recurso" else f".{ruta}")
+
+def operation_outcome(errores_por_entrada):
+    """OperationOutcome con un issue por error, ubicado en su entrada del bundle"""
+    return {
+        "resourceType": "OperationOutcome",
+        "issue": [
+            {"severity": "error", "code": "invalid", "diagnostics": error, "expression": [expresion(i, error)]}
+            for i, errores in sorted(errores_por_entrada.items())
+            for error in errores
+        ],
+    }
+
+def benchmark(entradas, recursos, repeticiones=3):
+    """Recursos por segundo validando completo y en modo confiable (mejor de n repeticiones)"""
+    entradas = (entradas * (recursos // len(entradas) + 1))[:recursos]
+    resultados = {}
+    for modo, confiable in (("validado", False), ("confiable", True)):
+        mejor = float("inf")
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            validar_entradas(entradas, confiable)
+            mejor = min(mejor, time.perf_counter() - inicio)
+        resultados[modo] = {"segundos": round(mejor, 3), "recursos_por_segundo": round(len(entradas) / mejor)}
+    resultados["aceleracion"] = round(resultados["validado"]["segundos"] / resultados["confiable"]["segundos"], 1)
+    return resultados
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validación compilada de recursos FHIR")
+    sub = parser.add_subparsers(dest="comando")
+    p_validar = sub.add_parser("validar")
+    p_validar.add_argument("bundle")
+    p_validar.add_argument("--confiable", action="store_true")
+    p_bench = sub.add_parser("benchmark")
+    p_bench.add_argument("--bundle", default=os.path.join(os.path.dirname(__file__), "..", "scripts", "datos_prueba.json"))
+    p_bench.add_argument("--recursos", type=int, default=200000)
+    args = parser.parse_args()
+
+    if args.comando == "validar":
+        with open(args.bundle, encoding="utf-8") as f:
+            errores = validar_entradas(json.load(f).get("entry", []), args.confiable)
+        print(json.dumps(operation_outcome(errores), indent=2, ensure_ascii=False))
+        sys.exit(1 if errores else 0)
+    elif args.comando == "benchmark":
+        with open(args.bundle, encoding="utf-8") as f:
+            entradas = json.load(f).get("entry", [])
+        print(f"Bundle de {args.recursos} recursos (a partir de {len(entradas)} entradas de {args.bundle})")
+        print(json.dumps(benchmark(entradas, args.recursos), indent=2))
+    else:
+        parser.print_help()
+        sys.exit(1)
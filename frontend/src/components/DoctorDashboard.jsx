@@ -41,6 +41,22 @@ function DoctorDashboard() {
       }
     };
     fetchPatients();
+
+    // Refrescar la lista solo cuando el backend notifica cambios en pacientes
+    let pendiente = null;
+    const socket = new WebSocket('ws://localhost:8000/ws/cambios?tablas=pacientes');
+    socket.onmessage = (mensaje) => {
+      const evento = JSON.parse(mensaje.data);
+      if (evento.tipo === 'cambio' || evento.tipo === 'resincronizar') {
+        // Agrupa ráfagas de cambios (p. ej. importaciones) en una sola recarga
+        clearTimeout(pendiente);
+        pendiente = setTimeout(fetchPatients, 500);
+      }
+    };
+    return () => {
+      clearTimeout(pendiente);
+      socket.close();
+    };
   }, []);
 
   // Helper to format patient name from FHIR resource
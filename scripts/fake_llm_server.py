@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Servidor local que imita /v1/chat/completions de OpenAI, con y sin streaming.
+
+Permite probar los endpoints /ai/* sin costo ni red, con latencias controladas:
+    python scripts/fake_llm_server.py --puerto 8085 --latencia-inicial 0.3 --intervalo 0.05
+    OPENAI_API_BASE=http://localhost:8085/v1 OPENAI_API_KEY=x uvicorn main:app
+
+Para medir el tiempo hasta el primer byte del endpoint con streaming:
+    python scripts/fake_llm_server.py --medir http://localhost:8000/ai/recomendaciones/stream --paciente <uuid>
+"""
+import argparse
+import json
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import request as urlrequest
+
+RESPUESTA = (
+    "Según sus biomarcadores, se recomienda: 1) mantener Omega-3 en 2000mg diarios con las comidas; "
+    "2) aumentar la fibra soluble (avena, legumbres) para mejorar el perfil lipídico; "
+    "3) sumar 30 minutos de actividad aeróbica diaria y repetir el perfil en 3 meses."
+)
+
+def fragmentos(texto):
+    """Divide el texto en trozos de una palabra, como los tokens de un modelo real"""
+    palabras = texto.split(" ")
+    return [p + (" " if i < len(palabras) - 1 else "") for i, p in enumerate(palabras)]
+
+class ManejadorLLM(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latencia_inicial = 0.3
+    intervalo = 0.05
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        cuerpo = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        modelo = cuerpo.get("model", "gpt-4")
+        id_respuesta = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        time.sleep(self.latencia_inicial)
+
+        if not cuerpo.get("stream"):
+            time.sleep(self.intervalo * len(fragmentos(RESPUESTA)))
+            self.enviar_json({
+                "id": id_respuesta,
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": modelo,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": RESPUESTA}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        deltas = [{"role": "assistant"}] + [{"content": f} for f in fragmentos(RESPUESTA)] + [{}]
+        for i, delta in enumerate(deltas):
+            fragmento = {
+                "id": id_respuesta,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": modelo,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if i == len(deltas) - 1 else None}],
+            }
+            self.wfile.write(f"data: {json.dumps(fragmento)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.intervalo)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def enviar_json(self, datos):
+        contenido = json.dumps(datos).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(contenido)))
+        self.end_headers()
+        self.wfile.write(contenido)
+
+    def log_message(self, formato, *args):
+        print(f"[fake-llm] {self.address_string()} {formato % args}")
+
+def medir(url, paciente_id):
+    """Imprime el tiempo hasta el primer byte, hasta el primer token y total de un endpoint SSE"""
+    solicitud = urlrequest.Request(
+        url,
+        data=json.dumps({"paciente_id": paciente_id}).encode("utf-8"),
+        headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+    )
+    inicio = time.perf_counter()
+    primer_byte = primer_token = None
+    tokens = 0
+    with urlrequest.urlopen(solicitud) as respuesta:
+        for linea in respuesta:
+            if primer_byte is None:
+                primer_byte = time.perf_counter() - inicio
+            if linea.startswith(b"event: token"):
+                tokens += 1
+                if primer_token is None:
+                    primer_token = time.perf_counter() - inicio
+            elif linea.startswith(b"event: error"):
+                print(f"Error: {next(respuesta).decode('utf-8').strip()}")
+    total = time.perf_counter() - inicio
+    print(f"Primer byte: {primer_byte:.3f}s")
+    print(f"Primer token: {primer_token:.3f}s" if primer_token is not None else "Primer token: sin tokens")
+    print(f"Total: {total:.3f}s ({tokens} tokens)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Servidor LLM falso compatible con OpenAI")
+    parser.add_argument("--puerto", type=int, default=8085)
+    parser.add_argument("--latencia-inicial", type=float, default=0.3, help="Segundos antes del primer token")
+    parser.add_argument("--intervalo", type=float, default=0.05, help="Segundos entre tokens")
+    parser.add_argument("--medir", metavar="URL", help="Mide un endpoint SSE en lugar de levantar el servidor")
+    parser.add_argument("--paciente", help="paciente_id para --medir")
+    args = parser.parse_args()
+
+    if args.medir:
+        medir(args.medir, args.paciente)
+    else:
+        ManejadorLLM.latencia_inicial = args.latencia_inicial
+        ManejadorLLM.intervalo = args.intervalo
+        servidor = ThreadingHTTPServer(("0.0.0.0", args.puerto), ManejadorLLM)
+        print(f"Servidor LLM falso en http://localhost:{args.puerto}/v1")
+        servidor.serve_forever()
@@ -532,83 +532,43 @@ def main():
     guardar_bundle_json(bundle)
     
     if backend_disponible:
-        # Primero, crear un bundle solo con pacientes
-        pacientes_bundle = {
-            "resourceType": "Bundle",
-            "type": "transaction",
-            "entry": []
-        }
-        
-        # Extraer solo los pacientes del bundle original
-        for entry in bundle["entry"]:
-            if entry["resource"]["resourceType"] == "Patient":
-                pacientes_bundle["entry"].append(entry)
-        
-        # Importar solo los pacientes primero
-        print("Importando pacientes...")
+        # Pacientes, observaciones y medicaciones en una sola transacción
+        print(f"Importando {len(bundle['entry'])} recursos...")
         response = requests.post(
             "http://backend:8000/fhir/import",
-            json=pacientes_bundle
+            json=bundle
         )
         
         if response.status_code != 200:
-            print(f"Error importando pacientes: {response.text}")
+            print(f"Error importando recursos: {response.text}")
             return
         
-        print("Pacientes importados correctamente")
-        
-        # Esperar un momento para asegurar que los pacientes estén en la base de datos
-        time.sleep(2)
+        print("Recursos importados correctamente")
         
-        # Ahora crear los historiales médicos uno por uno
-        for paciente_entry in pacientes_bundle["entry"]:
-            paciente_id = paciente_entry["resource"]["id"]
-            
-            # Verificar que el paciente existe en la base de datos
-            response = requests.get(f"http://backend:8000/pacientes/{paciente_id}")
-            if response.status_code != 200:
-                print(f"Paciente {paciente_id} no encontrado en la base de datos, saltando...")
+        # Ahora crear los historiales médicos en un solo lote
+        historiales = []
+        for entry in bundle["entry"]:
+            if entry["resource"]["resourceType"] != "Patient":
                 continue
-                
-            print(f"Creando historiales para paciente {paciente_id}")
-            
+            paciente_id = entry["resource"]["id"]
             # Crear 2-5 historiales para este paciente
             for _ in range(random.randint(2, 5)):
-                historial_data = generar_historial(paciente_id)
-                response = requests.post(
-                    "http://backend:8000/historial",
-                    json=historial_data
-                )
-                
-                if response.status_code not in [200, 201]:
-                    print(f"Error creando historial: {response.text}")
-                else:
-                    print("Historial creado correctamente")
-        
-        # Ahora importar observaciones y medicaciones
-        observaciones_medicaciones_bundle = {
-            "resourceType": "Bundle",
-            "type": "transaction",
-            "entry": []
-        }
+                historiales.append(generar_historial(paciente_id))
         
-        # Extraer observaciones y medicaciones del bundle original
-        for entry in bundle["entry"]:
-            if entry["resource"]["resourceType"] in ["Observation", "MedicationStatement"]:
-                observaciones_medicaciones_bundle["entry"].append(entry)
+        print(f"Creando {len(historiales)} historiales...")
+        response = requests.post(
+            "http://backend:8000/historial/batch",
+            json=historiales
+        )
         
-        # Importar observaciones y medicaciones
-        if observaciones_medicaciones_bundle["entry"]:
-            print("Importando observaciones y medicaciones...")
-            response = requests.post(
-                "http://backend:8000/fhir/import",
-                json=observaciones_medicaciones_bundle
-            )
-            
-            if response.status_code != 200:
-                print(f"Error importando observaciones y medicaciones: {response.text}")
-            else:
-                print("Observaciones y medicaciones importadas correctamente")
+        if response.status_code != 200:
+            print(f"Error creando historiales: {response.text}")
+        else:
+            resultado = response.json()
+            print(f"Historiales creados: {resultado['creados']}, rechazados: {resultado['rechazados']}")
+            for fila in resultado["resultados"]:
+                if fila["estado"] != "creado":
+                    print(f"  Historial {fila['indice']} rechazado: {fila['motivo']}")
     
     print("Generación de datos de prueba completada.")
 
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Prueba de carga con tráfico mixto de consulta y reporte contra SLOs.
+
+Cada usuario virtual repite los recorridos reales del frontend con pausas aleatorias:
+- lista: GET /fhir/Patient (PacienteList, DoctorDashboard)
+- ficha: Patient, Observation y MedicationStatement del paciente (PacienteDetail)
+- panel_ia: anomalías, tendencias y recomendaciones en paralelo, como los componentes
+  del dashboard al abrir un paciente
+- optimizacion: POST /ai/optimizacion-suplementos (SupplementOptimization)
+
+En paralelo un importador envía bundles batch a /fhir/import cada --intervalo-importacion
+segundos. Al final se informa por endpoint p50/p95/p99, tasa de error, rechazos (429/503)
+y solicitudes por segundo, y se compara con los SLOs declarados (código de salida 1 si
+alguno no se cumple).
+
+Uso, con el LLM falso para no depender de OpenAI:
+    python scripts/fake_llm_server.py --puerto 8085 &
+    OPENAI_API_BASE=http://localhost:8085/v1 OPENAI_API_KEY=x uvicorn main:app --workers 2
+    python scripts/prueba_carga.py --usuarios 20 --duracion 60 [--slo slo.json] [--salida reporte.json]
+"""
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from urllib import error as urlerror
+from urllib import request as urlrequest
+
+# Recorrido -> peso relativo en la mezcla de tráfico
+RECORRIDOS = {
+    "lista": 3,
+    "ficha": 4,
+    "panel_ia": 2,
+    "optimizacion": 1,
+}
+
+# SLO por endpoint: latencias en milisegundos y tasa de error máxima
+SLOS = {
+    "GET /fhir/Patient": {"p95": 500, "p99": 1000, "error": 0.01},
+    "GET /fhir/Patient/{id}": {"p95": 200, "p99": 500, "error": 0.01},
+    "GET /fhir/Observation/{id}": {"p95": 300, "p99": 600, "error": 0.01},
+    "GET /fhir/MedicationStatement/{id}": {"p95": 300, "p99": 600, "error": 0.01},
+    "POST /ai/deteccion-anomalias": {"p95": 1500, "p99": 3000, "error": 0.05},
+    "POST /ai/prediccion-tendencias": {"p95": 1500, "p99": 3000, "error": 0.05},
+    "POST /ai/recomendaciones": {"p95": 8000, "p99": 15000, "error": 0.05},
+    "POST /ai/optimizacion-suplementos": {"p95": 8000, "p99": 15000, "error": 0.05},
+    "POST /fhir/import": {"p95": 5000, "p99": 10000, "error": 0.01},
+}
+
+BIOMARCADORES = ["colesterol_total", "trigliceridos", "vitamina_d", "omega3_indice"]
+CODIGOS_LOINC = {"colesterol_total": "2093-3", "trigliceridos": "2571-8", "vitamina_d": "14635-7", "omega3_indice": "omega3_index"}
+
+class Registro:
+    """Mediciones por endpoint, compartidas entre hilos"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mediciones = {}
+
+    def agregar(self, endpoint, segundos, status):
+        with self.lock:
+            self.mediciones.setdefault(endpoint, []).append((segundos, status))
+
+def solicitar(base, metodo, ruta, endpoint, registro, cuerpo=None, cliente=None, timeout=60):
+    """Hace la solicitud y registra su latencia; devuelve el JSON o None"""
+    datos = json.dumps(cuerpo).encode("utf-8") if cuerpo is not None else None
+    cabeceras = {"Content-Type": "application/json"}
+    if cliente:
+        cabeceras["X-Cliente-Id"] = cliente
+    solicitud = urlrequest.Request(base + ruta, data=datos, method=metodo, headers=cabeceras)
+    inicio = time.perf_counter()
+    try:
+        with urlrequest.urlopen(solicitud, timeout=timeout) as respuesta:
+            contenido = respuesta.read()
+            status = respuesta.status
+    except urlerror.HTTPError as e:
+        e.read()
+        contenido, status = None, e.code
+    except Exception:
+        contenido, status = None, 0   # error de red o timeout
+    registro.agregar(endpoint, time.perf_counter() - inicio, status)
+    if contenido and 200 <= status < 300:
+        try:
+            return json.loads(contenido)
+        except ValueError:
+            return None
+    return None
+
+def recorrido_lista(base, registro, pacientes, cliente):
+    solicitar(base, "GET", "/fhir/Patient", "GET /fhir/Patient", registro, cliente=cliente)
+
+def recorrido_ficha(base, registro, pacientes, cliente):
+    pid = random.choice(pacientes)
+    solicitar(base, "GET", f"/fhir/Patient/{pid}", "GET /fhir/Patient/{id}", registro, cliente=cliente)
+    solicitar(base, "GET", f"/fhir/Observation/{pid}", "GET /fhir/Observation/{id}", registro, cliente=cliente)
+    solicitar(base, "GET", f"/fhir/MedicationStatement/{pid}", "GET /fhir/MedicationStatement/{id}", registro, cliente=cliente)
+
+def recorrido_panel_ia(base, registro, pacientes, cliente):
+    pid = random.choice(pacientes)
+    llamadas = [
+        ("/ai/deteccion-anomalias", {"paciente_id": pid}),
+        ("/ai/prediccion-tendencias", {"paciente_id": pid, "biomarcador": random.choice(BIOMARCADORES), "dias_prediccion": 90}),
+        ("/ai/recomendaciones", {"paciente_id": pid}),
+    ]
+    hilos = [
+        threading.Thread(target=solicitar, args=(base, "POST", ruta, f"POST {ruta}", registro, cuerpo, cliente))
+        for ruta, cuerpo in llamadas
+    ]
+    for hilo in hilos:
+        hilo.start()
+    for hilo in hilos:
+        hilo.join()
+
+def recorrido_optimizacion(base, registro, pacientes, cliente):
+    pid = random.choice(pacientes)
+    solicitar(base, "POST", "/ai/optimizacion-suplementos", "POST /ai/optimizacion-suplementos", registro,
+              {"paciente_id": pid}, cliente)
+
+FUNCIONES = {
+    "lista": recorrido_lista,
+    "ficha": recorrido_ficha,
+    "panel_ia": recorrido_panel_ia,
+    "optimizacion": recorrido_optimizacion,
+}
+
+def usuario_virtual(numero, base, registro, pacientes, fin, pausa):
+    cliente = f"usuario-{numero}"
+    nombres, pesos = list(RECORRIDOS), list(RECORRIDOS.values())
+    while time.monotonic() < fin:
+        FUNCIONES[random.choices(nombres, weights=pesos)[0]](base, registro, pacientes, cliente)
+        # Tiempo de lectura del médico entre pantallas
+        time.sleep(random.expovariate(1 / pausa) if pausa > 0 else 0)
+
+def bundle_importacion(pacientes_por_lote, observaciones_por_paciente):
+    """Bundle batch con pacientes nuevos y sus observaciones, referenciados por urn:uuid"""
+    entradas = []
+    for _ in range(pacientes_por_lote):
+        url = f"urn:uuid:{uuid.uuid4()}"
+        entradas.append({
+            "fullUrl": url,
+            "resource": {
+                "resourceType": "Patient",
+                "name": [{"given": ["Carga"], "family": f"Prueba{random.randint(1, 10**6)}"}],
+                "gender": random.choice(["male", "female"]),
+                "birthDate": f"{random.randint(1940, 2000)}-0{random.randint(1, 9)}-1{random.randint(0, 9)}",
+            },
+            "request": {"method": "POST", "url": "Patient"},
+        })
+        for _ in range(observaciones_por_paciente):
+            biomarcador = random.choice(BIOMARCADORES)
+            entradas.append({
+                "resource": {
+                    "resourceType": "Observation",
+                    "status": "final",
+                    "subject": {"reference": url},
+                    "code": {"coding": [{"system": "http://loinc.org", "code": CODIGOS_LOINC[biomarcador]}]},
+                    "valueQuantity": {"value": random.randint(10, 300)},
+                    "effectiveDateTime": f"2024-0{random.randint(1, 9)}-1{random.randint(0, 9)}",
+                },
+                "request": {"method": "POST", "url": "Observation"},
+            })
+    return {"resourceType": "Bundle", "type": "batch", "entry": entradas}
+
+def importador(base, registro, fin, intervalo, pacientes_por_lote):
+    while time.monotonic() < fin:
+        solicitar(base, "POST", "/fhir/import", "POST /fhir/import", registro,
+                  bundle_importacion(pacientes_por_lote, 10), "importador", timeout=120)
+        time.sleep(intervalo)
+
+def percentil(valores, p):
+    """Percentil por rango más cercano sobre valores ordenados"""
+    if not valores:
+        return None
+    return valores[max(0, math.ceil(p / 100 * len(valores)) - 1)]
+
+def resumir(registro, duracion, slos):
+    reporte = {}
+    for endpoint, mediciones in sorted(registro.mediciones.items()):
+        latencias = sorted(s * 1000 for s, _ in mediciones)
+        estados = [status for _, status in mediciones]
+        errores = sum(1 for s in estados if not 200 <= s < 300)
+        rechazos = sum(1 for s in estados if s in (429, 503))
+        fila = {
+            "solicitudes": len(mediciones),
+            "rps": round(len(mediciones) / duracion, 2),
+            "p50_ms": round(percentil(latencias, 50), 1),
+            "p95_ms": round(percentil(latencias, 95), 1),
+            "p99_ms": round(percentil(latencias, 99), 1),
+            "tasa_error": round(errores / len(mediciones), 4),
+            "rechazos": rechazos,
+        }
+        slo = slos.get(endpoint)
+        if slo:
+            fallas = []
+            for clave in ("p50", "p95", "p99"):
+                if clave in slo and fila[f"{clave}_ms"] > slo[clave]:
+                    fallas.append(f"{clave} {fila[f'{clave}_ms']:.0f}ms > {slo[clave]}ms")
+            if "error" in slo and fila["tasa_error"] > slo["error"]:
+                fallas.append(f"error {fila['tasa_error']:.2%} > {slo['error']:.2%}")
+            fila["slo"] = "FALLA" if fallas else "OK"
+            fila["fallas"] = fallas
+        reporte[endpoint] = fila
+    return reporte
+
+def imprimir(reporte):
+    print(f"{'Endpoint':<38} {'n':>6} {'rps':>7} {'p50':>8} {'p95':>8} {'p99':>8} {'error':>7} {'429/503':>8}  SLO")
+    for endpoint, f in reporte.items():
+        print(
+            f"{endpoint:<38} {f['solicitudes']:>6} {f['rps']:>7} {f['p50_ms']:>8} {f['p95_ms']:>8} "
+            f"{f['p99_ms']:>8} {f['tasa_error']:>7.2%} {f['rechazos']:>8}  {f.get('slo', '-')}"
+        )
+        for falla in f.get("fallas", []):
+            print(f"    {falla}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prueba de carga con tráfico mixto y SLOs")
+    parser.add_argument("--base", default="http://localhost:8000")
+    parser.add_argument("--usuarios", type=int, default=10)
+    parser.add_argument("--duracion", type=float, default=60, help="Segundos de prueba")
+    parser.add_argument("--pausa", type=float, default=1.0, help="Pausa media entre recorridos (segundos)")
+    parser.add_argument("--intervalo-importacion", type=float, default=30, help="Segundos entre importaciones; 0 = sin importador")
+    parser.add_argument("--pacientes-por-lote", type=int, default=20)
+    parser.add_argument("--slo", help="JSON con SLOs por endpoint que reemplazan a los declarados")
+    parser.add_argument("--salida", help="Guarda el reporte en JSON")
+    args = parser.parse_args()
+
+    slos = dict(SLOS)
+    if args.slo:
+        with open(args.slo, encoding="utf-8") as f:
+            slos.update(json.load(f))
+
+    with urlrequest.urlopen(args.base + "/fhir/Patient", timeout=60) as respuesta:
+        pacientes = [p["id"] for p in json.loads(respuesta.read())]
+    if not pacientes:
+        print("No hay pacientes; cargue datos con scripts/generate_test_data.py")
+        sys.exit(1)
+
+    registro = Registro()
+    fin = time.monotonic() + args.duracion
+    print(f"{args.usuarios} usuarios durante {args.duracion:.0f}s sobre {len(pacientes)} pacientes...")
+    inicio = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.usuarios + 1) as ejecutor:
+        if args.intervalo_importacion > 0:
+            ejecutor.submit(importador, args.base, registro, fin, args.intervalo_importacion, args.pacientes_por_lote)
+        for numero in range(args.usuarios):
+            ejecutor.submit(usuario_virtual, numero, args.base, registro, pacientes, fin, args.pausa)
+    duracion = time.monotonic() - inicio
+
+    reporte = resumir(registro, duracion, slos)
+    imprimir(reporte)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump({"usuarios": args.usuarios, "duracion": round(duracion, 1), "endpoints": reporte}, f, indent=2)
+    fallidos = [e for e, f in reporte.items() if f.get("slo") == "FALLA"]
+    print(f"\n{'❌' if fallidos else '✅'} {len(reporte) - len(fallidos)}/{len(reporte)} endpoints cumplen su SLO")
+    sys.exit(1 if fallidos else 0)